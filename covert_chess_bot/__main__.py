@@ -1,3 +1,5 @@
 from covert_chess_bot import bot
 
-bot.main()
\ No newline at end of file
+# guarded, as hint worker processes import this module when they start
+if __name__ == "__main__":
+    bot.main()
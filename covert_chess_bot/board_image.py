@@ -0,0 +1,351 @@
+# ------------------------------------------------------------------------------
+# Board Image
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Renders a PNG image of a chess position, so it can be seen without opening an
+# external link.
+#
+# Everything that doesn't depend on the position is drawn once, at import: an
+# empty board background, and an atlas of every piece sprite already drawn on
+# both colours of square. Rendering a position is then just copying background
+# rows and splicing in the sprite of each occupied square. Images only depend
+# on where pieces are, so they are cached by the pieces part of a FEN position.
+#
+# No imaging library is needed, PNGs are written directly with zlib.
+# https://www.w3.org/TR/png/
+# ------------------------------------------------------------------------------
+
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+
+# pixels per side of a square
+SQUARE_SIZE = 48
+
+# pixels per side of board
+BOARD_SIZE = 8 * SQUARE_SIZE
+
+# square colours (r, g, b)
+LIGHT_SQUARE = (240, 217, 181)
+DARK_SQUARE = (181, 136, 99)
+
+# piece colours, (fill, outline)
+WHITE_PIECE = ((255, 255, 255), (0, 0, 0))
+BLACK_PIECE = ((40, 40, 40), (0, 0, 0))
+
+# rendered images kept in memory
+IMAGE_CACHE_SIZE = 512
+
+# piece shapes, "#" outline, "o" fill, "." transparent
+pieceMasks = {
+    "P": [
+        "................",
+        "................",
+        "................",
+        "......####......",
+        ".....#oooo#.....",
+        ".....#oooo#.....",
+        "......#oo#......",
+        ".....#oooo#.....",
+        "....#oooooo#....",
+        ".....#oooo#.....",
+        "....#oooooo#....",
+        "...#oooooooo#...",
+        "..#oooooooooo#..",
+        "..############..",
+        "................",
+        "................",
+    ],
+    "N": [
+        "................",
+        ".....##.........",
+        "....#o##........",
+        "....#ooo###.....",
+        "...#oooooo##....",
+        "..#oo#ooooo#....",
+        "..#ooooooooo#...",
+        "...##ooooooo#...",
+        "....##oooooo#...",
+        ".....#oooooo#...",
+        "....#ooooooo#...",
+        "...#oooooooo#...",
+        "..#oooooooooo#..",
+        "..############..",
+        "................",
+        "................",
+    ],
+    "B": [
+        "................",
+        ".......##.......",
+        "......#oo#......",
+        ".......##.......",
+        "......#oo#......",
+        ".....#oooo#.....",
+        ".....#o##o#.....",
+        ".....#oooo#.....",
+        "......#oo#......",
+        ".....#oooo#.....",
+        "....#oooooo#....",
+        "...#oooooooo#...",
+        "..#oooooooooo#..",
+        "..############..",
+        "................",
+        "................",
+    ],
+    "R": [
+        "................",
+        "..##.##..##.##..",
+        "..#o##o##o##o#..",
+        "..#oooooooooo#..",
+        "...#oooooooo#...",
+        "....#oooooo#....",
+        "....#oooooo#....",
+        "....#oooooo#....",
+        "....#oooooo#....",
+        "....#oooooo#....",
+        "...#oooooooo#...",
+        "..#oooooooooo#..",
+        "..#oooooooooo#..",
+        "..############..",
+        "................",
+        "................",
+    ],
+    "Q": [
+        "................",
+        ".##....##....##.",
+        ".##....##....##.",
+        "..#o#.#oo#.#o#..",
+        "..#oo#oooo#oo#..",
+        "..#oooooooooo#..",
+        "...#oooooooo#...",
+        "...#oooooooo#...",
+        "....#oooooo#....",
+        "....#oooooo#....",
+        "...#oooooooo#...",
+        "..#oooooooooo#..",
+        "..#oooooooooo#..",
+        "..############..",
+        "................",
+        "................",
+    ],
+    "K": [
+        ".......##.......",
+        "......####......",
+        ".......##.......",
+        ".....######.....",
+        "....#oooooo#....",
+        "...#oooooooo#...",
+        "..#oooo##oooo#..",
+        "..#ooo#oo#ooo#..",
+        "...#oooooooo#...",
+        "....#oooooo#....",
+        "....#oooooo#....",
+        "...#oooooooo#...",
+        "..#oooooooooo#..",
+        "..############..",
+        "................",
+        "................",
+    ],
+}
+
+def drawSquare(colour):
+    '''
+    Returns rows (bytes of rgb pixels) of an empty square.
+    '''
+    return [bytes(colour) * SQUARE_SIZE] * SQUARE_SIZE
+
+def drawSprite(mask, pieceColours, squareColour):
+    '''
+    Returns rows (bytes of rgb pixels) of a square with a piece drawn on it.
+    '''
+    fill, outline = pieceColours
+    colours = {"#": outline, "o": fill, ".": squareColour}
+
+    # each mask pixel becomes a block of pixels, with mask centered in square
+    scale = SQUARE_SIZE // (len(mask) + 4)
+    margin = (SQUARE_SIZE - scale * len(mask)) // 2
+
+    rows = []
+    for y in range(SQUARE_SIZE):
+        maskY = (y - margin) // scale
+        row = bytearray()
+        for x in range(SQUARE_SIZE):
+            maskX = (x - margin) // scale
+            if 0 <= y - margin and 0 <= x - margin and maskY < len(mask) and maskX < len(mask[maskY]):
+                row += bytes(colours[mask[maskY][maskX]])
+            else:
+                row += bytes(squareColour)
+        rows.append(bytes(row))
+
+    return rows
+
+def drawBackground():
+    '''
+    Returns rows (bytes of rgb pixels) of an empty board.
+    '''
+    lightSquare = drawSquare(LIGHT_SQUARE)
+    darkSquare = drawSquare(DARK_SQUARE)
+
+    rows = []
+    for squareRow in range(8):
+        for y in range(SQUARE_SIZE):
+            rows.append(b"".join((lightSquare if (squareRow + file) % 2 == 0 else darkSquare)[y] for file in range(8)))
+
+    return rows
+
+# drawn once, every render starts from these
+background = drawBackground()
+
+# (piece letter, square is light) -> rows of square with piece drawn on it
+spriteAtlas = {}
+for kind, mask in pieceMasks.items():
+    for isLight in (True, False):
+        squareColour = LIGHT_SQUARE if isLight else DARK_SQUARE
+        spriteAtlas[(kind, isLight)] = drawSprite(mask, WHITE_PIECE, squareColour)
+        spriteAtlas[(kind.lower(), isLight)] = drawSprite(mask, BLACK_PIECE, squareColour)
+
+def pngChunk(chunkType, data):
+    '''
+    Returns a PNG chunk (length, type, data, crc).
+    '''
+    return struct.pack(">I", len(data)) + chunkType + data + struct.pack(">I", zlib.crc32(chunkType + data))
+
+def writePng(rows, width, height):
+    '''
+    Returns PNG file of given rows of rgb pixels.
+    '''
+    # filter type 0 (none) before each row
+    raw = b"".join(b"\x00" + bytes(row) for row in rows)
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + pngChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + pngChunk(b"IDAT", zlib.compress(raw, 6))
+            + pngChunk(b"IEND", b""))
+
+def placementKey(fenPosition):
+    '''
+    Returns part of a FEN position images depend on (where pieces are), used as cache key.
+    '''
+    return fenPosition.split(" ", 1)[0]
+
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def renderPlacement(placement):
+    '''
+    Returns PNG image (bytes) of board with pieces placed as in pieces part of a FEN position.
+    '''
+    rows = [bytearray(row) for row in background]
+
+    square = 0
+    for char in placement:
+        if char == "/":
+            continue
+        if char in "12345678":
+            square += int(char)
+            continue
+
+        squareRow, file = divmod(square, 8)
+        sprite = spriteAtlas[(char, (squareRow + file) % 2 == 0)]
+
+        start = file * SQUARE_SIZE * 3
+        end = start + SQUARE_SIZE * 3
+        for y in range(SQUARE_SIZE):
+            rows[squareRow * SQUARE_SIZE + y][start:end] = sprite[y]
+
+        square += 1
+
+    if square != 64:
+        raise ValueError("FEN position must describe 64 squares")
+
+    return writePng(rows, BOARD_SIZE, BOARD_SIZE)
+
+def renderBoard(fenPosition):
+    '''
+    Returns PNG image (bytes) of board of given FEN position.
+    '''
+    return renderPlacement(placementKey(fenPosition))
+
+class FileIdCache:
+    '''
+    Telegram file ids of already uploaded images, by placement, so identical boards are only uploaded once.
+    '''
+
+    def __init__(self, maxSize = 10000):
+        self.maxSize = maxSize
+        self.fileIds = OrderedDict()
+        # placement -> Event set once the image being uploaded has a file id (or failed)
+        self.uploading = {}
+        self.lock = threading.Lock()
+
+    def get(self, placement):
+        '''
+        Returns file id of image of placement, None if it hasn't been uploaded.
+        '''
+        with self.lock:
+            fileId = self.fileIds.get(placement)
+            if fileId != None:
+                self.fileIds.move_to_end(placement)
+            return fileId
+
+    def claim(self, placement, timeout = 30):
+        '''
+        Returns file id of image of placement, waiting for it if it is already
+        being uploaded. Returns None if caller should upload it, in which case
+        set (or release, if the upload fails) must be called.
+        '''
+        with self.lock:
+            fileId = self.fileIds.get(placement)
+            if fileId != None:
+                self.fileIds.move_to_end(placement)
+                return fileId
+
+            uploaded = self.uploading.get(placement)
+            if uploaded == None:
+                self.uploading[placement] = threading.Event()
+                return None
+
+        # same board is being uploaded for another chat, use its file id
+        uploaded.wait(timeout)
+
+        return self.get(placement)
+
+    def set(self, placement, fileId):
+        '''
+        Remember file id of uploaded image of placement.
+        '''
+        with self.lock:
+            self.fileIds[placement] = fileId
+            self.fileIds.move_to_end(placement)
+            while len(self.fileIds) > self.maxSize:
+                self.fileIds.popitem(last=False)
+
+        self.release(placement)
+
+    def release(self, placement):
+        '''
+        Stop waiting for an upload of placement to finish.
+        '''
+        with self.lock:
+            uploaded = self.uploading.pop(placement, None)
+
+        if uploaded != None:
+            uploaded.set()
+
+    def shrink(self):
+        '''
+        Forget file ids of the least recently used half of uploaded images, e.g. when short of memory.
+        '''
+        with self.lock:
+            for i in range(len(self.fileIds) // 2):
+                self.fileIds.popitem(last=False)
+
+    def discard(self, placement):
+        '''
+        Forget file id of placement, e.g. when telegram no longer accepts it.
+        '''
+        with self.lock:
+            self.fileIds.pop(placement, None)
@@ -9,56 +9,200 @@
 # ------------------------------------------------------------------------------
 
 import logging
-import emoji
-from covert_chess_bot import credentials, covert_chess
+import re
+from functools import lru_cache
+from io import BytesIO
+from covert_chess_bot import board_image, command_table, credentials, covert_chess, emoji_importer, engine, framing, log_pipeline, memory, metrics, move_check, openings, shadow, streaming
+from covert_chess_bot.command_table import CommandTable, TEXT_ARGUMENT, FEN_ARGUMENT, POSITION_ARGUMENT
+from covert_chess_bot.profiling import SlowRequestProfiler
+from covert_chess_bot.reminders import ReminderStore, MAX_HOURS, formatHours
+from covert_chess_bot.send_queue import SendQueue
+from covert_chess_bot.sessions import SessionStore
+from covert_chess_bot.telegram_request import MeteredRequest, connectionPoolSize
+from covert_chess_bot.tenants import TenantRunner
+from covert_chess_bot.workers import WebhookWorkerPool
+
+from telegram import Bot, Chat, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import BadRequest
+from telegram.ext import Updater, InlineQueryHandler, MessageHandler, Filters
+
+# rate limited queue all replies are sent through, created when bot is started
+sendQueue = None
+
+# every bot being served, when serving several bots from one process (see tenants.py)
+tenants = None
+
+# scheme new positions are encoded with, original unless dense is turned on in credentials
+encodingScheme = getattr(credentials, "encoding_scheme", None) or covert_chess.DEFAULT_SCHEME
+
+def send_queue_for(update):
+    '''Returns send queue for replies to an update, None if they are sent straight away.'''
+    # each bot has its own rate limits, so its own send queue
+    if tenants != None:
+        return tenants.tenantOf(update).sendQueue
+
+    return sendQueue
+
+def log_send_error(future):
+    '''Log why a queued message couldn't be sent (e.g. the chat blocked the bot), as nothing else waits on its Future.'''
+    error = future.exception()
+    if error != None:
+        logger.error("sending message failed: %s", error, exc_info=error)
+
+def reply(update, text, **kwargs):
+    '''Queue a reply to the chat an update came from, returns a Future of the sent message.'''
+    queue = send_queue_for(update)
+
+    # without a send queue (e.g. handlers used outside of main) reply straight away
+    if queue == None:
+        return update.message.reply_text(text, **kwargs)
+
+    # quote the message replied to in groups, as reply_text does
+    if update.effective_chat.type != Chat.PRIVATE:
+        kwargs.setdefault("reply_to_message_id", update.message.message_id)
+
+    future = queue.send(update.effective_chat.id, text, **kwargs)
+    future.add_done_callback(log_send_error)
+
+    return future
+
+# telegram file ids of board images already sent, so each board is only uploaded once
+boardFileIds = board_image.FileIdCache()
+
+def send_board(bot, chatId, fen, **kwargs):
+    '''Send image of board of a position to a chat, reusing an already uploaded image of the same board if there is one.'''
+    placement = board_image.placementKey(fen)
+
+    # waits if the same board is already being uploaded for another chat
+    fileId = boardFileIds.claim(placement)
+    if fileId != None:
+        try:
+            return bot.send_photo(chatId, fileId, **kwargs)
+        # telegram no longer accepts file id, upload image again
+        except BadRequest:
+            boardFileIds.discard(placement)
 
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+    try:
+        message = bot.send_photo(chatId, BytesIO(board_image.renderBoard(fen)), **kwargs)
+    # let anyone waiting for this upload try uploading it themselves
+    except Exception:
+        boardFileIds.release(placement)
+        raise
 
-def start(update, context):
-    '''Send a message when a user uses the bot for the first time or the command /start is issued.'''
-    user = update.effective_user
-    update.message.reply_text(f'Hi {user.name}, welcome to the Covert Chess telegram bot!\nUse /commands for a list of availble commands.')
-    
-def unknown(update, context):
-    '''Catches when user tries to use an unimplemented or misspelled command.'''
-    update.message.reply_text('This is not a valid command, please use /commands for a list of available commands.')
+    # largest size telegram made of image
+    boardFileIds.set(placement, message.photo[-1].file_id)
 
-def commands_command(update, context):
-    '''Send a message explaining possible commands when command /commands or /help is issued.'''
-    update.message.reply_text('''The commands available in this bot are:
+    return message
+
+def reply_board(update, context, fen, **kwargs):
+    '''Queue image of board of a position as a reply to the chat an update came from, returns a Future of the sent message.'''
+    chatId = update.effective_chat.id
+    queue = send_queue_for(update)
+
+    # without a send queue (e.g. handlers used outside of main) reply straight away
+    if queue == None:
+        return send_board(context.bot, chatId, fen, **kwargs)
 
-/startgame - gives emoji encoding and FEN of a chess board in its starting state 
+    return queue.submit(chatId, send_board, context.bot, chatId, fen, **kwargs)
 
-/encode (fen) - convert given chess position to emoji encoding of it
+# current position of each chat's game, created when bot is started (if enabled)
+sessions = None
 
-/decode (emojiString or mixedString) - decodes back to fen
+def session_store_for(update):
+    '''Returns store of current positions for the chat an update came from, None if positions aren't remembered.'''
+    # each bot has its own games
+    if tenants != None:
+        return tenants.tenantOf(update).sessions
 
-/resign (emojiString or mixedString or fen) - creates emoji encoding to show resignation at given position
+    return sessions
+
+def remember_position(update, fen, encoding = None):
+    '''Store position as the current position of the game in the chat an update came from.'''
+    store = session_store_for(update)
+    if store != None:
+        if encoding == None:
+            encoding = covert_chess.encode(fen, encodingScheme)
+        store.set(update.effective_chat.id, fen, encoding)
+
+    # a new position pushes back chat's move reminder (if it has asked for them)
+    if reminders != None:
+        reminders.touch(reminder_key(update), fen)
+
+def session_encoding(update):
+    '''Returns emoji encoding of current position of the game in the chat an update came from, empty if there isn't one.'''
+    store = session_store_for(update)
+    if store != None:
+        session = store.get(update.effective_chat.id)
+        if session != None:
+            return session.encoding
+
+    return ""
+
+def opening_section(fen):
+    '''Returns section of a response naming the opening of a position, empty if it isn't a known opening.'''
+    name = openings.openingName(fen)
+
+    if name == None:
+        return ""
+
+    return f'Opening:\n{name}\n\n'
+
+def move_check_text(result):
+    '''Returns text saying whether a position follows from the previous one by one legal move, and if not why not.'''
+    if result["legal"]:
+        return f'✅ {result["move"]} is one legal move from the previous position.'
+
+    if result["move"] != None:
+        text = f'⚠️ The board matches {result["move"]}, but the rest of the position doesn\'t:'
+    else:
+        text = f'⚠️ This is not one legal move from the previous position:'
 
-/mix (emojiString or fen) (message=message) - mix emoji encoding in to a given block of text, returns mixed message
+    for problem in result["problems"]:
+        text += f'\n- {problem}'
 
-/extract (mixedString) - remove embedded emoji encoding from mixed message
+    return text
 
-/move (emojiString or fen) - sends lichess link allowing a move to be made in given position
+def move_check_section(update, fen):
+    '''Returns section of a response checking a position follows the chat's current position by one legal move, empty if chat has no other current position.'''
+    store = session_store_for(update)
+    if store == None:
+        return ""
 
-/edit [emojiString or fen] - sends lichess link to edit a given position freely
+    session = store.get(update.effective_chat.id)
+    # e.g. the current position decoded again
+    if session == None or session.fen == fen:
+        return ""
 
-/commands - what you just used!
+    return f'Move check:\n{move_check_text(move_check.checkPositions(session.fen, fen))}\n\n'
+
+def start(update, context):
+    '''Send a message when a user uses the bot for the first time or the command /start is issued.'''
+    user = update.effective_user
+    reply(update, f'Hi {user.name}, welcome to the Covert Chess telegram bot!\nUse /commands for a list of availble commands.')
     
-n.b. required / optionalparameters are shown inside () or [] style brackets, but these are not necessary when actually inputting a command
-''')
+def unknown(update, context):
+    '''Catches when user tries to use an unimplemented or misspelled command.'''
+    reply(update, 'This is not a valid command, please use /commands for a list of available commands.')
+
+def commands_command(update, context):
+    '''Send a message explaining possible commands when command /commands or /help is issued.'''
+    reply(update, help_text())
 
 def emoji_info(update, context):
     '''When a user sends a single emoji message, sends info about that emoji'''
     
     # gets list of emojis from message
-    messageEmojis = emoji.emoji_lis(update.message.text)
+    messageEmojis = covert_chess.findEmoji(update.message.text)
+
+    # rest of a position cut off at the end of an earlier /decode
+    if continue_position(update, messageEmojis):
+        return
     
     # checks if there is exactly 1 emoji in message
     if len(messageEmojis) == 1:
 
         # get index of emoji in message
-        emojiIndex = covert_chess.emojiIndex(messageEmojis[0]["emoji"])
+        emojiIndex = covert_chess.emojiIndex(messageEmojis[0])
 
         # function to build reposnse message for emoji at a given index
         def buildEmojiInfoReply(index):
@@ -80,19 +224,19 @@ def emoji_info(update, context):
 
         # checks if message is just the fully qualified emoji
         if update.message.text == covert_chess.emojiList[emojiIndex]:
-            update.message.reply_text(buildEmojiInfoReply(emojiIndex))
+            reply(update, buildEmojiInfoReply(emojiIndex))
 
         # checks if message is just the minimally qualified emoji
         elif update.message.text == covert_chess.emojiListLessQualified[emojiIndex]:
-            update.message.reply_text(buildEmojiInfoReply(emojiIndex))
+            reply(update, buildEmojiInfoReply(emojiIndex))
 
         # checks if message is just fully qualified emoji + variation selector 16
         elif update.message.text == covert_chess.emojiList[emojiIndex] + variationSelector16:
-            update.message.reply_text(buildEmojiInfoReply(emojiIndex))
+            reply(update, buildEmojiInfoReply(emojiIndex))
 
         # checks if message is just the minimally qualified emoji + variation selector 16
         elif update.message.text == covert_chess.emojiListLessQualified[emojiIndex] + variationSelector16:
-            update.message.reply_text(buildEmojiInfoReply(emojiIndex))
+            reply(update, buildEmojiInfoReply(emojiIndex))
 
         # message contains more than just the 1 emoji in it
         else:
@@ -106,290 +250,875 @@ def startgame_command(update, context):
     response += "\n\n"
     response += f'FEN:\n{startingFen}'
     response += "\n\n"
-    response += f'Emoji encoding:\n{covert_chess.encode(startingFen)}'
+    response += f'Emoji encoding:\n{covert_chess.encode(startingFen, encodingScheme)}'
     response += "\n\n"
     response += f'Analysis board:\n{covert_chess.makeMove(startingFen)}'
 
-    update.message.reply_text(response, disable_web_page_preview=True)
+    reply(update, response, disable_web_page_preview=True)
+
+    # a new game has been started in this chat
+    remember_position(update, startingFen)
 
 def encode_command(update, context):
     '''Sends emoji encoding of passed FEN position when /encode is issued.'''
-    try:
-        # checks an argument was passed
-        if len(update.message.text.split(" ", 1)) > 1:
+    # passed FEN, already checked by command dispatcher
+    fen = context.fen
+
+    response = f'Please see below the emoji encoding of the passed chess position. Use the /mix command if you wish to embed this position in to a text message.'
+
+    response += "\n\n"
 
-            # get passed FEN
-            fen = update.message.text.split(" ", 1)[1].strip()
+    response += f'Input FEN:\n{fen}'
 
-            response = f'Please see below the emoji encoding of the passed chess position. Use the /mix command if you wish to embed this position in to a text message.'
-            
-            response += "\n\n"
-            
-            response += f'Input FEN:\n{fen}'
+    response += "\n\n"
+
+    encoding = covert_chess.encode(fen, encodingScheme)
+
+    response += f'Emoji encoding:\n{encoding}'
+
+    response += "\n\n"
 
-            response += "\n\n"
+    response += f'Analysis board:\n{covert_chess.makeMove(fen)}'
 
-            response += f'Emoji encoding:\n{covert_chess.encode(fen)}'
+    reply(update, response, disable_web_page_preview=True)
 
-            response += "\n\n"
+    remember_position(update, fen, encoding)
 
-            response += f'Analysis board:\n{covert_chess.makeMove(fen)}'
+# most positions found in one message that are reported, so replies stay within telegram's message length
+MAX_REPORTED_POSITIONS = 5
 
-            update.message.reply_text(response, disable_web_page_preview=True)
+# position of each chat partly received so far, when /decode is given a position cut off part way through
+partialPositions = streaming.PartialPositions()
 
-        # no argument passed
+def partial_progress_text(decoder):
+    '''Returns text describing how much of a partly received position has arrived.'''
+    message = f'Received {decoder.received} of {decoder.needed} emoji of a position so far'
+
+    # squares of an original scheme position are known as their emoji arrive
+    if decoder.needed == covert_chess.originalSchemeLength:
+        known = sum(square != None for square in decoder.squares())
+        message += f' ({known} of 64 squares decoded)'
+
+    return message + ', send the rest of it in your next message to decode it.'
+
+def decoded_positions_text(update, positions):
+    '''Returns response giving FEN (and opening, analysis board & move check) of each decoded position.'''
+    response = ""
+    if len(positions) > 1:
+        response += f'{len(positions)} positions were found in the passed message, please see each of them below.'
+        response += "\n\n"
+
+    for number, position in enumerate(positions[:MAX_REPORTED_POSITIONS], 1):
+        if len(positions) > 1:
+            response += f'Position {number}:\n'
+
+        # checks if position includes resignation emoji
+        if position["resigned"]:
+            response += f'Your opponent resigned! Use the link to the analysis board if you wish to view the position at time of resignation.'
+
+        # no resignation
         else:
-            update.message.reply_text('please input a valid FEN chess position after the /encode command')
-    
-    # try block failed, likely because of invalid FEN
-    except:
-        update.message.reply_text('please input a valid FEN chess position after the /encode command')
+            response += f'Please see below the FEN of the passed emoji encoding. Use the link to the analysis board if you wish to make a move, copy the resulting FEN position to use with the /encode command.'
+
+        response += "\n\n"
+        response += f'Input emoji encoding:\n{position["emoji"]}'
+        response += "\n\n"
+        response += f'Decoded FEN position:\n{position["fen"]}'
+        response += "\n\n"
+        response += opening_section(position["fen"])
+        response += f'Analysis board:\n{covert_chess.makeMove(position["fen"])}'
+        response += "\n\n"
+
+    # latest position should be one move on from the chat's current position
+    response += move_check_section(update, positions[-1]["fen"])
+
+    if len(positions) > MAX_REPORTED_POSITIONS:
+        response += f'...and {len(positions) - MAX_REPORTED_POSITIONS} more positions, decode them separately to see them.'
+
+    return response
 
 def decode_command(update, context):
-    '''Sends FEN encoding of passed emoji position when /decode is issued.'''
-    try:
-        # checks an argument was passed
-        if len(update.message.text.split(" ", 1)) > 1:
+    '''Sends FEN encoding of each emoji position in passed message when /decode is issued.'''
+    # a message of exactly one position is decoded strictly, even if its pieces
+    # couldn't be on the board in a real game (see framing.readPositions)
+    exact = framing.exactPosition(context.argument)
+    if exact != None:
+        partialPositions.discard(reminder_key(update))
+        reply(update, decoded_positions_text(update, [exact]).strip(), disable_web_page_preview=True)
+        remember_position(update, exact["fen"])
+        return
+
+    # every position in passed string, ignoring any other emoji around them, and
+    # any position cut off at the end of it to be completed by the next messages
+    # (same (bot name, chat id) key as reminders)
+    decoder = partialPositions.start(reminder_key(update))
+    positions = decoder.feed(context.argument) + decoder.flush()
+    partialPositions.keep(reminder_key(update), decoder)
+
+    if len(positions) == 0:
+        if decoder.inProgress:
+            reply(update, partial_progress_text(decoder))
+        else:
+            reply(update, context.command.invalidMessage)
+        return
 
-            # get passed string
-            emojiEncoding = update.message.text.split(" ", 1)[1].strip()
+    response = decoded_positions_text(update, positions)
 
-            # unmix string in case user didn't run /extract first
-            emojiEncoding = covert_chess.unmix(emojiEncoding)
+    if decoder.inProgress:
+        response += f'The end of the message looks like the start of another position. {partial_progress_text(decoder)}'
 
-            # checks if position includes resignation emoji
-            if len(emoji.emoji_lis(emojiEncoding)) > 25 and covert_chess.emojiIndex(emoji.emoji_lis(emojiEncoding)[25]["emoji"]) == 2914:
-                response = f'Your opponent resigned! Use the link to the analysis board if you wish to view the position at time of resignation.'   
+    reply(update, response.strip(), disable_web_page_preview=True)
 
-            # no resignation
-            else:
-                response = f'Please see below the FEN of the passed emoji encoding. Use the link to the analysis board if you wish to make a move, copy the resulting FEN position to use with the /encode command.'
-                
-            response += "\n\n"
-            response += f'Input emoji encoding:\n{emojiEncoding}'
-            response += "\n\n"
+    # latest position in message is the current position of the game
+    remember_position(update, positions[-1]["fen"])
 
-            # decode passed emoji string
-            fen = covert_chess.decode(emojiEncoding)
+def continue_position(update, messageEmojis):
+    '''Adds emoji of a message to the chat's partly received position (if it has one), returns True if they were used.'''
+    key = reminder_key(update)
+    decoder = partialPositions.get(key)
+    # emoji which couldn't be part of the position (e.g. a lone 👍) are left for emoji_info
+    if decoder == None or not decoder.couldContinue(messageEmojis):
+        return False
 
-            response += f'Decoded FEN position:\n{fen}'
-            response += "\n\n"
-            response += f'Analysis board:\n{covert_chess.makeMove(fen)}'
+    positions = decoder.feed(update.message.text) + decoder.flush()
+    partialPositions.keep(key, decoder)
 
-            update.message.reply_text(response, disable_web_page_preview=True)
+    if len(positions) > 0:
+        response = decoded_positions_text(update, positions)
+        if decoder.inProgress:
+            response += partial_progress_text(decoder)
+        reply(update, response.strip(), disable_web_page_preview=True)
+        remember_position(update, positions[-1]["fen"])
 
-        # no argument passed
-        else:
-            update.message.reply_text('Please input a valid emoji chess position after the /decode command.')
-    
-    # try block failed, likely because of invalid emoji encoded chess position
-    except:
-        update.message.reply_text('Please input a valid emoji chess position after the /decode command.')
+    elif decoder.inProgress:
+        reply(update, partial_progress_text(decoder))
+
+    else:
+        reply(update, 'The emoji of this message don\'t continue the position received so far, so it couldn\'t be decoded. Please use the /decode command again with the whole position.')
+
+    return True
+
+def check_command(update, context):
+    '''Checks the 2nd passed emoji position follows the 1st by one legal move when /check is issued.'''
+    # only one position passed, check it follows the chat's current position
+    store = session_store_for(update)
+    session = store.get(update.effective_chat.id) if store != None else None
+
+    try:
+        result = move_check.checkEncodings(context.argument, session.fen if session != None else None)
+    # fewer than 2 positions to compare
+    except ValueError:
+        reply(update, context.command.invalidMessage)
+        return
+
+    response = move_check_text(result)
+    response += "\n\n"
+    response += f'Previous FEN position:\n{result["previous"]}'
+    response += "\n\n"
+    response += f'New FEN position:\n{result["fen"]}'
+
+    reply(update, response)
 
 def resign_command(update, context):
     '''Give altered emoji string to show resignation at given position when /resign is issued'''
-    try:
-        # checks an argument was passed
-        if len(update.message.text.split(" ", 1)) > 1:
-            
-            response = f'Please see below the emoji encoding of the passed chess position with resignation marker. Use the /mix command if you wish to embed this position in to a text message.'
-                
-            response += "\n\n"
+    # position passed as argument (or chat's current position if nothing was passed)
+    position = context.argument
 
-            # store position passed as argument
-            position = update.message.text.split(" ", 1)[1].strip()
+    response = f'Please see below the emoji encoding of the passed chess position with resignation marker. Use the /mix command if you wish to embed this position in to a text message.'
+
+    response += "\n\n"
 
-            response += f'Input position:\n{position}'
+    response += f'Input position:\n{position}'
 
-            response += "\n\n"
+    response += "\n\n"
 
-            # emoji position
-            if len(emoji.emoji_lis(position)) > 0:
-                response += f'Resigned position emoji encoding:\n{covert_chess.encode(covert_chess.decode(position))}🏳️'
-            
-            # FEN position
-            else:
-                response += f'Resigned position emoji encoding:\n{covert_chess.encode(position)}🏳️'
+    # emoji & FEN positions were both decoded to FEN by command dispatcher
+    response += f'Resigned position emoji encoding:\n{covert_chess.encode(context.fen, encodingScheme)}🏳️'
 
-            update.message.reply_text(response, disable_web_page_preview=True)
+    reply(update, response, disable_web_page_preview=True)
 
-        # no argument passed
-        else:
-            update.message.reply_text('please input a valid emoji or FEN chess position after the /resign command')
-    
-    # try block failed, likely because of invalid position passed as argument
-    except:
-        update.message.reply_text('please input a valid emoji or FEN chess position after the /resign command')
+# reply to /mix used without a position & message
+MIX_HELP = "To use the /mix command properly, make sure to pass it a chess position, and then a message after the string \"message=\"\n\n"
+MIX_HELP += "e.g.\n/mix ♟️👯‍♂️🧚🏽‍♀️🧑🏻‍🔧👩🏾‍🦽🎥☄️👐🏿👩🏼‍🦼📟🚴🏼‍♂️🚣🏼‍♂️🛒💁🏿🤾🏾‍♀️🅰️👩🏿‍🏫🥔👩🏾‍🔧👼🏾📂🧑🏾‍🦲😀😀👐 message=The quick brown fox jumps over the lazy dog."
 
 def mix_command(update, context):
     '''Send emoji encoding mixed in to passed message when the command /mix is issued.'''
-
-    helpMessage = "To use the /mix command properly, make sure to pass it a chess position, and then a message after the string \"message=\"\n\n"
-    helpMessage += "e.g.\n/mix ♟️👯‍♂️🧚🏽‍♀️🧑🏻‍🔧👩🏾‍🦽🎥☄️👐🏿👩🏼‍🦼📟🚴🏼‍♂️🚣🏼‍♂️🛒💁🏿🤾🏾‍♀️🅰️👩🏿‍🏫🥔👩🏾‍🔧👼🏾📂🧑🏾‍🦲😀😀👐 message=The quick brown fox jumps over the lazy dog."
-    
     try:
         # get passed arguments
-        arguments = update.message.text.split(" ", 1)[1].strip()
+        arguments = context.argument
 
         position = arguments.split("message=")[0].strip()
         premixedMessage = arguments.split("message=")[1].strip()
 
+        # no position passed, mix in chat's current position
+        if position == "":
+            position = session_encoding(update)
+
         message = f'Passed position:\n{position}\n\n'
 
         # position already encoded to emoji
-        if len(emoji.emoji_lis(position)) > 0:
+        if len(covert_chess.findEmoji(position)) > 0:
             message += f'Mixed message:\n{covert_chess.mix(position, premixedMessage)}'
             message += "\n\n"
             message += "Congratulations, you have now covertly hidden this chess position! Paste this message wherever you wish, ready to be decoded by your opponent later."
-            update.message.reply_text(message, disable_web_page_preview=True)
+            reply(update, message, disable_web_page_preview=True)
         # FEN position
         else:
-            message += f'Mixed message:\n{covert_chess.mix(covert_chess.encode(position), premixedMessage)}'
+            message += f'Mixed message:\n{covert_chess.mix(covert_chess.encode(position, encodingScheme), premixedMessage)}'
             message += "\n\n"
             message += "Congratulations, you have now covertly hidden this chess position! Paste this message wherever you wish, ready to be decoded by your opponent later."
-            update.message.reply_text(message, disable_web_page_preview=True)
+            reply(update, message, disable_web_page_preview=True)
 
     except:
-        update.message.reply_text(helpMessage)
+        metrics.handlerErrors.inc("mix")
+        reply(update, MIX_HELP)
 
 def extract_command(update, context):
-    '''Extracts and displays emoji from passed mixed message'''
-    # checks an argument was passed
-    if len(update.message.text.split(" ", 1)) > 1:
+    '''Extracts and displays each position (or if there are none, every emoji) from passed mixed message'''
+    # get passed string
+    mixedMessage = context.argument
+
+    positions = framing.readPositions(mixedMessage)
 
-        # get passed string
-        mixedMessage = update.message.text.split(" ", 1)[1].strip()
+    response = f'Input message:\n{mixedMessage}'
+    response += "\n\n"
 
-        # unmix string in case user didn;t run /extract first
-        emojiOnly = covert_chess.unmix(update.message.text.split(" ", 1)[1])
+    if len(positions) == 1:
+        response += f'Extracted position:\n{positions[0]["emoji"]}'
 
-        response = f'Input message:\n{mixedMessage}'
-        response += "\n\n"
+    elif len(positions) > 1:
+        response += f'Extracted positions:'
+        for number, position in enumerate(positions, 1):
+            response += f'\n\n{number}. {position["emoji"]}'
+
+    # no complete positions, show whatever emoji there are
+    else:
+        emojiOnly = covert_chess.unmix(mixedMessage)
 
         if len(emojiOnly) == 0:
             response += f'No emoji found in passed massage.'
         else:
-            response += f'Extracted emoji:\n{emojiOnly}'
+            response += f'No complete positions found, extracted emoji:\n{emojiOnly}'
+
+    reply(update, response)
+
+def analysis_board(update, context):
+    '''Send link to analysis board of given position when the command /move is issued.'''
+    # argument entered after command (or chat's current position if nothing was passed)
+    argument = context.argument
+
+    # emoji & FEN positions were both decoded to FEN by command dispatcher
+    fen = context.fen
+    remember_position(update, fen)
 
-        update.message.reply_text(response)
+    message = f'Passed position:\n{argument}\n\n'
+    message += opening_section(fen)
+    message += f'Analysis board for passed position:\n{covert_chess.makeMove(fen)}'
+    message += "\n\n"
 
-    # no argument passed
+    # checks if position includes resignation emoji
+    if covert_chess.isResigned(argument):
+        message += f'A resignation occurred at this position! No further move needs to be made'
+
+    # no resignation
     else:
-        update.message.reply_text('Please input a message with embedded emoji after the /extract command.')
+        message += "If you wish to make a move, do so on the linked analysis board, then copy the resulting FEN position to use with the /encode or /mix command."
 
-def analysis_board(update, context):
-    '''Send link to analysis board of given position when the command /move or /show is issued.'''
-    try:
-        # get any argument entered after command
-        argument = update.message.text.split(" ", 1)[1].strip()
+    reply(update, message, disable_web_page_preview=True)
 
-        message = f'Passed position:\n{argument}\n\n'
+def show_command(update, context):
+    '''Send image of board of given position when the command /show is issued.'''
+    # emoji & FEN positions were both decoded to FEN by command dispatcher
+    fen = context.fen
 
-        # emoji encoding
-        if len(emoji.emoji_lis(argument)) > 0:
-            message += f'Analysis board for passed position:\n{covert_chess.makeMove(covert_chess.decode(argument))}'
-            message += "\n\n"
+    caption = fen
+    if openings.openingName(fen) != None:
+        caption += f'\n{openings.openingName(fen)}'
 
-            # checks if position includes resignation emoji
-            if len(emoji.emoji_lis(argument)) > 25 and covert_chess.emojiIndex(emoji.emoji_lis(argument)[25]["emoji"]) == 2914:
-                message += f'A resignation occurred at this position! No further move needs to be made'   
+    reply_board(update, context, fen, caption=caption)
 
-            # no resignation
-            else:
-                message += "If you wish to make a move, do so on the linked analysis board, then copy the resulting FEN position to use with the /encode or /mix command."
-            
-            update.message.reply_text(message, disable_web_page_preview=True)
-        
-        # FEN encoding
+    remember_position(update, fen)
+
+# worker processes searching for hints, created when bot is started
+hints = None
+
+def hint_message(hint):
+    '''Returns response describing a move suggested by the engine.'''
+    if hint["mate"] != None and hint["mate"] > 0:
+        evaluation = f'mate in {hint["mate"]}'
+    elif hint["mate"] != None:
+        evaluation = f'mated in {-hint["mate"]}'
+    elif hint["score"] != None:
+        evaluation = f'{hint["score"] / 100:+.2f}'
+    else:
+        evaluation = 'unknown'
+
+    message = f'Suggested move:\n{hint["move"]}\n\n'
+    message += f'Evaluation (for side to move):\n{evaluation}\n\n'
+    message += f'Expected line:\n{" ".join(hint["line"])}\n\n'
+    message += f'Searched {hint["depth"]} half-moves deep ({hint["nodes"]:,} positions in {hint["seconds"]:.1f}s)\n\n'
+    message += f'Position after suggested move:\n{covert_chess.encode(hint["fen"], encodingScheme)}'
+
+    return message
+
+def hint_command(update, context):
+    '''Suggest a move to make in given position when the command /hint is issued.'''
+    if covert_chess.isResigned(context.argument):
+        reply(update, 'A resignation occurred at this position! No further move needs to be made')
+        return
+
+    # emoji & FEN positions were both decoded to FEN by command dispatcher
+    fen = context.fen
+
+    # without worker processes (e.g. handlers used outside of main) search straight away
+    if hints == None:
+        hint = engine.suggestMove(fen)
+        if hint == None:
+            reply(update, 'There are no legal moves in this position, the game is over.')
         else:
-            # check FEN is valid
-            if covert_chess.decode(covert_chess.encode(argument)) == argument:
-                message += f'Analysis board for passed position:\n{covert_chess.makeMove(argument)}'
-                message += "\n\n"
-                message += "If you wish to make a move, do so on the linked analysis board, then copy the resulting FEN position to use with the /encode or /mix command."
-                update.message.reply_text(message, disable_web_page_preview=True)
-            else: 
-                update.message.reply_text('Please input a valid emoji or FEN chess position after the command.')
+            reply(update, hint_message(hint))
+        return
+
+    # one search per chat (with each bot, when serving several) at a time, and only so many waiting at once
+    key = (context.bot.id, update.effective_chat.id)
+    if hints.isBusy(key):
+        reply(update, 'Still working out the last hint asked for in this chat, please wait for it before asking for another.')
+        return
+
+    future = hints.submit(fen, key=key)
+    if future == None:
+        reply(update, 'Too many hints are being worked out right now, please try again shortly.')
+        return
+
+    # reply once search is done, without holding up a dispatcher thread while it runs
+    def send_hint(future):
+        try:
+            hint = future.result()
+        except ValueError:
+            reply(update, context.command.invalidMessage)
+            return
+        except Exception:
+            metrics.handlerErrors.inc("hint")
+            logger.exception("hint search failed")
+            reply(update, 'Sorry, a hint could not be worked out for this position.')
+            return
+
+        if hint == None:
+            reply(update, 'There are no legal moves in this position, the game is over.')
+        else:
+            reply(update, hint_message(hint))
 
-    except:
-        update.message.reply_text('Please input a valid emoji or FEN chess position after the command.')
+    future.add_done_callback(send_hint)
 
 def board_editor(update, context):
     '''Send link to board editor (optionally of a given position) when the command /edit or /create is issued.'''
-    try:
-        # returns link to edit starting position if no arguments entered
-        if len(update.message.text.split(" ", 1)) == 1:
-            startingFen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    # returns link to edit starting position if no arguments entered (and no game in this chat)
+    if context.argument == "":
+        startingFen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 
-            message = f'Board editor (from starting position):\n{covert_chess.createPosition(startingFen)}'
-            message += "\n\n"
-            message += "After creating desired position in linked board, copy the resulting FEN position to use with the /encode or /mix command."
-            update.message.reply_text(message, disable_web_page_preview=True)
-        
-        else:
-            # get any argument entered after command
-            argument = update.message.text.split(" ", 1)[1].strip()
-
-            message = f'Passed position:\n{argument}\n\n'
-            
-            # emoji position
-            if len(emoji.emoji_lis(argument)) > 0:
-                message += f'Board editor for passed position:\n{covert_chess.createPosition(covert_chess.decode(argument))}'
-                message += "\n\n"
-                message += "After creating desired position in linked board, copy the resulting FEN position to use with the /encode or /mix command."
-                update.message.reply_text(message, disable_web_page_preview=True)
-            
-            # fen position
-            else:
-                # check FEN is valid
-                if covert_chess.decode(covert_chess.encode(argument)) == argument:
-                    message += f'Board editor for passed position:\n{covert_chess.createPosition(argument)}'
-                    message += "\n\n"
-                    message += "After creating desired position in linked board, copy the resulting FEN position to use with the /encode or /mix command."
-                    update.message.reply_text(message, disable_web_page_preview=True)
-                else: 
-                    update.message.reply_text('Invalid position, please enter a valid emoji or FEN chess position or no arguments for starting position.')
-    except:
-        update.message.reply_text('Invalid position, please enter a valid emoji or FEN chess position or no arguments for starting position.')
+        message = f'Board editor (from starting position):\n{covert_chess.createPosition(startingFen)}'
+
+    else:
+        message = f'Passed position:\n{context.argument}\n\n'
+        # emoji & FEN positions were both decoded to FEN by command dispatcher
+        message += f'Board editor for passed position:\n{covert_chess.createPosition(context.fen)}'
+
+    message += "\n\n"
+    message += "After creating desired position in linked board, copy the resulting FEN position to use with the /encode or /mix command."
+    reply(update, message, disable_web_page_preview=True)
 
 def enpassant_command(update, context):
     '''Send a message when the command /enpassant is issued.'''
-    update.message.reply_text('Holy hell')
+    reply(update, 'Holy hell')
+
+# inline results only depend on query text, so telegram can cache them for every user
+INLINE_CACHE_TIME = 3600
+
+@lru_cache(maxsize=1024)
+def inline_results(query):
+    '''Builds (and caches) inline results for a query, returns empty tuple if query is not a usable position.'''
+    results = []
+
+    # optional message to mix position in to, as with /mix
+    position = query.split("message=")[0].strip()
+    premixedMessage = query.split("message=", 1)[1].strip() if "message=" in query else ""
+
+    # debounce, inline queries are sent on every keystroke so most will be
+    # partially typed FEN positions, rejected here before doing any real work
+    # (emoji are never ascii, so an ascii query can only be a FEN position)
+    if position.isascii() and not covert_chess.isValidFen(position):
+        return ()
+
+    # FEN position
+    if position.isascii():
+        encoding = covert_chess.encode(position, encodingScheme)
+
+        results.append(InlineQueryResultArticle(
+            id="encode",
+            title="Encode position",
+            description=encoding,
+            input_message_content=InputTextMessageContent(encoding),
+        ))
+
+    # emoji position (possibly mixed in to a message)
+    else:
+        # first position, ignoring any other emoji around it
+        positions = framing.readPositions(position)
+
+        # no complete position yet, still being typed / pasted
+        if len(positions) == 0:
+            return ()
+
+        fen = positions[0]["fen"]
+        encoding = covert_chess.encode(fen, encodingScheme)
+
+        results.append(InlineQueryResultArticle(
+            id="decode",
+            title="Decode position",
+            description=fen,
+            input_message_content=InputTextMessageContent(f'{fen}\n\n{covert_chess.makeMove(fen)}', disable_web_page_preview=True),
+        ))
+
+    # offered for both FEN & emoji positions
+    if premixedMessage != "":
+        mixedMessage = covert_chess.mix(encoding, premixedMessage)
+        results.append(InlineQueryResultArticle(
+            id="mix",
+            title="Mix position in to message",
+            description=mixedMessage,
+            input_message_content=InputTextMessageContent(mixedMessage),
+        ))
+
+    results.append(InlineQueryResultArticle(
+        id="resign",
+        title="Resign at position",
+        description=encoding + "🏳️",
+        input_message_content=InputTextMessageContent(encoding + "🏳️"),
+    ))
+
+    return tuple(results)
+
+def inline_query(update, context):
+    '''Offers encode / decode / mix / resign results for a position typed after @CovertChessBot in any chat.'''
+    query = update.inline_query.query.strip()
+
+    results = inline_results(query)
+
+    # nothing useful to show yet, don't spend an API call answering
+    if len(results) == 0:
+        return
+
+    # results are the same for everyone sending this query, so not personal
+    update.inline_query.answer(list(results), cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+# move reminders of chats which have asked for them, created when bot is started (if enabled)
+reminders = None
+
+def reminder_key(update):
+    '''Returns key of reminders of the chat an update came from, (bot name (empty unless serving several bots), chat id).'''
+    if tenants != None:
+        return tenants.tenantOf(update).name, update.effective_chat.id
+
+    return "", update.effective_chat.id
+
+def reminder_message(hours):
+    '''Returns text of a move reminder.'''
+    return f'No new position has been decoded in this chat for {formatHours(hours)}, is it your move?\n\nUse /remind off to stop these reminders.'
+
+def send_reminders(batch):
+    '''Queue due move reminders, each bot's as one batch, returns keys of those which couldn't be queued yet.'''
+    byBot = {}
+    for key, hours in batch:
+        byBot.setdefault(key[0], []).append((key, hours))
+
+    deferred = []
+    for botName, due in byBot.items():
+        if tenants != None:
+            tenant = tenants.byName.get(botName)
+            # bot no longer being served
+            if tenant == None:
+                continue
+            queue = tenant.sendQueue
+        else:
+            queue = sendQueue
+
+        futures = queue.sendMany([(chatId, reminder_message(hours)) for (name, chatId), hours in due])
+        deferred += [key for (key, hours), future in zip(due, futures) if future == None]
+
+        for future in futures:
+            if future != None:
+                future.add_done_callback(log_send_error)
+
+    return deferred
+
+# hours given to /remind, e.g. "12", "12h", "1.5 hours"
+hoursPattern = re.compile(r"(\d+(?:\.\d+)?)\s*(?:h|hours?)?")
+
+def remind_command(update, context):
+    '''Turns move reminders on or off for the chat when /remind is issued.'''
+    if reminders == None:
+        reply(update, 'Reminders are not enabled on this bot.')
+        return
+
+    key = reminder_key(update)
+    # e.g. "12", "12h", "1.5 hours" or "off"
+    argument = context.argument.lower().strip()
+
+    # no argument, say whether reminders are on
+    if argument == "":
+        hours = reminders.get(key)
+        if hours == None:
+            reply(update, 'Reminders are off in this chat. Use /remind (hours) to be reminded when no new position has been decoded for that long.')
+        else:
+            reply(update, f'Reminders are on in this chat, after {formatHours(hours)} without a new position. Use /remind off to turn them off.')
+        return
+
+    match = hoursPattern.fullmatch(argument)
+
+    if argument in ("off", "stop") or (match != None and float(match.group(1)) == 0):
+        if reminders.cancel(key):
+            reply(update, 'Reminders turned off in this chat.')
+        else:
+            reply(update, 'Reminders were already off in this chat.')
+        return
+
+    # not a number of hours
+    if match == None:
+        reply(update, context.command.invalidMessage)
+        return
+
+    # current position of chat's game (if known), so showing it again doesn't count as a new position
+    store = session_store_for(update)
+    session = store.get(update.effective_chat.id) if store != None else None
+
+    try:
+        hours = float(match.group(1))
+        reminders.set(key, hours, session.fen if session != None else None)
+    # out of range
+    except ValueError:
+        reply(update, context.command.invalidMessage)
+        return
+
+    reply(update, f'Reminders turned on, this chat will be reminded after {formatHours(hours)} without a new position.')
+
+# samples stacks of slow updates, created when bot is started (if enabled)
+profiler = None
+
+def instrumented(handlerName, callback):
+    '''Wraps a handler callback so its updates are recorded in metrics (and profiled if slow, when enabled).'''
+    if profiler != None:
+        callback = profiler.wrap(handlerName, callback)
+
+    return metrics.instrument(handlerName, callback)
+
+# every command, its aliases, the argument it takes & its help text
+# (listed in help in this order)
+commandTable = CommandTable()
+commandTable.add("start", start, hidden=True)
+commandTable.add("startgame", startgame_command, aliases=["newgame"],
+                 description="gives emoji encoding and FEN of a chess board in its starting state")
+commandTable.add("encode", encode_command, aliases=["encrypt"], argument=FEN_ARGUMENT, required=True,
+                 usage="(fen)", description="convert given chess position to emoji encoding of it",
+                 invalidMessage="please input a valid FEN chess position after the /encode command")
+commandTable.add("decode", decode_command, aliases=["decrypt"], argument=TEXT_ARGUMENT, required=True, session=True,
+                 usage="(emojiString or mixedString)", description="decodes back to fen (every position, if there are several)",
+                 invalidMessage="Please input a valid emoji chess position after the /decode command.")
+commandTable.add("check", check_command, argument=TEXT_ARGUMENT, required=True,
+                 usage="(previous emoji) (new emoji)", description="checks the new position follows the previous one by one legal move",
+                 invalidMessage="Please input two emoji chess positions after the /check command, the previous position then the new one (or just the new one to check it against this chat's current position).")
+commandTable.add("resign", resign_command, aliases=["giveup"], argument=POSITION_ARGUMENT, required=True, session=True,
+                 usage="(emojiString or mixedString or fen)", description="creates emoji encoding to show resignation at given position",
+                 invalidMessage="please input a valid emoji or FEN chess position after the /resign command")
+commandTable.add("mix", mix_command, argument=TEXT_ARGUMENT, required=True,
+                 usage="(emojiString or fen) (message=message)", description="mix emoji encoding in to a given block of text, returns mixed message",
+                 invalidMessage=MIX_HELP)
+commandTable.add("extract", extract_command, aliases=["unmix"], argument=TEXT_ARGUMENT, required=True,
+                 usage="(mixedString)", description="remove embedded emoji encoding (each position, if there are several) from mixed message",
+                 invalidMessage="Please input a message with embedded emoji after the /extract command.")
+commandTable.add("move", analysis_board, argument=POSITION_ARGUMENT, required=True, session=True,
+                 usage="(emojiString or fen)", description="sends lichess link allowing a move to be made in given position",
+                 invalidMessage="Please input a valid emoji or FEN chess position after the command.")
+commandTable.add("show", show_command, argument=POSITION_ARGUMENT, required=True, session=True,
+                 usage="(emojiString or fen)", description="sends an image of the board of given position",
+                 invalidMessage="Please input a valid emoji or FEN chess position after the /show command.")
+commandTable.add("hint", hint_command, argument=POSITION_ARGUMENT, required=True, session=True,
+                 usage="(emojiString or fen)", description="suggests a move to make in given position",
+                 invalidMessage="Please input a valid emoji or FEN chess position after the /hint command.")
+commandTable.add("remind", remind_command, argument=TEXT_ARGUMENT,
+                 usage="[hours or off]", description="reminds this chat when no new position has been decoded for given hours",
+                 invalidMessage=f"Please input a number of hours (up to {MAX_HOURS}) after the /remind command, or off to stop reminders.")
+commandTable.add("edit", board_editor, aliases=["create"], argument=POSITION_ARGUMENT, session=True,
+                 usage="[emojiString or fen]", description="sends lichess link to edit a given position freely",
+                 invalidMessage="Invalid position, please enter a valid emoji or FEN chess position or no arguments for starting position.")
+commandTable.add("enpassant", enpassant_command, hidden=True)
+commandTable.add("commands", commands_command, aliases=["help"], description="what you just used!")
+
+@lru_cache(maxsize=1)
+def help_text():
+    '''Returns /commands help text, generated from command table.'''
+    sessionCommands = [f'/{command.name}' for command in commandTable.commands if command.session and not command.hidden]
+
+    footer = "\n\n"
+    footer += f'n.b. if enabled for this bot, the position of the game in this chat is remembered, so {", ".join(sessionCommands[:-1])} & {sessionCommands[-1]} can be used without passing a position'
+    footer += "\n\n"
+    footer += "Inline mode: type @CovertChessBot followed by a fen or emojiString in any chat to encode / decode / resign in place (add message=message to a fen to mix it in to a message)"
+    footer += "\n\n"
+    footer += "n.b. required / optional parameters are shown inside () or [] style brackets, but these are not necessary when actually inputting a command"
+
+    return commandTable.helpText(header="The commands available in this bot are:\n\n", footer=footer)
+
+# instrumented callback of each command, by primary name, created when handlers are added
+commandCallbacks = {}
+
+def dispatch_command(update, context):
+    '''Run handler of the command in a message, with its argument parsed & checked once for every command.'''
+    parsed = command_table.parseCommand(update.message.text)
+
+    # passed Filters.command (e.g. a bot_command entity telegram found), but isn't a /name command
+    if parsed == None:
+        return
+
+    name, username, argument = parsed
+
+    # commands addressed to another bot in a group chat
+    if username != None and context.bot.username != None and username.lower() != context.bot.username.lower():
+        return
+
+    command = commandTable.lookup(name)
+    if command == None:
+        commandCallbacks["unknown"](update, context)
+        return
+
+    # no argument, fall back on current position of this chat's game
+    if argument == "" and command.session:
+        argument = session_encoding(update)
+
+    try:
+        fen = command.checkArgument(argument)
+    except ValueError:
+        # a missing argument is a mistake by the user rather than a failure
+        if argument != "":
+            metrics.handlerErrors.inc(command.name)
+        metrics.updates.inc(command.name)
+        reply(update, command.invalidMessage)
+        return
+
+    # handlers read argument from context, rather than splitting message text again
+    context.command = command
+    context.argument = argument
+    context.fen = fen
+
+    try:
+        commandCallbacks[command.name](update, context)
+    # e.g. a position which passed checks but still couldn't be handled
+    except Exception:
+        logger.exception("/%s failed", command.name)
+        reply(update, command.invalidMessage)
+
+def add_handlers(dispatcher):
+    '''Register all of the bot's handlers with a dispatcher.'''
+    # every command is instrumented under its primary name, so aliases are counted together
+    for command in commandTable.commands:
+        commandCallbacks[command.name] = instrumented(command.name, command.callback)
+    commandCallbacks["unknown"] = instrumented("unknown", unknown)
+
+    # every command (including unknown ones) goes through one handler, which looks it up in the command table
+    dispatcher.add_handler(MessageHandler(Filters.command & Filters.update.message, dispatch_command))
+
+    # inline queries, i.e. @CovertChessBot (position) typed in any chat
+    dispatcher.add_handler(InlineQueryHandler(instrumented("inline", inline_query)))
+
+    # echos a single emoji message back to userr
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, instrumented("emoji_info", emoji_info)))
+
+def memory_soft_limit():
+    '''Returns soft memory limit in bytes from credentials.py, None if there is no limit.'''
+    # (memory_soft_limit may not be set in credentials.py files made before it was added)
+    megabytes = getattr(credentials, "memory_soft_limit", None)
+
+    return int(megabytes * 1024 * 1024) if megabytes else None
+
+def start_shadow():
+    '''Turn on shadow mode if shadow_sample_rate is set in credentials.py, checking faster codec paths against the reference codec.'''
+    # (shadow_sample_rate may not be set in credentials.py files made before it was added)
+    sampleRate = getattr(credentials, "shadow_sample_rate", None)
+    if sampleRate:
+        shadow.start(sampleRate, getattr(credentials, "shadow_mismatch_file", None))
+
+def track_memory(monitor):
+    '''Account for the memory held by each of the bot's tables, caches & queues, shrinking caches when short of memory.'''
+    # stores & queues of every bot being served
+    if tenants != None:
+        sessionStores = lambda: [tenant.sessions for tenant in tenants.tenants if tenant.sessions != None]
+        sendQueues = lambda: [tenant.sendQueue for tenant in tenants.tenants]
+    else:
+        sessionStores = lambda: [sessions] if sessions != None else []
+        sendQueues = lambda: [sendQueue] if sendQueue != None else []
+
+    # memory mapped files, shared between processes & paged in as used
+    # (opening index is None until first used, False if it hasn't been built)
+    monitor.track("emoji_table", lambda: len(covert_chess.emojiTable.map))
+    monitor.track("opening_index", lambda: len(openings.index.map) if openings.index else 0)
+
+    # only held while the emoji tables are being built
+    monitor.track("emoji_importer", lambda: memory.deepSize((emoji_importer.importedEmoji, emoji_importer.importedLessQualifiedEmoji)))
+    monitor.track("board_sprites", lambda: memory.deepSize((board_image.background, board_image.spriteAtlas)))
+
+    # caches, all shrunk when over the soft limit
+    monitor.track("board_images", lambda: memory.lruCacheSize(board_image.renderPlacement), board_image.renderPlacement.cache_clear)
+    monitor.track("board_file_ids", lambda: memory.deepSize(boardFileIds.fileIds), boardFileIds.shrink)
+    monitor.track("partial_positions", lambda: memory.deepSize([(decoder.indexes, decoder.indexChunks, decoder.automaton.pending)
+                                                                 for decoder, used in list(partialPositions.decoders.values())]),
+                  partialPositions.shrink)
+    monitor.track("inline_results", lambda: memory.lruCacheSize(inline_results), inline_results.cache_clear)
+    monitor.track("sessions", lambda: sum(memory.deepSize(store.cache) for store in sessionStores()),
+                  lambda: [store.shrink() for store in sessionStores()])
+
+    # work in flight
+    monitor.track("send_queue", lambda: sum(memory.deepSize(queue.chats) for queue in sendQueues()))
+    monitor.track("reminders", lambda: memory.deepSize((reminders.hours, reminders.due, reminders.positions, reminders.wheel.levels)) if reminders != None else 0)
+    monitor.track("log_queue", lambda: memory.deepSize(log_pipeline.queueHandler.queue.queue) if log_pipeline.queueHandler != None else 0)
+
+def serve_tenants(botTokens):
+    '''Serve every bot in bot_tokens from this process, until SIGINT / SIGTERM is received.'''
+    global tenants, hints, profiler, reminders
+    tenants = TenantRunner(botTokens,
+                           sessionsDatabase=getattr(credentials, "sessions_database", None),
+                           webhookPort=credentials.webhook_port if credentials.webhook_active else None,
+                           webhookUrl=credentials.webhook_url if credentials.webhook_active else None)
+
+    # one set of reminders for every bot, each sent by the bot the chat asked
+    remindersDatabase = getattr(credentials, "reminders_database", None)
+    if remindersDatabase:
+        reminders = ReminderStore(remindersDatabase, send_reminders)
+
+    # one pool of hint processes for every bot
+    hints = engine.HintPool(processes=getattr(credentials, "hint_processes", None) or 1,
+                            seconds=getattr(credentials, "hint_seconds", None) or engine.DEFAULT_SECONDS)
+
+    # profiler must exist before handlers are registered, so they are wrapped by it
+    profileDirectory = getattr(credentials, "profile_directory", None)
+    if profileDirectory:
+        profiler = SlowRequestProfiler(profileDirectory, threshold=getattr(credentials, "profile_threshold", 1.0))
+
+    add_handlers(tenants.dispatcher)
+
+    metricsPort = getattr(credentials, "metrics_port", None)
+    if metricsPort:
+        metrics.startServer(metricsPort)
+
+    track_memory(memory.startMonitor(memory_soft_limit()))
+
+    start_shadow()
+
+    tenants.serve()
+
+    if reminders != None:
+        reminders.close()
+
+    hints.shutdown()
+
+    # finish comparing codec calls already sampled
+    shadow.stop()
 
 def main():
     '''Start bot.'''
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(credentials.bot_token)
+    # Enable logging, formatted & written on a background thread so handlers never wait on it
+    # (log_* may not be set in credentials.py files made before they were added)
+    log_pipeline.startLogging(level=getattr(credentials, "log_level", None) or logging.INFO,
+                              jsonOutput=getattr(credentials, "log_json", None) or False,
+                              sampleRates=getattr(credentials, "log_sample_rates", None),
+                              queueSize=getattr(credentials, "log_queue_size", None))
+
+    # optionally serve several bots from this one process, sharing its tables & caches
+    # (bot_tokens may not be set in credentials.py files made before it was added)
+    botTokens = getattr(credentials, "bot_tokens", None)
+    if botTokens:
+        serve_tenants(botTokens)
+        return
+
+    # optionally handle webhook updates in several processes, to use every core
+    # (webhook_workers may not be set in credentials.py files made before it was added)
+    webhookWorkers = getattr(credentials, "webhook_workers", None)
+    if credentials.webhook_active and webhookWorkers and webhookWorkers > 1:
+        WebhookWorkerPool(credentials.bot_token,
+                          port=credentials.webhook_port,
+                          workers=webhookWorkers,
+                          webhookUrl=credentials.webhook_url + credentials.bot_token,
+                          metricsPort=getattr(credentials, "metrics_port", None),
+                          sessionsDatabase=getattr(credentials, "sessions_database", None),
+                          profileDirectory=getattr(credentials, "profile_directory", None),
+                          profileThreshold=getattr(credentials, "profile_threshold", 1.0),
+                          hintProcesses=getattr(credentials, "hint_processes", None),
+                          hintSeconds=getattr(credentials, "hint_seconds", None),
+                          remindersDatabase=getattr(credentials, "reminders_database", None),
+                          memorySoftLimit=memory_soft_limit(),
+                          shadowSampleRate=getattr(credentials, "shadow_sample_rate", None),
+                          shadowMismatchFile=getattr(credentials, "shadow_mismatch_file", None)).serve()
+        return
+
+    # number of threads the dispatcher uses to run handlers
+    workers = 4
+
+    # Create the Bot, with a request object which records latency of every Bot API call
+    # & reuses its keep-alive connections, with enough for every thread making calls
+    # (bot_api_connections may not be set in credentials.py files made before it was added)
+    connections = getattr(credentials, "bot_api_connections", None) or connectionPoolSize(workers)
+    bot = Bot(credentials.bot_token, request=MeteredRequest(con_pool_size=connections))
+
+    # Create the Updater and pass it your bot.
+    updater = Updater(bot=bot, workers=workers)
+
+    # all replies are sent through a queue which keeps within telegram's rate limits
+    # (handlers are held back when too many replies are waiting to be sent)
+    global sendQueue
+    sendQueue = SendQueue(bot)
+
+    # optionally remember current position of each chat's game
+    # (sessions_database may not be set in credentials.py files made before it was added)
+    global sessions
+    sessionsDatabase = getattr(credentials, "sessions_database", None)
+    if sessionsDatabase:
+        sessions = SessionStore(sessionsDatabase)
+
+    # optionally send move reminders to chats which ask for them
+    # (reminders_database may not be set in credentials.py files made before it was added)
+    global reminders
+    remindersDatabase = getattr(credentials, "reminders_database", None)
+    if remindersDatabase:
+        reminders = ReminderStore(remindersDatabase, send_reminders)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
-    # on different commands - answer in Telegram
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("commands", commands_command))
-    dispatcher.add_handler(CommandHandler("help", commands_command)) # alias
-    dispatcher.add_handler(CommandHandler("startgame", startgame_command))
-    dispatcher.add_handler(CommandHandler("newgame", startgame_command)) # alias
-    dispatcher.add_handler(CommandHandler("encode", encode_command))
-    dispatcher.add_handler(CommandHandler("encrypt", encode_command)) # alias
-    dispatcher.add_handler(CommandHandler("decode", decode_command))
-    dispatcher.add_handler(CommandHandler("decrypt", decode_command)) # alias
-    dispatcher.add_handler(CommandHandler("mix", mix_command))
-    dispatcher.add_handler(CommandHandler("extract", extract_command))
-    dispatcher.add_handler(CommandHandler("unmix", extract_command)) # alias
-    dispatcher.add_handler(CommandHandler("move", analysis_board))
-    dispatcher.add_handler(CommandHandler("show", analysis_board)) # alias
-    dispatcher.add_handler(CommandHandler("edit", board_editor))
-    dispatcher.add_handler(CommandHandler("create", board_editor)) # alias
-    dispatcher.add_handler(CommandHandler("enpassant", enpassant_command))
-    dispatcher.add_handler(CommandHandler("resign", resign_command))
-    dispatcher.add_handler(CommandHandler("giveup", resign_command)) # alias
-
-    # default handler for a command that has not been defined
-    dispatcher.add_handler(MessageHandler(Filters.command, unknown))
+    # optionally keep flamegraph profiles of slow updates
+    # (profile_directory may not be set in credentials.py files made before it was added)
+    global profiler
+    profileDirectory = getattr(credentials, "profile_directory", None)
+    if profileDirectory:
+        profiler = SlowRequestProfiler(profileDirectory, threshold=getattr(credentials, "profile_threshold", 1.0))
 
-    # echos a single emoji message back to userr
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, emoji_info))
+    # hints are searched for in worker processes, each search limited to hint_seconds of CPU time
+    # (hint_processes & hint_seconds may not be set in credentials.py files made before they were added)
+    global hints
+    hints = engine.HintPool(processes=getattr(credentials, "hint_processes", None) or 1,
+                            seconds=getattr(credentials, "hint_seconds", None) or engine.DEFAULT_SECONDS)
+
+    # register every command & message handler
+    add_handlers(dispatcher)
+
+    # optionally serve metrics locally in prometheus format
+    # (metrics_port may not be set in credentials.py files made before it was added)
+    metricsPort = getattr(credentials, "metrics_port", None)
+    if metricsPort:
+        metrics.dispatcherQueueDepth.setFunction(dispatcher.update_queue.qsize)
+        metrics.startServer(metricsPort)
+
+    # sample memory use in to the metrics, optionally shrinking caches when over memory_soft_limit
+    track_memory(memory.startMonitor(memory_soft_limit()))
+
+    # optionally check a sample of faster codec paths against the reference codec
+    start_shadow()
 
     # using a webhook is usually preferred for final deployment
     # but can also be deployed using polling if a webhook can not be set up
@@ -411,9 +1140,21 @@ def main():
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
+    # stop sending reminders, and write any changed since they were last written
+    if reminders != None:
+        reminders.close()
+
+    # send any replies still queued before exiting
+    sendQueue.join(timeout=10)
+    sendQueue.stop()
+
+    # write any sessions changed since they were last written
+    if sessions != None:
+        sessions.close()
+
+    hints.shutdown()
+
+    # finish comparing codec calls already sampled
+    shadow.stop()
 
 logger = logging.getLogger(__name__)
\ No newline at end of file
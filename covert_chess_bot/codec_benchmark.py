@@ -0,0 +1,168 @@
+# ------------------------------------------------------------------------------
+# Codec Benchmark
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Measures how the codec's throughput scales with the number of threads calling
+# it at once, from 1 thread up to N.
+#
+# Every table the codec reads is set up once (the emoji table is memory mapped
+# read only when covert_chess is imported, and the importer's emoji lists are
+# set once under a lock), so encode & decode can be called from any number of
+# threads. On a standard interpreter the GIL lets one thread run python code
+# at a time, so throughput should stay flat as threads are added. On a free
+# threaded build (python3.13t or later) threads run in parallel, so it should
+# go up with the number of cores.
+#
+# Each thread checks every result it gets against the result worked out
+# beforehand by a single thread, so any result corrupted by running threads at
+# once is counted as a mismatch.
+#
+# usage (from the root folder of this repository, with either interpreter):
+#   python3 -m covert_chess_bot.codec_benchmark [--threads N] [--seconds S]
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import sys
+import sysconfig
+import threading
+import time
+from covert_chess_bot import covert_chess
+
+# positions encoded & decoded, the same as the load test's
+positionsFileLocation = "data/positions.txt"
+
+def interpreterInfo():
+    '''
+    Returns description of this interpreter, and whether its threads can run python code in parallel.
+    '''
+    freeThreadedBuild = bool(sysconfig.get_config_var("Py_GIL_DISABLED"))
+    # the GIL can be turned back on in a free threaded build (e.g. PYTHON_GIL=1, or by an extension needing it)
+    gilEnabled = sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True
+
+    build = "free threaded" if freeThreadedBuild else "standard"
+    gil = "enabled" if gilEnabled else "disabled"
+
+    return f"python {sys.version.split()[0]} ({build} build, GIL {gil})"
+
+def availableCpus():
+    '''
+    Returns number of cpus this process can run on.
+    '''
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+def threadCounts(maxThreads):
+    '''
+    Returns thread counts to measure, doubling from 1 up to (and including) maxThreads.
+    '''
+    counts = []
+    count = 1
+    while count < maxThreads:
+        counts.append(count)
+        count *= 2
+
+    return counts + [maxThreads]
+
+def loadCases():
+    '''
+    Returns dict of operation -> list of (input, expected output) each thread cycles through.
+    '''
+    with open(positionsFileLocation, "r", encoding="utf8") as positionsFile:
+        fens = [line.strip() for line in positionsFile if line.strip() != ""]
+
+    cases = {"encode": [], "decode": []}
+    for fen in fens:
+        for scheme in (covert_chess.DENSE_SCHEME, covert_chess.ORIGINAL_SCHEME):
+            encoding = covert_chess.encode(fen, scheme)
+            cases["encode"].append(((fen, scheme), encoding))
+            cases["decode"].append(((encoding,), covert_chess.decode(encoding)))
+
+    return cases
+
+operations = {
+    "encode": covert_chess.encode,
+    "decode": covert_chess.decode,
+}
+
+def measure(operation, cases, threads, seconds):
+    '''
+    Returns (operations per second, mismatched results) of given threads calling operation at once for given seconds.
+    '''
+    function = operations[operation]
+    # every thread starts together, once all of them have been created
+    barrier = threading.Barrier(threads + 1)
+    stop = threading.Event()
+    done = [0] * threads
+    mismatches = [0] * threads
+
+    def run(thread):
+        # threads start at different cases, so they aren't all working on the same one
+        i = thread * len(cases) // threads
+        count = 0
+        wrong = 0
+
+        barrier.wait()
+        while not stop.is_set():
+            arguments, expected = cases[i % len(cases)]
+            if function(*arguments) != expected:
+                wrong += 1
+            i += 1
+            count += 1
+
+        done[thread] = count
+        mismatches[thread] = wrong
+
+    workers = [threading.Thread(target=run, args=(thread,), daemon=True) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    return sum(done) / elapsed, sum(mismatches)
+
+def benchmark(maxThreads = None, seconds = 2.0):
+    '''
+    Measure encode & decode throughput from 1 to maxThreads threads (default the number of cpus), printing the results.
+    Returns total mismatched results, which should be 0.
+    '''
+    maxThreads = maxThreads or availableCpus()
+    cases = loadCases()
+
+    print(interpreterInfo())
+    print(f"{availableCpus()} cpus available, {len(cases['encode'])} cases per operation, {seconds:g} seconds per measurement")
+
+    totalMismatches = 0
+    for operation in operations:
+        print()
+        print(f"  {operation:<8} {'threads':>8} {'ops/s':>12} {'speedup':>9} {'efficiency':>11} {'mismatches':>11}")
+
+        single = None
+        for threads in threadCounts(maxThreads):
+            rate, mismatches = measure(operation, cases[operation], threads, seconds)
+            totalMismatches += mismatches
+            single = single or rate
+
+            print(f"  {'':<8} {threads:>8} {rate:>12.0f} {rate / single:>8.2f}x {rate / single / threads:>10.0%} {mismatches:>11}")
+
+    return totalMismatches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how codec throughput scales with threads.")
+    parser.add_argument("--threads", type=int, default=None, help="most threads to measure (default the number of cpus)")
+    parser.add_argument("--seconds", type=float, default=2.0, help="seconds to run each measurement for")
+    arguments = parser.parse_args()
+
+    # any mismatch means the codec isn't safe to call from several threads at once
+    sys.exit(1 if benchmark(arguments.threads, arguments.seconds) else 0)
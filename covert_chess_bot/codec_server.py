@@ -0,0 +1,414 @@
+# ------------------------------------------------------------------------------
+# Codec Server
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Standalone HTTP server exposing the covert chess codec as JSON, for services
+# which want encodings without importing this package (and loading its emoji
+# tables) or going through telegram. It doesn't need a bot token, telegram or
+# credentials.py:
+#   python3 -m covert_chess_bot.codec_server [--port 8080] [--listen 127.0.0.1] [--metrics-port N]
+#                                            [--shadow-rate 0.01 --shadow-file shadow.jsonl]
+#
+# Every endpoint takes a POST of a JSON object & replies with a JSON object:
+#   /encode    {"fen": ..., "scheme": "dense" or "original" (optional)} -> {"emoji": ...}
+#   /decode    {"emoji": ... (may be mixed in to text)} -> {"fen": 1st position, "positions": [every position]}
+#   /mix       {"position": emoji or fen, "message": ...} -> {"mixed": ...}
+#   /unmix     {"message": ...} -> {"emoji": ...}
+#   /validate  {"fen": ...} or {"emoji": ...} -> {"valid": true / false, "reason": why not}
+# Failures reply 400 (or 404 for an unknown path) with {"error": ...}.
+#
+#   /batch     {"requests": [{"op": "encode", "fen": ...}, ...]} -> {"results": [...]}
+# runs many operations in one request, each result being what its endpoint
+# would reply, or {"error": ...} if it failed (without failing the others).
+# Requests can also be sent as NDJSON (one operation per line). With
+# "Accept: application/x-ndjson" (or ?stream=1) results are streamed back as
+# NDJSON, each line written as soon as it is ready, so large batches needn't be
+# held in memory on either side.
+#
+# Connections are kept alive (HTTP/1.1), so a client sending many requests pays
+# for one TCP handshake. GET /health replies {"ok": true}.
+#
+# Running with --benchmark compares throughput of the in-process functions with
+# single requests (with & without keep-alive), batches & streamed batches.
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from covert_chess_bot import covert_chess, framing, metrics, shadow
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8080
+
+# largest request body accepted, in bytes
+MAX_BODY = 8 * 1024 * 1024
+
+# most operations in one batch
+MAX_BATCH = 10000
+
+NDJSON = "application/x-ndjson"
+
+# FEN positions requests are made from when benchmarking
+BENCHMARK_POSITIONS = "data/positions.txt"
+
+codecServerRequests = metrics.Counter("covert_chess_codec_server_requests_total", "Codec server requests, by endpoint & status.", ["endpoint", "status"])
+
+codecServerOperations = metrics.Counter("covert_chess_codec_server_operations_total", "Codec operations run by the codec server (including each of a batch), by operation & result.", ["operation", "result"])
+
+class CodecError(ValueError):
+    '''
+    Request which can't be carried out, replied to with its message.
+    '''
+
+def field(request, name):
+    '''
+    Returns string field of a request, raises CodecError if it is missing.
+    '''
+    value = request.get(name)
+    if not isinstance(value, str):
+        raise CodecError(f'"{name}" must be given as a string')
+
+    return value
+
+def encodeOperation(request):
+    fen = field(request, "fen")
+    scheme = request.get("scheme", covert_chess.DEFAULT_SCHEME)
+
+    if scheme not in (covert_chess.ORIGINAL_SCHEME, covert_chess.DENSE_SCHEME):
+        raise CodecError(f'"scheme" must be "{covert_chess.ORIGINAL_SCHEME}" or "{covert_chess.DENSE_SCHEME}"')
+    if not covert_chess.isValidFen(fen):
+        raise CodecError("invalid FEN position")
+
+    return {"emoji": covert_chess.encode(fen, scheme)}
+
+def decodeOperation(request):
+    # every position, ignoring any other emoji around them
+    positions = framing.readPositions(field(request, "emoji"))
+    if len(positions) == 0:
+        raise CodecError("no valid emoji position")
+
+    return {"fen": positions[0]["fen"], "positions": positions}
+
+def mixOperation(request):
+    position = field(request, "position")
+    message = field(request, "message")
+
+    # emoji are never ascii, so an ascii position can only be a FEN position
+    if position.isascii():
+        if not covert_chess.isValidFen(position):
+            raise CodecError("invalid FEN position")
+        position = covert_chess.encode(position)
+
+    return {"mixed": covert_chess.mix(position, message)}
+
+def unmixOperation(request):
+    return {"emoji": covert_chess.unmix(field(request, "message"))}
+
+def validateOperation(request):
+    if "fen" in request:
+        fen = field(request, "fen")
+        if not covert_chess.isValidFen(fen):
+            return {"valid": False, "reason": "not a complete FEN position"}
+        return {"valid": True}
+
+    if len(framing.readPositions(field(request, "emoji"))) == 0:
+        return {"valid": False, "reason": "no valid emoji position"}
+
+    return {"valid": True}
+
+# operation name -> function taking request dict & returning result dict
+operations = {
+    "encode": encodeOperation,
+    "decode": decodeOperation,
+    "mix": mixOperation,
+    "unmix": unmixOperation,
+    "validate": validateOperation,
+}
+
+def runOperation(name, request):
+    '''
+    Returns result of named operation, raises CodecError if it fails.
+    '''
+    operation = operations.get(name)
+    if operation == None:
+        raise CodecError(f'unknown operation "{name}"')
+    if not isinstance(request, dict):
+        raise CodecError("request must be a JSON object")
+
+    try:
+        result = operation(request)
+    except CodecError:
+        codecServerOperations.inc(name, "error")
+        raise
+    # e.g. an emoji which isn't in the emoji tables
+    except (ValueError, KeyError, IndexError) as error:
+        codecServerOperations.inc(name, "error")
+        raise CodecError(str(error))
+
+    codecServerOperations.inc(name, "ok")
+    return result
+
+def batchResult(request):
+    '''
+    Returns result (or error) of one operation of a batch.
+    '''
+    try:
+        if not isinstance(request, dict):
+            raise CodecError("request must be a JSON object")
+        return runOperation(request.get("op"), request)
+    except CodecError as error:
+        return {"error": str(error)}
+
+class CodecRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Answers codec requests, keeping connections alive between them.
+    '''
+
+    protocol_version = "HTTP/1.1"
+
+    # headers & body are written separately, which on a kept alive connection
+    # would otherwise wait on the client's delayed ACK (~40 ms) every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/health":
+            self.respond(200, {"ok": True}, "health")
+        else:
+            self.respond(404, {"error": "not found"}, "unknown")
+
+    def do_POST(self):
+        path, query = urlsplit(self.path)[2:4]
+        endpoint = path.strip("/")
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_BODY:
+            # body isn't read, so connection can't be reused
+            self.close_connection = True
+            self.respond(413, {"error": f"request body over {MAX_BODY} bytes"}, endpoint)
+            return
+        body = self.rfile.read(length)
+
+        if endpoint != "batch" and endpoint not in operations:
+            self.respond(404, {"error": "not found"}, "unknown")
+            return
+
+        try:
+            if endpoint == "batch":
+                requests = self.batchRequests(body)
+            else:
+                request = json.loads(body)
+        except (ValueError, CodecError) as error:
+            self.respond(400, {"error": f"invalid request: {error}"}, endpoint)
+            return
+
+        if endpoint != "batch":
+            try:
+                self.respond(200, runOperation(endpoint, request), endpoint)
+            except CodecError as error:
+                self.respond(400, {"error": str(error)}, endpoint)
+            return
+
+        if NDJSON in self.headers.get("Accept", "") or dict(parse_qsl(query)).get("stream") == "1":
+            self.streamBatch(requests)
+        else:
+            self.respond(200, {"results": [batchResult(request) for request in requests]}, endpoint)
+
+    def batchRequests(self, body):
+        '''
+        Returns list of operations in a batch request body, either a JSON object or NDJSON.
+        '''
+        if self.headers.get("Content-Type", "").startswith(NDJSON):
+            requests = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            batch = json.loads(body)
+            requests = batch.get("requests") if isinstance(batch, dict) else None
+            if not isinstance(requests, list):
+                raise CodecError('"requests" must be a list')
+
+        if len(requests) > MAX_BATCH:
+            raise CodecError(f"more than {MAX_BATCH} requests in batch")
+
+        return requests
+
+    def streamBatch(self, requests):
+        '''
+        Reply with result of each operation of a batch as a line of NDJSON, sent as soon as it is ready.
+        '''
+        self.send_response(200)
+        self.send_header("Content-Type", NDJSON)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for request in requests:
+            line = json.dumps(batchResult(request), ensure_ascii=False).encode("utf8") + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+
+        # last chunk
+        self.wfile.write(b"0\r\n\r\n")
+        codecServerRequests.inc("batch", 200)
+
+    def respond(self, status, result, endpoint):
+        body = json.dumps(result, ensure_ascii=False).encode("utf8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        codecServerRequests.inc(endpoint, status)
+
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.address_string(), *args)
+
+class CodecServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # many clients connecting at once shouldn't be turned away
+    request_queue_size = 128
+
+def serve(port = DEFAULT_PORT, listen = "127.0.0.1"):
+    '''
+    Start serving codec requests on a background thread, returns server.
+    '''
+    server = CodecServer((listen, port), CodecRequestHandler)
+    threading.Thread(target=server.serve_forever, name="codec-server", daemon=True).start()
+
+    logger.info("codec server listening on %s:%d", listen, server.server_address[1])
+
+    return server
+
+def benchmark(seconds = 2.0, threads = 4, batchSize = 100):
+    '''
+    Compare encode & decode throughput of the in-process functions against the
+    server, with single requests (new connection each, & kept alive), batches &
+    streamed batches, printing the results.
+    '''
+    import http.client
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+
+    # same positions as the bot's load test (which isn't imported, as it needs the bot & telegram)
+    with open(BENCHMARK_POSITIONS, "r", encoding="utf8") as positionsFile:
+        fens = [line.strip() for line in positionsFile if line.strip() != ""]
+    encodings = {fen: covert_chess.encode(fen) for fen in fens}
+
+    server = serve(0)
+    port = server.server_address[1]
+
+    def measure(name, unit, work):
+        '''
+        Run work (returning operations done) on every thread for given seconds, printing operations per second.
+        '''
+        def run(thread):
+            state = {}
+            done = 0
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                done += work(state)
+            if "connection" in state:
+                state["connection"].close()
+            return done
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            done = sum(executor.map(run, range(threads)))
+        elapsed = time.perf_counter() - start
+
+        print(f"  {name:<40} {done / elapsed:>10.0f} {unit}/s")
+
+    def randomRequest():
+        fen = random.choice(fens)
+        if random.random() < 0.5:
+            return {"op": "encode", "fen": fen}
+        return {"op": "decode", "emoji": encodings[fen]}
+
+    def inProcess(state):
+        request = randomRequest()
+        runOperation(request["op"], request)
+        return 1
+
+    def post(state, path, body, headers, keepAlive = True):
+        connection = state.get("connection")
+        if connection == None or not keepAlive:
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            state["connection"] = connection
+        headers = dict(headers, Connection="keep-alive" if keepAlive else "close")
+        connection.request("POST", path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path} replied {response.status}: {data[:200]}")
+        return data
+
+    def single(keepAlive):
+        def work(state):
+            request = randomRequest()
+            post(state, "/" + request.pop("op"), json.dumps(request), {"Content-Type": "application/json"}, keepAlive)
+            return 1
+        return work
+
+    def batch(stream):
+        def work(state):
+            body = json.dumps({"requests": [randomRequest() for i in range(batchSize)]})
+            headers = {"Content-Type": "application/json"}
+            if stream:
+                headers["Accept"] = NDJSON
+            post(state, "/batch", body, headers)
+            return batchSize
+        return work
+
+    print(f"random encode / decode operations, {threads} client threads, {seconds:.0f} s each\n")
+    measure("in process (no HTTP)", "ops", inProcess)
+    measure("single requests, new connection each", "ops", single(False))
+    measure("single requests, kept alive", "ops", single(True))
+    measure(f"batches of {batchSize}", "ops", batch(False))
+    measure(f"streamed NDJSON batches of {batchSize}", "ops", batch(True))
+
+    server.shutdown()
+    server.server_close()
+
+if __name__ == "__main__":
+    import argparse
+    from covert_chess_bot import log_pipeline
+
+    parser = argparse.ArgumentParser(description="Serve the covert chess codec over HTTP as JSON.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--listen", default="127.0.0.1", help="address to listen on (0.0.0.0 for every interface)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="port to serve prometheus metrics on")
+    parser.add_argument("--shadow-rate", type=float, default=None, help="fraction of calls to faster codec paths checked against the reference codec (see shadow.py)")
+    parser.add_argument("--shadow-file", default=None, help="file to write shadow mode mismatches to")
+    parser.add_argument("--benchmark", action="store_true", help="compare throughput of the server & in-process functions, then exit")
+    parser.add_argument("--threads", type=int, default=4, help="client threads when benchmarking")
+    parser.add_argument("--seconds", type=float, default=2.0, help="seconds to run each benchmark for")
+    arguments = parser.parse_args()
+
+    if arguments.benchmark:
+        benchmark(arguments.seconds, arguments.threads)
+    else:
+        log_pipeline.startLogging()
+
+        if arguments.metrics_port:
+            metrics.startServer(arguments.metrics_port)
+
+        if arguments.shadow_rate:
+            shadow.start(arguments.shadow_rate, arguments.shadow_file)
+
+        server = serve(arguments.port, arguments.listen)
+
+        # until Ctrl-C
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+        server.shutdown()
+
+        # finish comparing codec calls already sampled
+        shadow.stop()
@@ -0,0 +1,164 @@
+# ------------------------------------------------------------------------------
+# Command Table
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Declarative table of the bot's commands. Each command is described once:
+# its name & aliases, the handler callback, what kind of argument it takes, and
+# its line of /commands help text.
+#
+# Every name & alias maps to its command in a single dict, so a command message
+# is dispatched with one lookup, rather than being tested against a handler per
+# command in turn. The argument is split from the command once, and checked the
+# same way for every command taking the same kind of argument, before the
+# handler is called, so handlers only deal with arguments already known to be
+# usable.
+# ------------------------------------------------------------------------------
+
+import re
+from covert_chess_bot import covert_chess, framing
+
+# kinds of argument a command can take
+NO_ARGUMENT = None
+# any text
+TEXT_ARGUMENT = "text"
+# a FEN position
+FEN_ARGUMENT = "fen"
+# an emoji position (possibly mixed in to a message)
+EMOJI_ARGUMENT = "emoji"
+# an emoji (possibly mixed in to a message) or FEN position
+POSITION_ARGUMENT = "position"
+
+# "/name", "/name@botusername", then the argument (which may span several lines)
+commandPattern = re.compile(r"/(\w+)(?:@(\w+))?(?:\s+(.*))?", re.DOTALL)
+
+def parseCommand(text):
+    '''
+    Returns (command name (lower case), bot username or None, argument) of a command message, None if it isn't a command.
+    '''
+    match = commandPattern.match(text or "")
+    if match == None:
+        return None
+
+    name, username, argument = match.groups()
+
+    return name.lower(), username, (argument or "").strip()
+
+def positionFen(argument, allowFen = True):
+    '''
+    Returns FEN of an emoji (possibly mixed in to a message, the first if there are several) or FEN position, raises ValueError if it isn't a valid position.
+    '''
+    # emoji are never ascii, so an ascii argument can only be a FEN position
+    if argument.isascii():
+        if not allowFen or not covert_chess.isValidFen(argument):
+            raise ValueError("invalid FEN position")
+        return argument
+
+    # first position in argument, ignoring any other emoji around it
+    positions = framing.readPositions(argument)
+    if len(positions) == 0:
+        raise ValueError("no valid emoji position")
+
+    return positions[0]["fen"]
+
+class Command:
+    '''
+    Description of one command, and how its argument is checked.
+    '''
+
+    def __init__(self, name, callback, aliases = (), argument = NO_ARGUMENT, required = False, session = False,
+                 usage = "", description = "", invalidMessage = None, hidden = False):
+        self.name = name
+        self.callback = callback
+        self.aliases = tuple(aliases)
+        # kind of argument taken, one of the *_ARGUMENT constants
+        self.argument = argument
+        # reply invalidMessage rather than call handler when there is no argument
+        self.required = required
+        # use chat's current position when there is no argument
+        self.session = session
+        # shown after command in help, e.g. "(fen)"
+        self.usage = usage
+        self.description = description
+        self.invalidMessage = invalidMessage or f'Please input a valid argument after the /{name} command.'
+        # not listed in help, e.g. /start
+        self.hidden = hidden
+
+    def checkArgument(self, argument):
+        '''
+        Returns FEN of argument if command takes a position (else None), raises ValueError if argument isn't valid.
+        '''
+        if argument == "":
+            if self.required:
+                raise ValueError("argument required")
+            return None
+
+        if self.argument == FEN_ARGUMENT:
+            if not covert_chess.isValidFen(argument):
+                raise ValueError("invalid FEN position")
+            return argument
+
+        if self.argument == EMOJI_ARGUMENT:
+            return positionFen(argument, allowFen=False)
+
+        if self.argument == POSITION_ARGUMENT:
+            return positionFen(argument)
+
+        return None
+
+    def helpLine(self):
+        '''
+        Returns line of help text describing command.
+        '''
+        if self.usage:
+            return f'/{self.name} {self.usage} - {self.description}'
+
+        return f'/{self.name} - {self.description}'
+
+class CommandTable:
+    '''
+    Every command, by name & alias.
+    '''
+
+    def __init__(self):
+        # in order added, the order they are listed in help
+        self.commands = []
+        # name or alias -> command
+        self.byName = {}
+
+    def add(self, name, callback, **kwargs):
+        '''
+        Add a command (see Command for options), returns it.
+        '''
+        command = Command(name, callback, **kwargs)
+
+        for commandName in (command.name,) + command.aliases:
+            if commandName in self.byName:
+                raise ValueError(f"/{commandName} is already a command")
+            self.byName[commandName] = command
+
+        self.commands.append(command)
+
+        return command
+
+    def lookup(self, name):
+        '''
+        Returns command with given name or alias, None if there is no such command.
+        '''
+        return self.byName.get(name.lower())
+
+    def names(self):
+        '''
+        Returns every name & alias commands can be used by.
+        '''
+        return list(self.byName)
+
+    def helpText(self, header = "", footer = ""):
+        '''
+        Returns help text listing every (non hidden) command, between header & footer.
+        '''
+        lines = [command.helpLine() for command in self.commands if not command.hidden]
+
+        return header + "\n\n".join(lines) + footer
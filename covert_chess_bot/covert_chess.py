@@ -10,6 +10,12 @@
 # Mixes emoji encoding in to given text block to steganographically hide the
 # chess position.
 #
+# Two encoding schemes exist, identified by the first emoji of a position:
+#   original - 25 emoji, 3 squares per emoji (docs/emoji-encoding-scheme.txt)
+#   dense    - whole position packed in to one big number, written in base
+#              3,178 (one emoji per digit), usually needing far fewer emoji
+# Positions are always decoded with the scheme they were encoded with.
+#
 # n.b. Given that the custom emoji encoding is based on FEN, a complete list of
 # moves is not stored. Therefore, threefold repitition can not be automatically
 # calculated. This allows for a more compact encoding, storing every move would
@@ -17,44 +23,143 @@
 # within a short message.
 # ------------------------------------------------------------------------------
 
-import emoji
-from covert_chess_bot import emoji_importer
+import re
+from math import comb
+from covert_chess_bot import emoji_table, metrics, shadow
 
-# import dictionary with info of all 3,178 fully qualified emoji from unicode's 12.1 standard
-emojiDict = emoji_importer.importEmoji()
+# all 3,178 fully qualified emoji from unicode's 12.1 standard, their info &
+# indexes, in a memory mapped file shared by every process (see emoji_table.py)
+# loaded once, as this module is imported, and read only after, so the codec
+# can be used from any number of threads at once without locking
+emojiTable = emoji_table.loadTable()
 
-# import all 3,178 fully qualified emoji from unicode's 12.1 standard 
-emojiList = emoji_importer.getEmoji()
+# all 3,178 fully qualified emoji from unicode's 12.1 standard
+emojiList = emojiTable.emoji
 
-# importing all 3,178 emojis from unicode's standard
+# all 3,178 emojis from unicode's standard
 # preferring less qualified emojis when they exist
 # needed for situations where an emoji library function returns less qualified
-# emoji with a fully qualified emoji as input 
-emojiListLessQualified = emoji_importer.getEmoji(lessQualified=True)
+# emoji with a fully qualified emoji as input
+emojiListLessQualified = emojiTable.lessQualified
+
+# shape of a complete FEN position, checked before doing any work on a FEN
+# pieces / next to move / castling rights / en passant square / half moves / full moves
+fenPattern = re.compile(r"([pnbrqkPNBRQK1-8]{1,8}/){7}[pnbrqkPNBRQK1-8]{1,8} [wb] (-|K?Q?k?q?) (-|[a-h][36]) \d{1,3} \d{1,4}")
+
+def isValidFen(fenPosition):
+    '''
+    Quickly checks if given string is a complete FEN position which can be encoded.
+    '''
+
+    # cheap check of overall shape first, rejects partially typed positions
+    if fenPattern.fullmatch(fenPosition) == None:
+        return False
+
+    # every rank must describe exactly 8 squares
+    for rank in fenPosition.split(" ", 1)[0].split("/"):
+        squares = 0
+        for char in rank:
+            if char in "12345678":
+                squares += int(char)
+            else:
+                squares += 1
+        if squares != 8:
+            return False
+
+    # empty castling rights would match pattern above, but are written as "-"
+    if fenPosition.split(" ")[2] == "":
+        return False
+
+    # half move clock can only go up to 100 (50 move rule)
+    if int(fenPosition.split(" ")[4]) > 100:
+        return False
+
+    return True
+
+# index of every emoji, in both fully and less qualified forms, so emoji can be
+# looked up without searching through the lists above
+# (fully qualified forms win if a form appears in both lists)
+emojiIndexes = emojiTable.indexes
+
+# most characters (code points) any one emoji is made up of
+longestEmoji = emojiTable.longest
 
 def emojiIndex(emoji):
     '''
     Returns index of given emoji
     '''
 
-    # try on both lists so that fully and minimally qualified emoji both return a correct index value
+    # both fully and minimally qualified emoji return a correct index value
     try:
-        index = emojiList.index(emoji)
-    except:
-        index = emojiListLessQualified.index(emoji)
-    
-    return index
+        return emojiIndexes[emoji]
+    except KeyError:
+        raise ValueError(f"{emoji} is not a known emoji")
+
+def findEmoji(text):
+    '''
+    Returns list of every known emoji in given text, in order, ignoring anything else.
+    '''
+
+    foundEmoji = []
+
+    i = 0
+    while i < len(text):
+        # longest match first, as many emoji start with a shorter emoji
+        # (e.g. skin tone & zwj sequences)
+        # (characters no emoji starts with have no lengths to try)
+        for length in range(min(emojiTable.longestStartingWith(text[i]), len(text) - i), 0, -1):
+            if text[i : i + length] in emojiIndexes:
+                foundEmoji.append(text[i : i + length])
+                i += length
+                break
+        # not the start of an emoji
+        else:
+            i += 1
+
+    return foundEmoji
 
 def emojiInfo(index):
     '''
     Returns the dictionary of info for emoji at a given index
     '''
-    return emojiDict[index]
+    return emojiTable.info(index)
+
+# encoding schemes
+ORIGINAL_SCHEME = "original"
+DENSE_SCHEME = "dense"
+
+# scheme used for new encodings, dense is opt-in as bots without it can't decode it
+DEFAULT_SCHEME = ORIGINAL_SCHEME
+
+# 1st emoji of original scheme positions, also encodes A8 square (index 2441-2453)
+originalSchemeFirstIndex = 2441
+
+# emoji in an original scheme position
+originalSchemeLength = 25
 
-def encode(fenPosition):
+# 1st emoji of dense scheme positions, index is this + number of digit emoji which follow
+denseSchemeFirstIndex = 2454
+
+# most digit emoji a dense position can have (any board with up to 9999 full moves fits, 32 pieces needs 19)
+denseSchemeMaxDigits = 24
+
+# resignation marker, optionally added after a position
+resignIndex = 2914
+
+@metrics.timed(metrics.codecSeconds, "encode")
+def encode(fenPosition, scheme = DEFAULT_SCHEME):
     '''
     Takes a chess position in FEN and returns emoji encoding of position.
     '''
+    if scheme == DENSE_SCHEME:
+        return encodeDense(fenPosition)
+
+    return encodeOriginal(fenPosition)
+
+def encodeOriginal(fenPosition):
+    '''
+    Takes a chess position in FEN and returns original (25 emoji) encoding of position.
+    '''
 
     def getSquareValues(fenPosition):
         pieceValues = {
@@ -224,10 +329,73 @@ def encode(fenPosition):
 
     return emojiPosition
 
+@metrics.timed(metrics.codecSeconds, "decode")
 def decode(emojiPosition):
     '''
     Takes a chess position in emoji and returns FEN encoding of position.
     '''
+    positionEmoji = findEmoji(emojiPosition)
+
+    if positionScheme(positionEmoji) == DENSE_SCHEME:
+        return decodeDense(positionEmoji)
+
+    return decodeOriginal(positionEmoji)
+
+def positionScheme(positionEmoji):
+    '''
+    Returns scheme a position (list of its emoji) was encoded with, identified by its 1st emoji.
+    '''
+    if len(positionEmoji) == 0:
+        raise ValueError("no emoji in position")
+
+    firstIndex = emojiIndex(positionEmoji[0])
+
+    if originalSchemeFirstIndex <= firstIndex < originalSchemeFirstIndex + 13:
+        return ORIGINAL_SCHEME
+
+    # only the few indexes reserved for dense headers, not every emoji above them (e.g. 🏳️)
+    if denseSchemeFirstIndex < firstIndex <= denseSchemeFirstIndex + denseSchemeMaxDigits and firstIndex != resignIndex:
+        return DENSE_SCHEME
+
+    raise ValueError(f"{positionEmoji[0]} does not start a known encoding scheme")
+
+def positionLength(positionEmoji):
+    '''
+    Returns number of emoji in a position (list of its emoji), not including any resignation marker.
+    '''
+    if positionScheme(positionEmoji) == DENSE_SCHEME:
+        return 1 + emojiIndex(positionEmoji[0]) - denseSchemeFirstIndex
+
+    return originalSchemeLength
+
+def isCompletePosition(emojiPosition):
+    '''
+    Checks if given emoji string contains every emoji of the position it starts.
+    '''
+    positionEmoji = findEmoji(emojiPosition)
+
+    try:
+        return len(positionEmoji) >= positionLength(positionEmoji)
+    except ValueError:
+        return False
+
+def isResigned(emojiPosition):
+    '''
+    Checks if given emoji position is followed by the resignation marker.
+    '''
+    positionEmoji = findEmoji(emojiPosition)
+
+    try:
+        length = positionLength(positionEmoji)
+    except ValueError:
+        return False
+
+    return len(positionEmoji) > length and emojiIndex(positionEmoji[length]) == resignIndex
+
+def decodeOriginal(positionEmoji):
+    '''
+    Takes list of emoji of an original (25 emoji) encoded position and returns FEN encoding of position.
+    '''
 
     def get1stSquareValue(emoji):
 
@@ -400,7 +568,11 @@ def decode(emojiPosition):
     
     def fullMovesFen(fullMoves):
         return str(fullMoves)
-    
+
+    # e.g. a position cut off part way through (see streaming.py to decode one arriving in pieces)
+    if len(positionEmoji) < originalSchemeLength:
+        raise ValueError("position is missing emoji")
+
     # initialise variable to store fen encoding of position
     fenPosition = ""
 
@@ -408,12 +580,12 @@ def decode(emojiPosition):
     squareValues = []
     
     # get 1st emoji and add its value to square values list
-    emoji1stSquare = emoji.emoji_lis(emojiPosition)[0]["emoji"]
+    emoji1stSquare = positionEmoji[0]
     squareValues.append(get1stSquareValue(emoji1stSquare))
 
     # get next 21 square emojis, adding their values to square values list
     for i in range(21):
-        emoji3Squares = emoji.emoji_lis(emojiPosition)[i+1]["emoji"]
+        emoji3Squares = positionEmoji[i+1]
         offset = i * 1111
         squareValues += get3SquareValues(emoji3Squares, offset)
 
@@ -423,7 +595,7 @@ def decode(emojiPosition):
     fenPosition += " "
     
     # get 23rd emoji and extract relevant values
-    emojiLegalMoves = emoji.emoji_lis(emojiPosition)[22]["emoji"]
+    emojiLegalMoves = positionEmoji[22]
     nextToMoveValue, castleRightsValues, enPassantValue = getLegalMoveValues(emojiLegalMoves)
 
     # set next to move in fen
@@ -443,8 +615,8 @@ def decode(emojiPosition):
 
     # get last 2 emoji and extract move values
     emojiMoves = []
-    emojiMoves.append(emoji.emoji_lis(emojiPosition)[23]["emoji"])
-    emojiMoves.append(emoji.emoji_lis(emojiPosition)[24]["emoji"])
+    emojiMoves.append(positionEmoji[23])
+    emojiMoves.append(positionEmoji[24])
     halfMoves, fullMoves = getMoveCounts(emojiMoves)
     
     # set half moves clock in fen
@@ -457,6 +629,167 @@ def decode(emojiPosition):
 
     return fenPosition
 
+# piece letters in order of their dense scheme value (0-11)
+densePieces = "PNBRQKpnbrqk"
+
+densePieceValues = {piece: value for value, piece in enumerate(densePieces)}
+
+# number of ways of choosing which k of 64 squares are occupied, by k
+occupancyCombinations = tuple(comb(64, k) for k in range(65))
+
+def referenceEncodeDense(fenPosition):
+    '''
+    Returns FEN of a position encoded & decoded again by the original scheme, to check encodeDense against in shadow mode.
+    '''
+    return decodeOriginal(findEmoji(encodeOriginal(fenPosition)))
+
+def denseRoundTrip(emojiPosition):
+    '''
+    Returns FEN of a dense encoded position, what referenceEncodeDense returns for the FEN it was encoded from.
+    '''
+    return decodeDense(findEmoji(emojiPosition))
+
+@shadow.shadowed("encode_dense", referenceEncodeDense, key=denseRoundTrip)
+def encodeDense(fenPosition):
+    '''
+    Takes a chess position in FEN and returns dense encoding of position.
+
+    Every part of the position is packed in to one number, in mixed radix
+    (least significant part first):
+        number of occupied squares (0-64)
+        which squares are occupied (index of combination of occupied squares)
+        piece on each occupied square (0-11 each)
+        next to move, castling rights & en passant square (0-2079, as original scheme)
+        half move clock (0-100)
+        full moves
+    That number is then written in base 3,178, one emoji per digit, after a 1st
+    emoji identifying this scheme and the number of digits.
+
+    Empty squares cost nothing, and the rarely large full move count is most
+    significant, so typical positions give a small number & few emoji.
+    '''
+    fields = fenPosition.split()
+    if len(fields) != 6:
+        raise ValueError("FEN position must have 6 fields")
+    board, nextToMove, castleRights, enPassant, halfMoves, fullMoves = fields
+
+    # squares numbered 0 (A8) to 63 (H1), the order pieces appear in FEN
+    occupiedSquares = []
+    pieces = []
+    square = 0
+    for char in board:
+        if char == "/":
+            continue
+        if char in "12345678":
+            square += int(char)
+        else:
+            occupiedSquares.append(square)
+            pieces.append(densePieceValues[char])
+            square += 1
+    if square != 64:
+        raise ValueError("FEN position must describe 64 squares")
+
+    # checked before packing, as a bad field would silently be packed as another value
+    if castleRights == "" or re.fullmatch("-|K?Q?k?q?", castleRights) == None:
+        raise ValueError("castling rights must be - or some of KQkq, in that order")
+    if re.fullmatch("-|[a-h][36]", enPassant) == None:
+        raise ValueError("en passant square must be - or a square on the 3rd or 6th rank")
+
+    halfMoves = int(halfMoves)
+    fullMoves = int(fullMoves)
+    if not 0 <= halfMoves <= 100 or not 0 <= fullMoves <= 9999:
+        raise ValueError("move counts out of range")
+
+    # next to move, castling & en passant, exactly as the original scheme's 23rd emoji
+    stateValue = 1040 if nextToMove == "b" else 0
+    for castle, castleValue in zip("KQkq", (520, 260, 130, 65)):
+        if castle in castleRights:
+            stateValue += castleValue
+    if enPassant != "-":
+        stateValue += 8 * (8 - int(enPassant[1])) + ord(enPassant[0]) - ord("a") + 1
+
+    # most significant part first
+    value = fullMoves
+    value = value * 101 + halfMoves
+    value = value * 2080 + stateValue
+    for piece in pieces:
+        value = value * 12 + piece
+
+    # combinatorial number system, ranks set of occupied squares among all sets of that size
+    occupancyIndex = 0
+    for k, square in enumerate(occupiedSquares, 1):
+        occupancyIndex += comb(square, k)
+    value = value * occupancyCombinations[len(pieces)] + occupancyIndex
+
+    value = value * 65 + len(pieces)
+
+    # base 3,178 digits, most significant first
+    digits = []
+    while True:
+        value, digit = divmod(value, 3178)
+        digits.append(emojiList[digit])
+        if value == 0:
+            break
+    digits.reverse()
+
+    return emojiList[denseSchemeFirstIndex + len(digits)] + "".join(digits)
+
+def decodeDense(positionEmoji):
+    '''
+    Takes list of emoji of a dense encoded position and returns FEN encoding of position.
+    '''
+    digitCount = emojiIndex(positionEmoji[0]) - denseSchemeFirstIndex
+    if len(positionEmoji) < 1 + digitCount:
+        raise ValueError("position is missing emoji")
+
+    value = 0
+    for digit in positionEmoji[1 : 1 + digitCount]:
+        value = value * 3178 + emojiIndex(digit)
+
+    # unpack in reverse order of encodeDense, least significant part first
+    value, pieceCount = divmod(value, 65)
+    value, occupancyIndex = divmod(value, occupancyCombinations[pieceCount])
+
+    # unrank combination, highest occupied square first
+    occupiedSquares = []
+    square = 63
+    for k in range(pieceCount, 0, -1):
+        while comb(square, k) > occupancyIndex:
+            square -= 1
+        occupiedSquares.append(square)
+        occupancyIndex -= comb(square, k)
+        square -= 1
+
+    squares = ["1"] * 64
+    for square in occupiedSquares:
+        value, piece = divmod(value, 12)
+        squares[square] = densePieces[piece]
+
+    value, stateValue = divmod(value, 2080)
+    fullMoves, halfMoves = divmod(value, 101)
+
+    # pieces, replacing each run of empty squares with its length
+    ranks = []
+    for rank in range(8):
+        rankString = "".join(squares[rank * 8 : (rank + 1) * 8])
+        ranks.append(re.sub("1+", lambda emptySquares: str(len(emptySquares.group())), rankString))
+
+    nextToMove = "b" if stateValue >= 1040 else "w"
+
+    castleRights = ""
+    for castle, castleValue in zip("KQkq", (520, 260, 130, 65)):
+        if stateValue % (2 * castleValue) >= castleValue:
+            castleRights += castle
+
+    enPassantValue = stateValue % 65
+    if enPassantValue == 0:
+        enPassant = "-"
+    else:
+        enPassant = "abcdefgh"[(enPassantValue - 1) % 8] + str(8 - (enPassantValue - 1) // 8)
+
+    return f'{"/".join(ranks)} {nextToMove} {castleRights or "-"} {enPassant} {halfMoves} {fullMoves}'
+
+@metrics.timed(metrics.codecSeconds, "mix")
 def mix(emojiPosition, message):
     '''
     Mixes a given emoji chess poition in to a given message.
@@ -524,7 +857,7 @@ def mix(emojiPosition, message):
         return interleavedList
 
     # get list of all emoji in position
-    splitEmoji = [x["emoji"] for x in emoji.emoji_lis(emojiPosition)]
+    splitEmoji = findEmoji(emojiPosition)
 
     # get a list of all words in message
     splitMessage = message.split()
@@ -534,6 +867,7 @@ def mix(emojiPosition, message):
 
     return " ".join(mixedMessage)
 
+@metrics.timed(metrics.codecSeconds, "unmix")
 def unmix(mixedMessage):
     '''
     Extracts emoji from a given mixed message including it.
@@ -541,13 +875,13 @@ def unmix(mixedMessage):
 
     emojiString = ""
 
-    extractedEmoji = emoji.emoji_lis(mixedMessage)
+    extractedEmoji = findEmoji(mixedMessage)
 
-    # iterate through first 25 extracted emoji
+    # iterate through all extracted emoji
     for entry in extractedEmoji:
 
         # get index of emoji in this entry
-        index = emojiIndex(entry["emoji"])
+        index = emojiIndex(entry)
 
         # append fully qualified emoji to string
         emojiString += emojiList[index]
@@ -20,6 +20,12 @@ imported_variable = credentials.variablename
 # can be generated or changed by contacting @BotFather on telegram
 bot_token = "exampletoken"
 
+# tokens of several bots to serve from this one process, sharing its emoji tables & caches
+# either a list of tokens, or a dict of name -> token (names label each bot's metrics & sessions database)
+# bot_token & webhook_workers are ignored when set, each bot's webhook is webhook_url + its token
+# set to None to serve only bot_token
+bot_tokens = None
+
 # webhook information 
 
 # set to True if using a webhook, False if running bot use polling
@@ -31,4 +37,99 @@ webhook_active = None
 webhook_port = None
 
 # needs to be set to the URL that your webhook is set up on
-webhook_url = "https://example.com/"
\ No newline at end of file
+webhook_url = "https://example.com/"
+
+# number of processes to handle webhook updates with, to make use of several cores
+# set to None (or 1) to handle all updates in a single process
+webhook_workers = None
+
+
+# Bot API information
+
+# number of keep-alive connections kept open to the Bot API
+# set to None to have one for every thread which can be making a call at once
+bot_api_connections = None
+
+
+# metrics information
+
+# local port to serve prometheus metrics on (http://127.0.0.1:port/metrics)
+# set to None to not serve metrics
+metrics_port = None
+
+
+# session information
+
+# sqlite database file to remember the current position of each chat's game in
+# set to None to not remember positions
+sessions_database = None
+
+
+# reminder information
+
+# sqlite database file to keep /remind move reminders in (may be the same file as sessions_database)
+# set to None to not offer reminders
+reminders_database = None
+
+
+# profiling information
+
+# directory to write flamegraph profiles (collapsed stacks) of slow updates to
+# set to None to not profile updates
+profile_directory = None
+
+# seconds an update must take to be handled before its profile is kept
+profile_threshold = 1.0
+
+
+# hint information
+
+# number of processes searching for /hint moves (per webhook worker, if using several)
+hint_processes = 1
+
+# seconds of CPU time a /hint search may use
+hint_seconds = 2.0
+
+
+# encoding information
+
+# scheme new positions are encoded with, "original" (25 emoji, decoded by every
+# version of the bot) or "dense" (fewer emoji, only decoded by bots which have the
+# dense scheme, so only turn it on once every bot your chats use is upgraded)
+encoding_scheme = "original"
+
+
+# memory information
+
+# megabytes of RSS above which caches are shrunk, set a little below the host's
+# memory limit (shared equally between webhook workers, if using several)
+# set to None to never shrink caches
+memory_soft_limit = None
+
+
+# shadow mode information
+
+# fraction (0-1) of calls to faster codec paths also run through the reference
+# codec on a background thread, to check they give the same results (see shadow.py)
+# e.g. 0.01 checks 1 in 100, set to None to turn shadow mode off
+shadow_sample_rate = None
+
+# file mismatches are written to, as a line of JSON each (with several webhook
+# workers, each has its own file, e.g. shadow.0.jsonl)
+shadow_mismatch_file = "data/shadow.jsonl"
+
+
+# logging information
+
+# lowest level of log records written, e.g. "INFO" or "WARNING"
+log_level = "INFO"
+
+# set to True to write each log record as a line of JSON, False for plain text
+log_json = False
+
+# fraction of INFO records kept from noisy loggers (and their child loggers)
+# e.g. {"telegram.ext": 0.1} keeps 1 in 10, warnings & errors are always kept
+log_sample_rates = {}
+
+# log records which can be waiting to be written before more are dropped
+log_queue_size = 10000
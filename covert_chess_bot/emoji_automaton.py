@@ -0,0 +1,151 @@
+# ------------------------------------------------------------------------------
+# Emoji Automaton
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Aho-Corasick automaton built from the emoji table, which finds every emoji in
+# a stream of text in a single pass over it, whatever size the text is.
+# https://en.wikipedia.org/wiki/Aho%E2%80%93Corasick_algorithm
+#
+# Many emoji start or end with another emoji (e.g. skin tone & zwj sequences),
+# so of overlapping matches the leftmost, then longest, is the one kept. This is
+# the same result as covert_chess.findEmoji, but text can be fed in any number
+# of pieces and matches are returned as soon as they can no longer change.
+# ------------------------------------------------------------------------------
+
+import copy
+
+class EmojiAutomaton:
+    '''
+    Aho-Corasick automaton matching emoji (strings) to their index.
+    '''
+
+    def __init__(self, emojiIndexes):
+        # state 0 is the root, each state is the string of characters leading to it
+        # goto[state] = {character: next state}
+        self.goto = [{}]
+        # fail[state] = state for longest proper suffix of this state's string which is also a state
+        self.fail = [0]
+        # depth[state] = length of this state's string
+        self.depth = [0]
+        # outputs[state] = [(length, emoji index)] of every emoji which is a suffix of this state's string
+        self.outputs = [[]]
+
+        # trie of every emoji
+        for emoji, index in emojiIndexes.items():
+            state = 0
+            for character in emoji:
+                nextState = self.goto[state].get(character)
+                if nextState == None:
+                    nextState = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.outputs.append([])
+                    self.goto[state][character] = nextState
+                state = nextState
+            self.outputs[state].append((len(emoji), index))
+
+        # failure links, breadth first so shorter states are always linked first
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for character, nextState in self.goto[state].items():
+                failState = self.fail[state]
+                while character not in self.goto[failState] and failState != 0:
+                    failState = self.fail[failState]
+                self.fail[nextState] = self.goto[failState].get(character, 0)
+                # every emoji matched at the fail state also ends here
+                self.outputs[nextState] = self.outputs[nextState] + self.outputs[self.fail[nextState]]
+                queue.append(nextState)
+
+        self.reset()
+
+    def stream(self):
+        '''
+        Returns automaton sharing this one's tables, with its own matching state, to feed a separate stream of text.
+        '''
+        stream = copy.copy(self)
+        stream.reset()
+
+        return stream
+
+    def reset(self):
+        '''
+        Forget any partly matched text, e.g. at the start of a new message.
+        '''
+        self.state = 0
+        # characters fed so far
+        self.position = 0
+        # start position -> (length, emoji index) of longest match found starting there
+        self.pending = {}
+        # matches may not start before here, as an earlier match covers it
+        self.nextStart = 0
+
+    def feed(self, text):
+        '''
+        Feed more text, returns list of (start position, emoji index) of emoji now known to be matched.
+        '''
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        pending = self.pending
+
+        matches = []
+        state = self.state
+        position = self.position
+
+        for character in text:
+            while character not in goto[state] and state != 0:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            position += 1
+
+            for length, index in outputs[state]:
+                start = position - length
+                if start not in pending or pending[start][0] < length:
+                    pending[start] = (length, index)
+
+            # matches starting before every partial match in progress can no longer grow
+            if pending:
+                self.position = position
+                self.finalise(position - self.depth[state], matches)
+
+        self.state = state
+        self.position = position
+
+        return matches
+
+    def flush(self):
+        '''
+        End of text, returns list of (start position, emoji index) of any remaining matches.
+        '''
+        matches = []
+        self.finalise(self.position + 1, matches)
+        self.reset()
+
+        return matches
+
+    def finalise(self, before, matches):
+        '''
+        Move leftmost longest pending matches starting before given position to matches.
+        '''
+        pending = self.pending
+
+        for start in sorted(start for start in pending if start < before):
+            length, index = pending.pop(start)
+            # overlaps a match already kept
+            if start < self.nextStart:
+                continue
+            matches.append((start, index))
+            self.nextStart = start + length
+
+    def findAll(self, text):
+        '''
+        Returns list of indexes of every emoji in a complete piece of text, in order.
+        '''
+        self.reset()
+        matches = self.feed(text) + self.flush()
+
+        return [index for start, index in matches]
@@ -4,6 +4,14 @@
 
 # tested working from 4.0 to 14.0 emoji standards
 
+# imported emoji are set once, when fully imported, and never changed after
+# (each is a tuple of read only dicts), so any number of threads can read them
+# at once without a lock. Importing is guarded by a lock, so the test file is
+# only read once however many threads ask for the emoji at the same time.
+
+import threading
+from types import MappingProxyType
+
 # default file location / name of unicode emoji test file is set here
 emojiTestFileLocation = "data/emoji-test.txt"
 
@@ -15,15 +23,31 @@ importedEmoji = None
 # instead of fully-qualified version, when they exists
 importedLessQualifiedEmoji = None
 
+# held while importing emoji, or changing the test file location
+importLock = threading.Lock()
+
 def setEmojiTestFileLocation(testFile = None):
     '''
     Overwrite the default test file location.
     '''
-    # set new test file location
-    emojiTestFileLocation = testFile
+    global emojiTestFileLocation
+
+    with importLock:
+        # set new test file location
+        emojiTestFileLocation = testFile
+
+        # reset imported emoji
+        releaseEmoji()
+
+def releaseEmoji():
+    '''
+    Forget imported emoji, e.g. once the emoji table has been built from them.
+    '''
+    global importedEmoji
+    global importedLessQualifiedEmoji
 
-    # reset imported emoji
     importedEmoji = None
+    importedLessQualifiedEmoji = None
 
 def getEmojiTestFileLocation():
     '''
@@ -38,35 +62,55 @@ def importEmoji(testFileOverride = None, lessQualified = False):
     emoji in a given unicode testfile.
     '''
 
-    # optionally setting new test file location
-    if testFileOverride != None:
-        setEmojiTestFileLocation(testFileOverride)
-
     # make sure we are working with global variables
+    global emojiTestFileLocation
     global importedEmoji
     global importedLessQualifiedEmoji
 
-    # requested fully qualified emoji have already been set
-    if (importedEmoji != None) and (lessQualified == False):
-        return importedEmoji
-    
-    # requested less qualified emoji have already been set
-    if (importedLessQualifiedEmoji != None) and (lessQualified == True):
-        return importedLessQualifiedEmoji
+    # requested emoji have already been set (only ever set fully imported, so no lock is needed)
+    imported = importedLessQualifiedEmoji if lessQualified else importedEmoji
+    if imported != None and testFileOverride in (None, emojiTestFileLocation):
+        return imported
+
+    with importLock:
+        # optionally setting new test file location, forgetting emoji imported from the old one
+        # (under the lock, so the file read is always the one asked for)
+        if testFileOverride != None and testFileOverride != emojiTestFileLocation:
+            emojiTestFileLocation = testFileOverride
+            releaseEmoji()
+
+        # another thread may have imported them while this one waited for the lock
+        imported = importedLessQualifiedEmoji if lessQualified else importedEmoji
+        if imported != None:
+            return imported
+
+        # read only copy of every entry, so no caller can change them for the others
+        imported = tuple(MappingProxyType(emojiEntry) for emojiEntry in readTestFile(emojiTestFileLocation, lessQualified))
 
-    # Only need to import if global variable has not yet been set
-    # i.e. an import has not already been done on fully qualified emoji
-    if (importedEmoji == None) and (lessQualified == False):
+        if lessQualified:
+            importedLessQualifiedEmoji = imported
+        else:
+            importedEmoji = imported
+
+    return imported
+
+def readTestFile(testFile, lessQualified = False):
+    '''
+    Returns list of dicts of info of each emoji in given unicode test file, run once per file by importEmoji.
+    '''
+
+    # fully qualified emoji
+    if lessQualified == False:
 
         # open the test file
-        emojiTestFile = open(emojiTestFileLocation, 'r', encoding='utf8')
+        emojiTestFile = open(testFile, 'r', encoding='utf8')
         # store each line of file
         emojiTestFileLines = emojiTestFile.readlines()
         # close passed file
         emojiTestFile.close()
 
         # initialise to list to store imported emoji info in
-        importedEmoji = []
+        emojiEntries = []
 
         # iterate over each line to find relevant info
         for line in emojiTestFileLines:
@@ -127,23 +171,22 @@ def importEmoji(testFileOverride = None, lessQualified = False):
                 }
 
                 # append dictionary for this emoji on to the list
-                importedEmoji.append(emojiEntry)
+                emojiEntries.append(emojiEntry)
 
-        return importedEmoji
+        return emojiEntries
     
-    # Only need to import requested emoji if global variable has not yet been set
-    # i.e. an import has not already been done on less qualified emoji
-    if (importedLessQualifiedEmoji == None) and (lessQualified == True):
+    # less qualified emoji
+    if lessQualified == True:
 
         # open the test file
-        emojiTestFile = open(emojiTestFileLocation, 'r', encoding='utf8')
+        emojiTestFile = open(testFile, 'r', encoding='utf8')
         # store each line of file
         emojiTestFileLines = emojiTestFile.readlines()
         # close passed file
         emojiTestFile.close()
 
         # initialise to list to store imported emoji info in
-        importedLessQualifiedEmoji = []
+        emojiEntries = []
 
         # iterate over each line to find relevant info
         for line in emojiTestFileLines:
@@ -204,7 +247,7 @@ def importEmoji(testFileOverride = None, lessQualified = False):
                 }
 
                 # append dictionary for this emoji on to the list
-                importedLessQualifiedEmoji.append(emojiEntry)
+                emojiEntries.append(emojiEntry)
             
             # checks if a less qualified version of emoji exists
             # i.e. last emoji entry needs to be overwritten 
@@ -229,7 +272,7 @@ def importEmoji(testFileOverride = None, lessQualified = False):
 
                 # overwrite last emoji dict
                 # i.e. overwriting entry of fully qualified version imported on previous line
-                importedLessQualifiedEmoji[-1] = {
+                emojiEntries[-1] = {
                     "emoji" : emoji,
                     "escape" : escapeSequence,
                     "name" : name,
@@ -237,7 +280,7 @@ def importEmoji(testFileOverride = None, lessQualified = False):
                     "subgroup" : subgroup
                 }
             
-        return importedLessQualifiedEmoji
+        return emojiEntries
 
 def getEmoji(testFileOverride = None, lessQualified = False):
     '''
@@ -250,7 +293,7 @@ def getEmoji(testFileOverride = None, lessQualified = False):
 
     # fully qualified emoji
     if lessQualified == False:
-        return [emojiEntry["emoji"] for emojiEntry in importEmoji(lessQualified == False)]
+        return [emojiEntry["emoji"] for emojiEntry in importEmoji()]
 
     # less qualified emoji
     if lessQualified == True:
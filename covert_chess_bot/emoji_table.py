@@ -0,0 +1,343 @@
+# ------------------------------------------------------------------------------
+# Emoji Table
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# The emoji tables the codec uses (index -> emoji, emoji -> index, and the name
+# / group / subgroup of each emoji), stored in one flat, memory mapped file.
+#
+# Built as python lists & dicts, the tables are thousands of small objects in
+# every process. Forked worker processes only share them until the objects'
+# reference counts are touched, after which each worker has its own copy. A
+# read only memory mapped file has no python objects in it, so every process
+# using it shares the same pages of the OS's page cache, and memory per worker
+# stays flat however many workers there are.
+#
+# The file (data/emoji.idx) is built from the unicode emoji test file the first
+# time it is needed (or whenever the test file changes), or ahead of time with:
+#   python3 -m covert_chess_bot.emoji_table
+#
+# Emoji are looked up in an open addressing hash table (crc32 of their utf8,
+# which unlike python's hash() is the same in every process), with linear
+# probing. The longest emoji starting with each character is also stored, so
+# when finding emoji in text, characters no emoji starts with (i.e. nearly all
+# ordinary text) are skipped after one binary search.
+#
+# table file layout (little endian):
+#   magic "CCET" / version (u32) / number of emoji n (u32) / hash slots m (u32)
+#   / longest emoji in characters (u32) / characters emoji start with s (u32)
+#   / test file size (u64) / test file crc32 (u64)
+#   5 columns (emoji, less qualified emoji, name, group, subgroup) of
+#   n + 1 string offsets (u32) each, string i is offsets[i] to offsets[i + 1]
+#   s characters emoji start with (u32 code point), sorted
+#   s lengths (u32) of longest emoji starting with each of those characters
+#   m slots (emoji index (u32, 0xFFFFFFFF if empty), string offset (u32), length (u32))
+#   strings (utf8)
+# ------------------------------------------------------------------------------
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from bisect import bisect_left
+from covert_chess_bot import emoji_importer
+
+# default location of table file
+tableFileLocation = "data/emoji.idx"
+
+TABLE_MAGIC = b"CCET"
+TABLE_VERSION = 1
+headerStruct = struct.Struct("<4sIIIIIQQ")
+# u32 per slot
+SLOT_SIZE = 3
+
+# index of an empty hash slot
+EMPTY_SLOT = 0xFFFFFFFF
+
+# string columns, in order stored
+EMOJI_COLUMN = 0
+LESS_QUALIFIED_COLUMN = 1
+NAME_COLUMN = 2
+GROUP_COLUMN = 3
+SUBGROUP_COLUMN = 4
+COLUMNS = 5
+
+def sourceStamp(testFileLocation = None):
+    '''
+    Returns (size, crc32) of emoji test file, used to tell if a table is out of date.
+    '''
+    with open(testFileLocation or emoji_importer.getEmojiTestFileLocation(), "rb") as testFile:
+        data = testFile.read()
+
+    return len(data), zlib.crc32(data)
+
+def buildTable(tableLocation = None):
+    '''
+    Build table file from unicode emoji test file, returns number of emoji in it.
+    '''
+    tableLocation = tableLocation or tableFileLocation
+
+    fullyQualified = emoji_importer.importEmoji()
+    lessQualified = emoji_importer.importEmoji(lessQualified=True)
+    count = len(fullyQualified)
+
+    # imported lists aren't needed once table is built
+    emoji_importer.releaseEmoji()
+
+    columns = [
+        [entry["emoji"] for entry in fullyQualified],
+        [entry["emoji"] for entry in lessQualified],
+        [entry["name"] for entry in fullyQualified],
+        [entry["group"] for entry in fullyQualified],
+        [entry["subgroup"] for entry in fullyQualified],
+    ]
+
+    # offsets of column strings, string i is offsets[i] to offsets[i + 1], so
+    # strings of a column are stored consecutively
+    strings = bytearray()
+    columnOffsets = []
+    # utf8 of emoji -> offset, so hash slots refer to strings already stored in a column
+    emojiOffsets = {}
+    for columnNumber, column in enumerate(columns):
+        offsets = [len(strings)]
+        for text in column:
+            data = text.encode("utf8")
+            if columnNumber in (EMOJI_COLUMN, LESS_QUALIFIED_COLUMN):
+                emojiOffsets.setdefault(data, len(strings))
+            strings.extend(data)
+            offsets.append(len(strings))
+        columnOffsets.append(offsets)
+
+    # both forms of every emoji, fully qualified added last so they win if a form appears in both lists
+    keys = {}
+    for index, emoji in enumerate(columns[LESS_QUALIFIED_COLUMN]):
+        keys[emoji] = index
+    for index, emoji in enumerate(columns[EMOJI_COLUMN]):
+        keys[emoji] = index
+
+    # at most half full, so probes stay short
+    slotCount = 1
+    while slotCount < 2 * len(keys):
+        slotCount *= 2
+
+    slots = [(EMPTY_SLOT, 0, 0)] * slotCount
+    for emoji, index in keys.items():
+        data = emoji.encode("utf8")
+        slot = zlib.crc32(data) & (slotCount - 1)
+        while slots[slot][0] != EMPTY_SLOT:
+            slot = (slot + 1) & (slotCount - 1)
+        slots[slot] = (index, emojiOffsets[data], len(data))
+
+    # character -> longest emoji starting with it
+    starts = {}
+    for emoji in keys:
+        starts[ord(emoji[0])] = max(starts.get(ord(emoji[0]), 0), len(emoji))
+    startChars = sorted(starts)
+
+    longest = max(starts.values())
+    size, crc = sourceStamp()
+
+    # offsets in file are from start of strings
+    table = bytearray(headerStruct.pack(TABLE_MAGIC, TABLE_VERSION, count, slotCount, longest, len(startChars), size, crc))
+    for offsets in columnOffsets:
+        table += struct.pack(f"<{count + 1}I", *offsets)
+    table += struct.pack(f"<{len(startChars)}I", *startChars)
+    table += struct.pack(f"<{len(startChars)}I", *(starts[char] for char in startChars))
+    for slot in slots:
+        table += struct.pack("<III", *slot)
+    table += strings
+
+    # written to a temporary file & renamed, so a process never maps a half written table
+    temporaryLocation = f"{tableLocation}.{os.getpid()}.tmp"
+    with open(temporaryLocation, "wb") as tableFile:
+        tableFile.write(table)
+    os.replace(temporaryLocation, tableLocation)
+
+    return count
+
+def u32Array(tableMap, start, count):
+    '''
+    Returns sequence of count u32 values in table file from start, read straight from the mapped file where possible.
+    '''
+    if sys.byteorder == "little":
+        return memoryview(tableMap)[start : start + 4 * count].cast("I")
+
+    return struct.unpack_from(f"<{count}I", tableMap, start)
+
+class EmojiColumn:
+    '''
+    Read only sequence of one column of strings (e.g. every emoji, by index) in a table file.
+    '''
+
+    def __init__(self, table, column):
+        self.map = table.map
+        self.count = table.count
+        self.offsets = u32Array(table.map, headerStruct.size + column * 4 * (table.count + 1), table.count + 1)
+        self.stringsStart = table.stringsStart
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("emoji index out of range")
+
+        return self.map[self.stringsStart + self.offsets[index] : self.stringsStart + self.offsets[index + 1]].decode("utf8")
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+class EmojiIndexes:
+    '''
+    Read only mapping of every emoji (both fully & less qualified forms) to its index, in a table file.
+    '''
+
+    def __init__(self, table):
+        self.map = table.map
+        self.slots = u32Array(table.map, table.slotsStart, SLOT_SIZE * table.slotCount)
+        self.stringsStart = table.stringsStart
+        self.mask = table.slotCount - 1
+        self.size = None
+
+    def find(self, emoji):
+        '''
+        Returns index of emoji, None if it isn't a known emoji.
+        '''
+        data = emoji.encode("utf8")
+        slot = zlib.crc32(data) & self.mask
+
+        slots = self.slots
+        while True:
+            index = slots[SLOT_SIZE * slot]
+            if index == EMPTY_SLOT:
+                return None
+            if slots[SLOT_SIZE * slot + 2] == len(data):
+                start = self.stringsStart + slots[SLOT_SIZE * slot + 1]
+                if self.map[start : start + len(data)] == data:
+                    return index
+            slot = (slot + 1) & self.mask
+
+    def get(self, emoji, default = None):
+        index = self.find(emoji)
+        return default if index == None else index
+
+    def __getitem__(self, emoji):
+        index = self.find(emoji)
+        if index == None:
+            raise KeyError(emoji)
+        return index
+
+    def __contains__(self, emoji):
+        return self.find(emoji) != None
+
+    def items(self):
+        '''
+        Yields (emoji, index) of every emoji form in table.
+        '''
+        for slot in range(self.mask + 1):
+            index, offset, length = self.slots[SLOT_SIZE * slot : SLOT_SIZE * slot + SLOT_SIZE]
+            if index != EMPTY_SLOT:
+                start = self.stringsStart + offset
+                yield self.map[start : start + length].decode("utf8"), index
+
+    def __iter__(self):
+        for emoji, index in self.items():
+            yield emoji
+
+    def __len__(self):
+        if self.size == None:
+            self.size = sum(1 for item in self.items())
+        return self.size
+
+class EmojiTable:
+    '''
+    Memory mapped table file, shared read only by every process using it.
+    '''
+
+    def __init__(self, tableLocation = None):
+        with open(tableLocation or tableFileLocation, "rb") as tableFile:
+            self.map = mmap.mmap(tableFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, self.slotCount, self.longest, self.startCount, self.sourceSize, self.sourceCrc = headerStruct.unpack_from(self.map, 0)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            raise ValueError("not an emoji table, or built by a different version")
+
+        startsStart = headerStruct.size + COLUMNS * 4 * (self.count + 1)
+        self.startChars = u32Array(self.map, startsStart, self.startCount)
+        self.startLengths = u32Array(self.map, startsStart + 4 * self.startCount, self.startCount)
+
+        self.slotsStart = startsStart + 8 * self.startCount
+        self.stringsStart = self.slotsStart + 4 * SLOT_SIZE * self.slotCount
+
+        self.emoji = EmojiColumn(self, EMOJI_COLUMN)
+        self.lessQualified = EmojiColumn(self, LESS_QUALIFIED_COLUMN)
+        self.names = EmojiColumn(self, NAME_COLUMN)
+        self.groups = EmojiColumn(self, GROUP_COLUMN)
+        self.subgroups = EmojiColumn(self, SUBGROUP_COLUMN)
+        self.indexes = EmojiIndexes(self)
+
+    def longestStartingWith(self, char):
+        '''
+        Returns length of longest emoji starting with given character, 0 if no emoji starts with it.
+        '''
+        codePoint = ord(char)
+        i = bisect_left(self.startChars, codePoint)
+        if i == self.startCount or self.startChars[i] != codePoint:
+            return 0
+
+        return self.startLengths[i]
+
+    def isCurrent(self, testFileLocation = None):
+        '''
+        Checks if table was built from emoji test file as it is now.
+        '''
+        return (self.sourceSize, self.sourceCrc) == sourceStamp(testFileLocation)
+
+    def info(self, index):
+        '''
+        Returns dict of info of emoji at index, as emoji_importer.importEmoji gives it.
+        '''
+        emoji = self.emoji[index]
+
+        return {
+            "emoji": emoji,
+            "escape": "".join(f"\\U{ord(char):08X}" for char in emoji),
+            "name": self.names[index],
+            "group": self.groups[index],
+            "subgroup": self.subgroups[index],
+        }
+
+# building is only ever done by one thread of a process at a time
+buildLock = threading.Lock()
+
+def loadTable(tableLocation = None):
+    '''
+    Returns table, building (or rebuilding) its file first if it doesn't exist or is out of date.
+    '''
+    tableLocation = tableLocation or tableFileLocation
+
+    with buildLock:
+        try:
+            table = EmojiTable(tableLocation)
+            if table.isCurrent():
+                return table
+        # not built yet, or by a different version
+        except (OSError, ValueError):
+            pass
+
+        buildTable(tableLocation)
+
+        return EmojiTable(tableLocation)
+
+if __name__ == "__main__":
+    print(f"stored {buildTable()} emoji in {tableFileLocation}")
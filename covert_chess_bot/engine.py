@@ -0,0 +1,523 @@
+# ------------------------------------------------------------------------------
+# Engine
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Small chess engine which suggests a move in a position, for /hint.
+#
+# Searches with alpha-beta (negamax) and iterative deepening, going one ply
+# deeper at a time until its time budget runs out, then gives the best move of
+# the deepest search completed. A bounded Zobrist keyed transposition table
+# remembers results of positions already searched (also reached by other move
+# orders), and the best move found in each is tried first next time. Other
+# moves are ordered with MVV-LVA (captures of the most valuable piece, by the
+# least valuable piece first), killer moves & the history heuristic.
+# https://www.chessprogramming.org/Alpha-Beta
+#
+# Positions are scored by material & piece-square tables (from the "Simplified
+# Evaluation Function"), with a quiescence search of captures at the end of
+# each line so positions aren't scored in the middle of an exchange.
+# https://www.chessprogramming.org/Simplified_Evaluation_Function
+#
+# Searches are CPU bound, so the bot runs them in separate worker processes
+# (HintPool), each limited to a fixed amount of CPU time, so that one hint can
+# never hold up other users' updates.
+# ------------------------------------------------------------------------------
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from covert_chess_bot.position import Position
+
+# optional, not available on every platform
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# default seconds of CPU time a search may use
+DEFAULT_SECONDS = 2.0
+
+# deepest search attempted, however much time is left
+MAX_DEPTH = 32
+
+# most captures followed at the end of a line
+QUIESCENCE_DEPTH = 6
+
+# positions remembered in transposition table
+TABLE_SIZE = 200000
+
+# nodes searched between checks of time used
+CHECK_INTERVAL = 512
+
+# score of being checkmated (less plies taken to get there)
+MATE_SCORE = 100000
+
+# centipawn value of each kind of piece
+pieceValues = {"P": 100, "N": 320, "B": 330, "R": 500, "Q": 900, "K": 0}
+
+# bonus (centipawns) for a white piece on each square, A8 to H1 (mirrored for black)
+pieceSquareTables = {
+    "P": [
+         0,  0,  0,  0,  0,  0,  0,  0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+         5,  5, 10, 25, 25, 10,  5,  5,
+         0,  0,  0, 20, 20,  0,  0,  0,
+         5, -5,-10,  0,  0,-10, -5,  5,
+         5, 10, 10,-20,-20, 10, 10,  5,
+         0,  0,  0,  0,  0,  0,  0,  0,
+    ],
+    "N": [
+        -50,-40,-30,-30,-30,-30,-40,-50,
+        -40,-20,  0,  0,  0,  0,-20,-40,
+        -30,  0, 10, 15, 15, 10,  0,-30,
+        -30,  5, 15, 20, 20, 15,  5,-30,
+        -30,  0, 15, 20, 20, 15,  0,-30,
+        -30,  5, 10, 15, 15, 10,  5,-30,
+        -40,-20,  0,  5,  5,  0,-20,-40,
+        -50,-40,-30,-30,-30,-30,-40,-50,
+    ],
+    "B": [
+        -20,-10,-10,-10,-10,-10,-10,-20,
+        -10,  0,  0,  0,  0,  0,  0,-10,
+        -10,  0,  5, 10, 10,  5,  0,-10,
+        -10,  5,  5, 10, 10,  5,  5,-10,
+        -10,  0, 10, 10, 10, 10,  0,-10,
+        -10, 10, 10, 10, 10, 10, 10,-10,
+        -10,  5,  0,  0,  0,  0,  5,-10,
+        -20,-10,-10,-10,-10,-10,-10,-20,
+    ],
+    "R": [
+         0,  0,  0,  0,  0,  0,  0,  0,
+         5, 10, 10, 10, 10, 10, 10,  5,
+        -5,  0,  0,  0,  0,  0,  0, -5,
+        -5,  0,  0,  0,  0,  0,  0, -5,
+        -5,  0,  0,  0,  0,  0,  0, -5,
+        -5,  0,  0,  0,  0,  0,  0, -5,
+        -5,  0,  0,  0,  0,  0,  0, -5,
+         0,  0,  0,  5,  5,  0,  0,  0,
+    ],
+    "Q": [
+        -20,-10,-10, -5, -5,-10,-10,-20,
+        -10,  0,  0,  0,  0,  0,  0,-10,
+        -10,  0,  5,  5,  5,  5,  0,-10,
+         -5,  0,  5,  5,  5,  5,  0, -5,
+          0,  0,  5,  5,  5,  5,  0, -5,
+        -10,  5,  5,  5,  5,  5,  0,-10,
+        -10,  0,  5,  0,  0,  0,  0,-10,
+        -20,-10,-10, -5, -5,-10,-10,-20,
+    ],
+    "K": [
+        -30,-40,-40,-50,-50,-40,-40,-30,
+        -30,-40,-40,-50,-50,-40,-40,-30,
+        -30,-40,-40,-50,-50,-40,-40,-30,
+        -30,-40,-40,-50,-50,-40,-40,-30,
+        -20,-30,-30,-40,-40,-30,-30,-20,
+        -10,-20,-20,-20,-20,-20,-20,-10,
+         20, 20,  0,  0,  0,  0, 20, 20,
+         20, 30, 10,  0,  0, 10, 30, 20,
+    ],
+}
+
+# piece letter -> list (by square) of value + square bonus for that piece, for both colours
+squareValues = {}
+for kind, table in pieceSquareTables.items():
+    squareValues[kind] = [pieceValues[kind] + table[square] for square in range(64)]
+    # black's tables are white's flipped top to bottom
+    squareValues[kind.lower()] = [pieceValues[kind] + table[square ^ 56] for square in range(64)]
+
+# transposition table entry bounds
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+class SearchTimeout(Exception):
+    '''
+    Raised inside a search when its time is up.
+    '''
+
+def evaluate(position):
+    '''
+    Returns score (centipawns) of position for the side to move.
+    '''
+    score = 0
+    for square, piece in enumerate(position.board):
+        if piece != None:
+            if piece.isupper():
+                score += squareValues[piece][square]
+            else:
+                score -= squareValues[piece][square]
+
+    return score if position.nextToMove == "w" else -score
+
+class Search:
+    '''
+    Alpha-beta search of one position, with its own transposition table & move ordering state.
+    '''
+
+    def __init__(self, position, seconds = DEFAULT_SECONDS, tableSize = TABLE_SIZE):
+        self.root = position
+        self.seconds = seconds
+        self.tableSize = tableSize
+
+        # Zobrist key -> (depth, score, bound, best move)
+        self.table = {}
+        # ply -> up to 2 quiet moves which recently caused a cutoff at that ply
+        self.killers = [[] for ply in range(MAX_DEPTH + QUIESCENCE_DEPTH + 2)]
+        # (piece, to square) -> how often quiet moves like it caused cutoffs
+        self.history = {}
+
+        self.nodes = 0
+        # CPU time, so time spent waiting (e.g. for other processes) isn't counted
+        self.deadline = None
+
+    def checkTime(self):
+        '''
+        Count a node, raising SearchTimeout every so often once time is up.
+        '''
+        self.nodes += 1
+        if self.nodes % CHECK_INTERVAL == 0 and time.process_time() > self.deadline:
+            raise SearchTimeout()
+
+    def store(self, key, depth, score, bound, move):
+        '''
+        Remember result of a position, forgetting the oldest entry if the table is full.
+        '''
+        if key not in self.table and len(self.table) >= self.tableSize:
+            del self.table[next(iter(self.table))]
+        self.table[key] = (depth, score, bound, move)
+
+    def orderMoves(self, position, moves, tableMove, ply):
+        '''
+        Returns moves in the order they should be searched, most promising first.
+        '''
+        board = position.board
+        killers = self.killers[ply]
+        history = self.history
+
+        def priority(move):
+            if move == tableMove:
+                return 10000000
+            captured = board[move[1]]
+            if captured != None:
+                # most valuable victim, least valuable attacker
+                return 1000000 + 10 * pieceValues[captured.upper()] - pieceValues[board[move[0]].upper()]
+            if move[2] != None:
+                return 900000
+            if move in killers:
+                return 800000
+            return history.get((board[move[0]], move[1]), 0)
+
+        return sorted(moves, key=priority, reverse=True)
+
+    def quiescence(self, position, alpha, beta, ply, depth):
+        '''
+        Returns score of position, following captures until it is quiet.
+        '''
+        self.checkTime()
+
+        standPat = evaluate(position)
+        if standPat >= beta or depth == 0:
+            return standPat
+        alpha = max(alpha, standPat)
+
+        colour = position.nextToMove
+        board = position.board
+        captures = [move for move in position.pseudoLegalMoves() if board[move[1]] != None]
+
+        for move in self.orderMoves(position, captures, None, ply):
+            after = position.push(move)
+            if after.isCheck(colour):
+                continue
+            score = -self.quiescence(after, -beta, -alpha, ply + 1, depth - 1)
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+
+        return alpha
+
+    def negamax(self, position, depth, alpha, beta, ply):
+        '''
+        Returns score of position searched to given depth, for the side to move.
+        '''
+        if depth <= 0:
+            return self.quiescence(position, alpha, beta, ply, QUIESCENCE_DEPTH)
+
+        self.checkTime()
+
+        # draw by 50 move rule
+        if position.halfMoves >= 100 and ply > 0:
+            return 0
+
+        key = position.zobristKey()
+        originalAlpha = alpha
+
+        entry = self.table.get(key)
+        tableMove = None
+        if entry != None:
+            entryDepth, entryScore, bound, tableMove = entry
+            if entryDepth >= depth and ply > 0:
+                if bound == EXACT:
+                    return entryScore
+                if bound == LOWER_BOUND:
+                    alpha = max(alpha, entryScore)
+                elif bound == UPPER_BOUND:
+                    beta = min(beta, entryScore)
+                if alpha >= beta:
+                    return entryScore
+
+        colour = position.nextToMove
+        inCheck = position.isCheck(colour)
+        # look further in to checks, they are forcing
+        if inCheck:
+            depth += 1
+
+        bestScore = -MATE_SCORE - 1
+        bestMove = None
+        legalMoves = 0
+
+        for move in self.orderMoves(position, position.pseudoLegalMoves(), tableMove, ply):
+            after = position.push(move)
+            if after.isCheck(colour):
+                continue
+            legalMoves += 1
+
+            score = -self.negamax(after, depth - 1, -beta, -alpha, ply + 1)
+
+            if score > bestScore:
+                bestScore = score
+                bestMove = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                # remember quiet moves which refuted the opponent's move
+                if position.board[move[1]] == None:
+                    killers = self.killers[ply]
+                    if move not in killers:
+                        killers.insert(0, move)
+                        del killers[2:]
+                    historyKey = (position.board[move[0]], move[1])
+                    self.history[historyKey] = self.history.get(historyKey, 0) + depth * depth
+                break
+
+        # checkmate (sooner is worse) or stalemate
+        if legalMoves == 0:
+            return -MATE_SCORE + ply if inCheck else 0
+
+        if bestScore <= originalAlpha:
+            bound = UPPER_BOUND
+        elif bestScore >= beta:
+            bound = LOWER_BOUND
+        else:
+            bound = EXACT
+        self.store(key, depth, bestScore, bound, bestMove)
+
+        return bestScore
+
+    def run(self):
+        '''
+        Search with iterative deepening until time is up, returns dict of result.
+        '''
+        start = time.process_time()
+        self.deadline = start + self.seconds
+
+        result = {"move": None, "score": None, "depth": 0}
+
+        legalMoves = self.root.legalMoves()
+        if len(legalMoves) == 0:
+            result["nodes"] = 0
+            result["seconds"] = 0
+            return result
+
+        for depth in range(1, MAX_DEPTH + 1):
+            try:
+                score = self.negamax(self.root, depth, -MATE_SCORE - 1, MATE_SCORE + 1, 0)
+            # keep result of deepest search completed
+            except SearchTimeout:
+                break
+
+            entry = self.table.get(self.root.zobristKey())
+            if entry != None and entry[3] != None:
+                result.update(move=entry[3], score=score, depth=depth)
+
+            # found a forced mate, searching deeper won't change move
+            if abs(score) >= MATE_SCORE - MAX_DEPTH:
+                break
+
+        # always suggest a legal move, even if not even depth 1 finished
+        if result["move"] == None:
+            result["move"] = legalMoves[0]
+
+        result["nodes"] = self.nodes
+        result["seconds"] = time.process_time() - start
+
+        return result
+
+def principalVariation(position, table, length = 8):
+    '''
+    Returns list of best moves from position, following transposition table.
+    '''
+    moves = []
+    seen = set()
+    while len(moves) < length:
+        key = position.zobristKey()
+        entry = table.get(key)
+        if entry == None or entry[3] == None or key in seen:
+            break
+        seen.add(key)
+        moves.append(entry[3])
+        position = position.push(entry[3])
+    return moves
+
+def suggestMove(fenPosition, seconds = DEFAULT_SECONDS):
+    '''
+    Returns dict describing best move found in given FEN position within given seconds of CPU time:
+        move (SAN), fen (after move), score (centipawns for side to move, None if
+        unknown), mate (moves until mate, negative if being mated, else None),
+        depth, nodes, seconds, line (SAN of expected continuation)
+    or None if there is no legal move.
+    '''
+    position = Position.fromFen(fenPosition)
+
+    if position.kingSquare("w") == None or position.kingSquare("b") == None:
+        raise ValueError("position must have a king of each colour")
+
+    search = Search(position, seconds)
+    result = search.run()
+
+    if result["move"] == None:
+        return None
+
+    # expected line, in SAN
+    line = []
+    linePosition = position
+    for move in principalVariation(position, search.table):
+        if move not in linePosition.legalMoves():
+            break
+        line.append(linePosition.san(move))
+        linePosition = linePosition.push(move)
+
+    score = result["score"]
+    mate = None
+    if score != None and abs(score) >= MATE_SCORE - MAX_DEPTH * 2:
+        plies = MATE_SCORE - abs(score)
+        mate = (plies + 1) // 2 if score > 0 else -((plies + 1) // 2)
+
+    return {
+        "move": position.san(result["move"]),
+        "fen": position.push(result["move"]).fen(),
+        "score": score,
+        "mate": mate,
+        "depth": result["depth"],
+        "nodes": result["nodes"],
+        "seconds": result["seconds"],
+        "line": line or [position.san(result["move"])],
+    }
+
+def limitedSuggestMove(fenPosition, seconds):
+    '''
+    suggestMove, run in a worker process, which is killed by the OS if it somehow uses far more CPU time than allowed.
+    '''
+    if resource != None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = usage.ru_utime + usage.ru_stime
+        soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        # backstop only, searches normally stop themselves in time
+        limit = int(used + seconds * 2 + 2)
+        if hard == resource.RLIM_INFINITY or limit <= hard:
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+    return suggestMove(fenPosition, seconds)
+
+class HintPool:
+    '''
+    Runs searches in worker processes, off the threads handling updates.
+    '''
+
+    def __init__(self, processes = 1, seconds = DEFAULT_SECONDS, maxPending = None):
+        self.processes = processes
+        self.seconds = seconds
+        # searches which can be waiting before new ones are turned away
+        self.maxPending = maxPending if maxPending != None else 4 * processes
+
+        # spawned (not forked), as the bot's process has many threads
+        self.context = multiprocessing.get_context("spawn")
+        # started on first search, so there are no worker processes if /hint is never used
+        self.executor = None
+        self.stopped = False
+
+        self.pending = 0
+        # keys (e.g. chat ids) with a search in progress, one search each at a time
+        self.busyKeys = set()
+        self.lock = threading.Lock()
+
+    def isBusy(self, key):
+        '''
+        Checks if key already has a search in progress.
+        '''
+        with self.lock:
+            return key in self.busyKeys
+
+    def searchExecutor(self):
+        '''
+        Returns pool of worker processes, starting it if there isn't one yet.
+        '''
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("hint pool has been shut down")
+            if self.executor == None:
+                self.executor = ProcessPoolExecutor(self.processes, mp_context=self.context)
+            return self.executor
+
+    def submit(self, fenPosition, key = None):
+        '''
+        Start a search, returns a Future of its result, or None if too many are already waiting (or key already has one).
+        '''
+        with self.lock:
+            if self.pending >= self.maxPending or (key != None and key in self.busyKeys):
+                return None
+            self.pending += 1
+            if key != None:
+                self.busyKeys.add(key)
+
+        def finished(future = None):
+            with self.lock:
+                self.pending -= 1
+                self.busyKeys.discard(key)
+
+        submitted = False
+        try:
+            executor = self.searchExecutor()
+            try:
+                future = executor.submit(limitedSuggestMove, fenPosition, self.seconds)
+            # a worker was killed (e.g. used too much CPU), start a new pool
+            except BrokenProcessPool:
+                with self.lock:
+                    if self.executor is executor:
+                        self.executor = None
+                future = self.searchExecutor().submit(limitedSuggestMove, fenPosition, self.seconds)
+
+            future.add_done_callback(finished)
+            submitted = True
+        # never submitted (e.g. the new pool broke too), so the key isn't left busy for good
+        finally:
+            if not submitted:
+                finished()
+
+        return future
+
+    def shutdown(self):
+        '''
+        Stop worker processes, cancelling waiting searches.
+        '''
+        with self.lock:
+            self.stopped = True
+            executor = self.executor
+
+        if executor != None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,426 @@
+# ------------------------------------------------------------------------------
+# Fake Bot API
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# A local stand-in for the Telegram Bot API, so the bot can be exercised
+# without talking to telegram. A Bot can be pointed at it with:
+#   Bot(token, base_url=fakeApi.baseUrl)
+#
+# Enforces telegram's flood limits on sent messages in the same way telegram
+# does, replying with a 429 error & retry_after when they are exceeded.
+#
+# Can also be served over HTTPS (with a self signed certificate), so the cost of
+# TLS handshakes shows up when measuring the bot's outbound calls.
+#
+# Updates pushed in to it are handed to the bot either through getUpdates
+# (polling), or by being POSTed to the bot's webhook once one has been set.
+#
+# Running this module directly runs a simulation of many chats being replied to
+# at once, both directly and through the send queue, and reports the results.
+# ------------------------------------------------------------------------------
+
+import http.client
+import json
+import os
+import ssl
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# limits enforced on sent messages, telegram allows ~30 messages per second
+# overall & ~1 per second to a chat, with short bursts allowed
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+# bot api methods which send a message to a chat
+SEND_METHODS = ("sendMessage", "sendPhoto", "sendDocument")
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections when many threads connect at
+    # once, which then take a second to retry
+    request_queue_size = 128
+
+class FakeBotApi:
+    '''
+    Local HTTP server answering Bot API calls, records every message sent.
+    '''
+
+    def __init__(self, port = 0, enforceLimits = True, latency = 0, certFile = None, keyFile = None):
+        # import here so the fake api can be used without the bot's send queue
+        from covert_chess_bot.send_queue import TokenBucket
+        self.TokenBucket = TokenBucket
+
+        self.enforceLimits = enforceLimits
+        # simulated time taken by telegram to handle each call
+        self.latency = latency
+
+        self.globalBucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chatBuckets = {}
+        self.lock = threading.Lock()
+
+        # every successfully sent message, as (time, method, parameters)
+        self.sent = []
+        # number of calls rejected with a 429 error
+        self.rejected = 0
+        # optional functions called with (method, parameters) on every successful send
+        self.listeners = []
+
+        self.messageId = 0
+
+        # connections accepted from the bot
+        self.connections = 0
+
+        # files uploaded (rather than sent by file id)
+        self.uploads = 0
+
+        # updates waiting to be fetched with getUpdates
+        self.updates = deque()
+        self.updatesAvailable = threading.Condition()
+        self.updateId = 0
+
+        # url set by the bot with setWebhook, updates are POSTed here if set
+        self.webhookUrl = None
+        self.webhookConnections = threading.local()
+        self.webhookExecutor = None
+
+        self.server = FakeBotApiServer(("127.0.0.1", port), self.requestHandler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.baseUrl = f"http://127.0.0.1:{self.port}/bot"
+
+        if certFile != None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certFile, keyFile)
+            # handshake is done by each connection's own thread, not the one accepting connections
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True, do_handshake_on_connect=False)
+            self.baseUrl = f"https://localhost:{self.port}/bot"
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True)
+        self.thread.start()
+
+    def requestHandler(self):
+        '''
+        Returns a request handler class bound to this fake api.
+        '''
+        fakeApi = self
+
+        class FakeBotApiRequestHandler(BaseHTTPRequestHandler):
+            # keep-alive, as the bot reuses its connections
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                with fakeApi.lock:
+                    fakeApi.connections += 1
+                super().setup()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+
+                # url is /bot<token>/<method>
+                method = self.path.rsplit("/", 1)[-1]
+
+                status, response = fakeApi.handle(method, parseParameters(self.headers.get("Content-Type", ""), body))
+
+                data = json.dumps(response).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeBotApiRequestHandler
+
+    def handle(self, method, parameters):
+        '''
+        Returns (http status, response) for given Bot API call.
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Covert Chess Bot", "username": "CovertChessBot"}}
+
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self.getUpdates(parameters)}
+
+        if method == "setWebhook":
+            self.webhookUrl = parameters.get("url") or None
+            return 200, {"ok": True, "result": True}
+
+        if method == "deleteWebhook":
+            self.webhookUrl = None
+            return 200, {"ok": True, "result": True}
+
+        if method in SEND_METHODS:
+            chatId = int(parameters.get("chat_id", 0))
+
+            with self.lock:
+                now = time.monotonic()
+
+                if self.enforceLimits:
+                    chatBucket = self.chatBuckets.get(chatId)
+                    if chatBucket == None:
+                        chatBucket = self.TokenBucket(CHAT_RATE, CHAT_BURST, now)
+                        self.chatBuckets[chatId] = chatBucket
+
+                    wait = max(self.globalBucket.waitTime(now), chatBucket.waitTime(now))
+                    if wait > 0:
+                        self.rejected += 1
+                        # telegram gives whole seconds to wait
+                        retryAfter = int(wait) + 1
+                        return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retryAfter}", "parameters": {"retry_after": retryAfter}}
+
+                    self.globalBucket.take(now)
+                    chatBucket.take(now)
+
+                self.messageId += 1
+                messageId = self.messageId
+                self.sent.append((now, method, parameters))
+
+            for listener in self.listeners:
+                listener(method, parameters)
+
+            result = {
+                "message_id": messageId,
+                "date": int(time.time()),
+                "chat": {"id": chatId, "type": "private" if chatId > 0 else "group"},
+                "text": parameters.get("text", ""),
+            }
+
+            # photos are either uploaded (a file, so not in parameters) or an already uploaded file id
+            if method == "sendPhoto":
+                fileId = parameters.get("photo")
+                if fileId == None:
+                    with self.lock:
+                        self.uploads += 1
+                    fileId = f"photo-{messageId}"
+                result["photo"] = [{"file_id": fileId, "file_unique_id": fileId, "width": 384, "height": 384}]
+
+            return 200, {"ok": True, "result": result}
+
+        # anything else is just accepted
+        return 200, {"ok": True, "result": True}
+
+    def getUpdates(self, parameters):
+        '''
+        Returns updates after given offset, waiting up to given timeout for one.
+        '''
+        offset = int(parameters.get("offset") or 0)
+        timeout = float(parameters.get("timeout") or 0)
+        limit = int(parameters.get("limit") or 100)
+
+        deadline = time.monotonic() + timeout
+
+        with self.updatesAvailable:
+            # updates before offset have been confirmed by the bot
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+
+            # long polling, wait for an update to arrive
+            while len(self.updates) == 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.updatesAvailable.wait(remaining)
+
+            return [self.updates[i] for i in range(min(limit, len(self.updates)))]
+
+    def makeUpdate(self, chatId, text):
+        '''
+        Returns a new update of a text message sent to the bot in given private chat.
+        '''
+        with self.updatesAvailable:
+            self.updateId += 1
+            updateId = self.updateId
+
+        message = {
+            "message_id": updateId,
+            "date": int(time.time()),
+            "chat": {"id": chatId, "type": "private", "first_name": "Load"},
+            "from": {"id": chatId, "is_bot": False, "first_name": "Load"},
+            "text": text,
+        }
+
+        # telegram marks commands with an entity, which command handlers look for
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split(" ", 1)[0])}]
+
+        return {"update_id": updateId, "message": message}
+
+    def pushUpdate(self, update):
+        '''
+        Hand an update to the bot, by webhook if one has been set, otherwise via getUpdates.
+        '''
+        if self.webhookUrl != None:
+            # deliver from a pool of threads, as telegram has many updates in flight at once
+            if self.webhookExecutor == None:
+                self.webhookExecutor = ThreadPoolExecutor(16, thread_name_prefix="fake-webhook")
+            return self.webhookExecutor.submit(self.deliverWebhook, update)
+
+        with self.updatesAvailable:
+            self.updates.append(update)
+            self.updatesAvailable.notify_all()
+
+    def deliverWebhook(self, update):
+        '''
+        POST update to bot's webhook, returns http status of response.
+        '''
+        host, path = self.webhookUrl.split("://", 1)[1].split("/", 1)
+        body = json.dumps(update).encode("utf8")
+        headers = {"Content-Type": "application/json"}
+
+        # each delivery thread keeps its own keep-alive connection
+        connection = getattr(self.webhookConnections, "connection", None)
+        for attempt in range(2):
+            if connection == None:
+                connection = http.client.HTTPConnection(host, timeout=30)
+                self.webhookConnections.connection = connection
+            try:
+                connection.request("POST", "/" + path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            # connection closed by bot since it was last used, retry on a new one
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                connection = None
+                self.webhookConnections.connection = None
+
+        return None
+
+    def stop(self):
+        '''
+        Shut down server.
+        '''
+        with self.updatesAvailable:
+            self.updatesAvailable.notify_all()
+        if self.webhookExecutor != None:
+            self.webhookExecutor.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+
+def selfSignedCertificate(directory):
+    '''
+    Writes a self signed certificate for localhost to directory (using the openssl command), returns (certificate file, key file).
+    '''
+    certFile = os.path.join(directory, "localhost.crt")
+    keyFile = os.path.join(directory, "localhost.key")
+
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+                    "-keyout", keyFile, "-out", certFile],
+                   check=True, capture_output=True)
+
+    return certFile, keyFile
+
+def parseParameters(contentType, body):
+    '''
+    Returns dict of parameters from body of a Bot API call.
+    '''
+    if len(body) == 0:
+        return {}
+
+    if contentType.startswith("application/json"):
+        return json.loads(body.decode("utf8"))
+
+    # files are sent as multipart forms, only the simple fields are needed here
+    if contentType.startswith("multipart/form-data"):
+        parameters = {}
+        boundary = contentType.split("boundary=", 1)[1].strip('"').encode("utf8")
+        for part in body.split(b"--" + boundary):
+            if b"\r\n\r\n" not in part:
+                continue
+            headers, value = part.split(b"\r\n\r\n", 1)
+            if b'name="' not in headers or b"filename=" in headers:
+                continue
+            name = headers.split(b'name="', 1)[1].split(b'"', 1)[0].decode("utf8")
+            parameters[name] = value.rstrip(b"\r\n").decode("utf8", "replace")
+        return parameters
+
+    return {}
+
+def simulate(chats = 60, messagesPerChat = 5, bulkChats = 100):
+    '''
+    Reply to many chats at once (while bulk messages are also being sent to
+    other group chats) against the fake api, both by calling the Bot API directly
+    from many threads & through the send queue, printing the results.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from covert_chess_bot.send_queue import SendQueue, PRIORITY_BULK
+    from covert_chess_bot.telegram_request import MeteredRequest
+    from telegram import Bot
+    from telegram.error import RetryAfter
+
+    def makeBot(fakeApi):
+        return Bot("123456:simulation", base_url=fakeApi.baseUrl, request=MeteredRequest(con_pool_size=16))
+
+    def report(name, fakeApi, start, latencies):
+        elapsed = time.monotonic() - start
+        latencies = sorted(latencies)
+        print(f"{name}:")
+        print(f"  messages sent:       {len(fakeApi.sent)}")
+        print(f"  429 responses:       {fakeApi.rejected}")
+        print(f"  total time:          {elapsed:.2f}s")
+        if latencies:
+            print(f"  median reply time:   {latencies[len(latencies) // 2]:.2f}s")
+            print(f"  slowest reply time:  {latencies[-1]:.2f}s")
+
+    # direct: every handler sends straight away, retrying after a 429
+    fakeApi = FakeBotApi()
+    bot = makeBot(fakeApi)
+    latencies = []
+
+    def sendDirectly(chatId, text):
+        queued = time.monotonic()
+        while True:
+            try:
+                bot.send_message(chatId, text)
+                break
+            except RetryAfter as error:
+                time.sleep(error.retry_after)
+        return time.monotonic() - queued
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(16) as executor:
+        bulkFutures = [executor.submit(sendDirectly, -chatId - 1, f"bulk {chatId}") for chatId in range(bulkChats)]
+        futures = [executor.submit(sendDirectly, chatId, f"reply {i}") for i in range(messagesPerChat) for chatId in range(1, chats + 1)]
+        latencies = [future.result() for future in futures]
+        [future.result() for future in bulkFutures]
+    report("Direct sends", fakeApi, start, latencies)
+    fakeApi.stop()
+
+    # send queue: rate limited & prioritised
+    fakeApi = FakeBotApi()
+    sendQueue = SendQueue(makeBot(fakeApi))
+
+    def recordLatency(queuedTime):
+        return lambda future: latencies.append(time.monotonic() - queuedTime)
+
+    start = time.monotonic()
+    latencies = []
+    for chatId in range(bulkChats):
+        sendQueue.send(-chatId - 1, f"bulk {chatId}", priority=PRIORITY_BULK)
+    for i in range(messagesPerChat):
+        for chatId in range(1, chats + 1):
+            sendQueue.send(chatId, f"reply {i}").add_done_callback(recordLatency(time.monotonic()))
+    sendQueue.join()
+    report("Send queue", fakeApi, start, latencies)
+    sendQueue.stop()
+    fakeApi.stop()
+
+if __name__ == "__main__":
+    simulate()
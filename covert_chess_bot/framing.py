@@ -0,0 +1,253 @@
+# ------------------------------------------------------------------------------
+# Framing
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Finds where encoded positions are in the emoji of a message, so other emoji
+# in the carrier text (e.g. a 👍 before the hidden position) don't corrupt them,
+# and every position in a message is found rather than just the first.
+#
+# A position (frame) can only start with a scheme's 1st emoji, which also gives
+# its length: 25 emoji for the original scheme (1st emoji index 2441-2453), or
+# 1 + the number of digits its 1st emoji gives for the dense scheme. Each
+# candidate frame is checked cheaply from emoji indexes alone before it is
+# decoded:
+#   original - every square emoji holds legal piece values, the state emoji is
+#              in range with a possible en passant square, and the full move
+#              counter is in range
+#   dense    - no leading zero digits
+# (the half move counter is always in range, as it is stored modulo 101)
+# then must decode to a valid FEN position, with pieces that could be on the
+# board in a real game (one king each, at most 16 pieces & 8 pawns each, no
+# pawns on the 1st or 8th rank). A valid frame (and a resignation
+# marker straight after it) is skipped over, otherwise the search moves on by
+# one emoji, so a message is framed in a single pass.
+#
+# The placement check only tells positions apart from other emoji in noisy
+# text, it never stops a position being encoded. Text whose emoji are exactly
+# one position (e.g. a plain /decode argument) is decoded strictly, without
+# it, by readPositions, so every encoded position can be decoded again.
+# ------------------------------------------------------------------------------
+
+from covert_chess_bot import covert_chess, shadow
+
+# most digit emoji a dense position can have
+DENSE_MAX_DIGITS = covert_chess.denseSchemeMaxDigits
+
+# emoji per three squares of the original scheme, and the offset each successive one is shifted by
+SQUARE_EMOJI = 21
+SQUARE_OFFSET = 1111
+
+# en passant values (0 for none, else 1 + square index) of squares a pawn can be taken en passant on (ranks 6 & 3)
+enPassantValues = frozenset({0} | set(range(17, 25)) | set(range(41, 49)))
+
+def candidateLength(index):
+    '''
+    Returns number of emoji in a position starting with emoji index, None if no position starts with it.
+    '''
+    if covert_chess.originalSchemeFirstIndex <= index < covert_chess.originalSchemeFirstIndex + 13:
+        return covert_chess.originalSchemeLength
+
+    digits = index - covert_chess.denseSchemeFirstIndex
+    if 0 < digits <= DENSE_MAX_DIGITS:
+        return 1 + digits
+
+    return None
+
+def isOriginalFrame(indexes):
+    '''
+    Checks emoji indexes of an original scheme position (25 emoji) could be a real position, without decoding it.
+    '''
+    # 3 squares of 13 possible values (empty or a piece) per emoji
+    for i in range(SQUARE_EMOJI):
+        if (indexes[1 + i] - i * SQUARE_OFFSET) % 3178 >= 13 ** 3:
+            return False
+
+    # next to move (2) x castling rights (16) x en passant (65)
+    state = indexes[22]
+    if state >= 2080 or state % 65 not in enPassantValues:
+        return False
+
+    # half moves (0-100) x full moves (FEN allows up to 4 digits)
+    if (indexes[23] * 3178 + indexes[24]) // 101 > 9999:
+        return False
+
+    return True
+
+def isOriginalEmoji(indexes, i):
+    '''
+    Checks emoji i of an original scheme position could be part of a real
+    position, given emoji indexes of the position up to & including it.
+    '''
+    if 1 <= i <= SQUARE_EMOJI:
+        return (indexes[i] - (i - 1) * SQUARE_OFFSET) % 3178 < 13 ** 3
+
+    if i == 22:
+        return indexes[22] < 2080 and indexes[22] % 65 in enPassantValues
+
+    if i == 24:
+        return (indexes[23] * 3178 + indexes[24]) // 101 <= 9999
+
+    return True
+
+def isDenseFrame(indexes):
+    '''
+    Checks emoji indexes of a dense scheme position could be a real position, without decoding it.
+    '''
+    # encoder never writes a leading zero digit
+    return len(indexes) == 2 or indexes[1] != 0
+
+def isPossiblePlacement(fenPosition):
+    '''
+    Checks pieces of a FEN position could be on the board in a real game.
+    '''
+    ranks = fenPosition.split(" ", 1)[0].split("/")
+    pieces = "".join(ranks)
+
+    if pieces.count("K") != 1 or pieces.count("k") != 1:
+        return False
+
+    if pieces.count("P") > 8 or pieces.count("p") > 8:
+        return False
+
+    if sum(char.isupper() for char in pieces) > 16 or sum(char.islower() for char in pieces) > 16:
+        return False
+
+    return not any(pawn in ranks[0] + ranks[7] for pawn in "Pp")
+
+def referenceDecodeFrame(indexes):
+    '''
+    Returns (scheme, FEN) of position with given emoji indexes, decoded from
+    its emoji by the reference codec, to check decodeFrame against in shadow mode.
+    '''
+    emojiPosition = "".join(covert_chess.emojiList[index] for index in indexes)
+
+    # undecorated, so shadow comparisons aren't counted as codec calls
+    return covert_chess.positionScheme(covert_chess.findEmoji(emojiPosition)), covert_chess.decode.__wrapped__(emojiPosition)
+
+@shadow.shadowed("decode_frame", referenceDecodeFrame)
+def decodeFrame(indexes):
+    '''
+    Returns (scheme, FEN) of position with given emoji indexes, None if they aren't a valid position.
+    '''
+    if covert_chess.originalSchemeFirstIndex <= indexes[0] < covert_chess.originalSchemeFirstIndex + 13:
+        scheme = covert_chess.ORIGINAL_SCHEME
+        if not isOriginalFrame(indexes):
+            return None
+    else:
+        scheme = covert_chess.DENSE_SCHEME
+        if not isDenseFrame(indexes):
+            return None
+
+    positionEmoji = [covert_chess.emojiList[index] for index in indexes]
+
+    try:
+        if scheme == covert_chess.DENSE_SCHEME:
+            fen = covert_chess.decodeDense(positionEmoji)
+        else:
+            fen = covert_chess.decodeOriginal(positionEmoji)
+    # e.g. more pieces than squares
+    except (ValueError, KeyError, IndexError):
+        return None
+
+    # state & counters of dense positions are only known once decoded
+    if not covert_chess.isValidFen(fen) or not isPossiblePlacement(fen):
+        return None
+
+    return scheme, fen
+
+def findPositions(text):
+    '''
+    Returns list of every valid position in text, in order, each a dict of:
+        emoji (fully qualified encoding, including any resignation marker),
+        fen, scheme, resigned
+    '''
+    indexes = [covert_chess.emojiIndex(emoji) for emoji in covert_chess.findEmoji(text)]
+
+    positions = []
+
+    i = 0
+    while i < len(indexes):
+        length = candidateLength(indexes[i])
+
+        # not the 1st emoji of a complete position
+        if length == None or i + length > len(indexes):
+            i += 1
+            continue
+
+        frame = decodeFrame(indexes[i : i + length])
+        if frame == None:
+            i += 1
+            continue
+
+        scheme, fen = frame
+        end = i + length
+        resigned = end < len(indexes) and indexes[end] == covert_chess.resignIndex
+        if resigned:
+            end += 1
+
+        positions.append({
+            "emoji": "".join(covert_chess.emojiList[index] for index in indexes[i:end]),
+            "fen": fen,
+            "scheme": scheme,
+            "resigned": resigned,
+        })
+
+        i = end
+
+    return positions
+
+def exactPosition(text):
+    '''
+    Returns position (as findPositions) if emoji of text are exactly one
+    position & an optional resignation marker, decoded without the placement
+    check, None if they aren't.
+    '''
+    indexes = [covert_chess.emojiIndex(emoji) for emoji in covert_chess.findEmoji(text)]
+
+    if len(indexes) == 0:
+        return None
+
+    length = candidateLength(indexes[0])
+    if length == None or len(indexes) not in (length, length + 1):
+        return None
+
+    resigned = len(indexes) == length + 1
+    if resigned and indexes[length] != covert_chess.resignIndex:
+        return None
+
+    positionEmoji = [covert_chess.emojiList[index] for index in indexes]
+    scheme = covert_chess.positionScheme(positionEmoji)
+
+    try:
+        if scheme == covert_chess.DENSE_SCHEME:
+            fen = covert_chess.decodeDense(positionEmoji[:length])
+        else:
+            fen = covert_chess.decodeOriginal(positionEmoji[:length])
+    # e.g. more pieces than squares
+    except (ValueError, KeyError, IndexError):
+        return None
+
+    if not covert_chess.isValidFen(fen):
+        return None
+
+    return {
+        "emoji": "".join(positionEmoji),
+        "fen": fen,
+        "scheme": scheme,
+        "resigned": resigned,
+    }
+
+def readPositions(text):
+    '''
+    Returns list of positions in text, as findPositions, but if its emoji are
+    exactly one position it is decoded strictly (even if its pieces couldn't be
+    on the board in a real game), as there is no other emoji to tell it apart from.
+    '''
+    position = exactPosition(text)
+    if position != None:
+        return [position]
+
+    return findPositions(text)
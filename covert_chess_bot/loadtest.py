@@ -0,0 +1,240 @@
+# ------------------------------------------------------------------------------
+# Load Test
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Measures how many updates per second the bot can handle, by replaying a
+# realistic mix of synthetic updates through the bot's real handlers, with a
+# local fake Bot API standing in for telegram.
+#
+# Both ways of receiving updates are tested, getUpdates (polling) & webhook.
+# The multi-process webhook deployment can also be tested ("workers" mode).
+# Latency of each update is measured from it being handed to the fake api
+# until the bot's reply to it arrives back at the fake api.
+#
+# usage (from the root folder of this repository):
+#   python3 -m covert_chess_bot.loadtest [--updates N] [--rate N] [--mode polling|webhook|workers|both]
+#                                         [--processes N]
+# ------------------------------------------------------------------------------
+
+import argparse
+import random
+import socket
+import threading
+import time
+from covert_chess_bot import bot as covertChessBot, covert_chess, metrics
+from covert_chess_bot.fake_bot_api import FakeBotApi
+from covert_chess_bot.send_queue import SendQueue
+from covert_chess_bot.telegram_request import MeteredRequest, connectionPoolSize
+from covert_chess_bot.workers import WebhookWorkerPool
+
+from telegram import Bot
+from telegram.ext import Updater
+
+# default file location of positions used to build synthetic updates
+positionsFileLocation = "data/positions.txt"
+
+# relative frequency of each kind of update sent to the bot
+updateMix = {
+    "encode": 30,
+    "decode": 25,
+    "mix": 15,
+    "move": 15,
+    "emoji": 15,
+}
+
+# words mixed messages are built from
+carrierWords = "the quick brown fox jumps over the lazy dog while we wait for lunch to arrive".split()
+
+def loadPositions(fileLocation = None):
+    '''
+    Returns list of FEN positions from positions file.
+    '''
+    with open(fileLocation or positionsFileLocation, "r", encoding="utf8") as positionsFile:
+        return [line.strip() for line in positionsFile if line.strip() != ""]
+
+def makeTexts(count, positions, seed = 0):
+    '''
+    Returns list of (kind, message text) for given number of synthetic updates.
+    '''
+    generator = random.Random(seed)
+
+    # encode every position once up front, so generating updates is cheap
+    encodings = [covert_chess.encode(fen) for fen in positions]
+
+    kinds = list(updateMix.keys())
+    weights = list(updateMix.values())
+
+    texts = []
+    for kind in generator.choices(kinds, weights, k=count):
+        i = generator.randrange(len(positions))
+
+        if kind == "encode":
+            text = f"/encode {positions[i]}"
+        elif kind == "decode":
+            # half of decodes are of positions mixed in to a message
+            if generator.random() < 0.5:
+                text = f"/decode {encodings[i]}"
+            else:
+                text = f"/decode {covert_chess.mix(encodings[i], ' '.join(generator.sample(carrierWords, 8)))}"
+        elif kind == "mix":
+            text = f"/mix {encodings[i]} message={' '.join(generator.sample(carrierWords, 8))}"
+        elif kind == "move":
+            text = f"/move {generator.choice([positions[i], encodings[i]])}"
+        else:
+            text = covert_chess.emojiList[generator.randrange(len(covert_chess.emojiList))]
+
+        texts.append((kind, text))
+
+    return texts
+
+def freePort():
+    '''
+    Returns a currently unused local port.
+    '''
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(sortedValues, fraction):
+    '''
+    Returns value at given fraction (0-1) through an already sorted list.
+    '''
+    if len(sortedValues) == 0:
+        return float("nan")
+
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+def run(mode, texts, rate = None, workers = 4, processes = 2, timeout = 30):
+    '''
+    Replays texts as updates to the bot using given mode (polling, webhook or
+    workers), returns dict of results.
+    '''
+    # no flood limits, it's the bot's own throughput being measured here
+    fakeApi = FakeBotApi(enforceLimits=False)
+
+    token = "123456:loadtest"
+    bot = Bot(token, base_url=fakeApi.baseUrl, request=MeteredRequest(con_pool_size=connectionPoolSize(workers)))
+
+    if mode == "workers":
+        # worker processes have their own dispatchers & send queues (with no global rate limit)
+        # n.b. their handler errors are not visible here, only unanswered updates
+        port = freePort()
+        pool = WebhookWorkerPool(token, port, processes, listen="127.0.0.1",
+                                 webhookUrl=f"http://127.0.0.1:{port}/{token}", baseUrl=fakeApi.baseUrl, globalRate=1e9)
+    else:
+        updater = Updater(bot=bot, workers=workers)
+        covertChessBot.add_handlers(updater.dispatcher)
+
+        # send queue as in the real bot, but with no global rate limit (every
+        # update comes from a different chat, so per chat limits are never hit)
+        covertChessBot.sendQueue = SendQueue(bot, globalRate=1e9, globalBurst=1e9)
+
+    # every update is sent from its own chat, so replies can be matched to updates
+    sentTimes = {}
+    replyTimes = {}
+    replied = threading.Event()
+
+    def recordReply(method, parameters):
+        replyTimes.setdefault(int(parameters["chat_id"]), time.monotonic())
+        if len(replyTimes) >= len(texts):
+            replied.set()
+
+    fakeApi.listeners.append(recordReply)
+
+    if mode == "workers":
+        pool.start()
+    elif mode == "webhook":
+        port = freePort()
+        updater.start_webhook(listen="127.0.0.1", port=port, url_path=token, webhook_url=f"http://127.0.0.1:{port}/{token}")
+    else:
+        updater.start_polling(poll_interval=0, timeout=1)
+
+    # make sure bot is up (and webhook is set) before measuring
+    time.sleep(1)
+
+    errorsBefore = sum(metrics.handlerErrors.values.values())
+
+    start = time.monotonic()
+    for i, (kind, text) in enumerate(texts):
+        # open loop, updates are sent at a fixed rate regardless of replies
+        if rate != None:
+            delay = start + (i / rate) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        chatId = i + 1
+        sentTimes[chatId] = time.monotonic()
+        fakeApi.pushUpdate(fakeApi.makeUpdate(chatId, text))
+
+    replied.wait(timeout)
+    elapsed = max(replyTimes.values(), default=time.monotonic()) - start
+
+    errors = sum(metrics.handlerErrors.values.values()) - errorsBefore
+
+    if mode == "workers":
+        pool.stop()
+    else:
+        updater.stop()
+        covertChessBot.sendQueue.stop()
+        covertChessBot.sendQueue = None
+    fakeApi.stop()
+
+    latencies = sorted(replyTimes[chatId] - sentTimes[chatId] for chatId in replyTimes)
+
+    # per kind of update
+    kinds = {}
+    for i, (kind, text) in enumerate(texts):
+        if i + 1 in replyTimes:
+            kinds.setdefault(kind, []).append(replyTimes[i + 1] - sentTimes[i + 1])
+
+    return {
+        "mode": mode,
+        "updates": len(texts),
+        "replies": len(latencies),
+        "unanswered": len(texts) - len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "kinds": {kind: percentile(sorted(values), 0.50) for kind, values in kinds.items()},
+    }
+
+def report(results):
+    '''
+    Print results of a load test run.
+    '''
+    print(f"{results['mode']}:")
+    print(f"  updates sent:     {results['updates']}")
+    print(f"  replies received: {results['replies']}")
+    print(f"  error rate:       {(results['unanswered'] + results['errors']) / results['updates']:.2%} ({results['unanswered']} unanswered, {results['errors']} error replies)")
+    print(f"  throughput:       {results['throughput']:.1f} updates/s")
+    print(f"  latency p50:      {results['p50'] * 1000:.1f} ms")
+    print(f"  latency p95:      {results['p95'] * 1000:.1f} ms")
+    print(f"  latency p99:      {results['p99'] * 1000:.1f} ms")
+    for kind, median in sorted(results["kinds"].items()):
+        print(f"    {kind + ' p50:':16}{median * 1000:.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the covert chess bot against a local fake Bot API.")
+    parser.add_argument("--updates", type=int, default=500, help="number of updates to send in each mode")
+    parser.add_argument("--rate", type=float, default=None, help="updates per second to send at (default: all at once)")
+    parser.add_argument("--mode", choices=["polling", "webhook", "workers", "both"], default="both")
+    parser.add_argument("--workers", type=int, default=4, help="dispatcher worker threads")
+    parser.add_argument("--processes", type=int, default=2, help="worker processes in workers mode")
+    parser.add_argument("--positions", default=positionsFileLocation, help="file of FEN positions to build updates from")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    texts = makeTexts(arguments.updates, loadPositions(arguments.positions), arguments.seed)
+
+    modes = ["polling", "webhook"] if arguments.mode == "both" else [arguments.mode]
+    for mode in modes:
+        report(run(mode, texts, arguments.rate, arguments.workers, arguments.processes))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# ------------------------------------------------------------------------------
+# Log Pipeline
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Logging which never holds up the thread handling an update.
+#
+# Records logged anywhere in the process (the bot's own & every library's) go to
+# one handler on the root logger, which only puts them on a bounded queue. A
+# single background thread takes them off the queue, formats them (as plain
+# text, or one JSON object per line for log collectors) & writes them out, so
+# formatting & log I/O are off the request path.
+#
+# Under a burst, the queue filling up means records are being logged faster than
+# they can be written. Rather than blocking the handling threads until there is
+# room, records which don't fit are dropped & counted in the metrics.
+#
+# Noisy loggers can also be sampled, e.g. {"telegram.ext": 0.1} keeps 1 in 10 of
+# the INFO (and DEBUG) records of telegram.ext & its child loggers. Warnings &
+# errors are always kept.
+#
+# Worker processes forked after logging is started get their own queue &
+# writing thread, as threads don't survive a fork.
+# ------------------------------------------------------------------------------
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from covert_chess_bot import metrics
+
+# records which can be waiting to be written before more are dropped
+DEFAULT_QUEUE_SIZE = 10000
+
+# format of plain text records
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# attributes every LogRecord has, anything else was passed with extra={...}
+standardAttributes = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+logRecordsDropped = metrics.Counter("covert_chess_log_records_dropped_total", "Log records not written, by reason (sampled or queue_full).", ["reason"])
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats records as one JSON object per line, including any extra={...} fields.
+    '''
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+
+        for key, value in vars(record).items():
+            if key not in standardAttributes and key not in entry:
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+
+        # values which aren't JSON types (e.g. an exception in extra) are written as their str
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps a fraction of the INFO & lower records of given loggers (and their child loggers).
+    '''
+
+    def __init__(self, rates):
+        super().__init__()
+        # logger name -> fraction of its records kept
+        self.rates = dict(rates)
+        # logger name -> rate applying to it (its own, or nearest parent's), found once per logger
+        self.resolved = {}
+        # logger name -> records owed to it, a record is kept each time this reaches 1
+        self.credit = {}
+        self.lock = threading.Lock()
+
+    def rate(self, name):
+        '''
+        Returns fraction of records of named logger which are kept.
+        '''
+        rate = self.resolved.get(name)
+        if rate == None:
+            rate = 1.0
+            parent = name
+            while parent:
+                if parent in self.rates:
+                    rate = self.rates[parent]
+                    break
+                parent = parent.rpartition(".")[0]
+            self.resolved[name] = rate
+
+        return rate
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+
+        rate = self.rate(record.name)
+        if rate >= 1:
+            return True
+
+        # evenly spread, rather than random, so a rate of 0.1 keeps exactly every 10th record
+        with self.lock:
+            credit = self.credit.get(record.name, 1.0) + rate
+            keep = credit >= 1
+            self.credit[record.name] = credit - 1 if keep else credit
+
+        if not keep:
+            logRecordsDropped.inc("sampled")
+
+        return keep
+
+class DroppingQueueHandler(QueueHandler):
+    '''
+    Puts records on a bounded queue without ever waiting, dropping them when it is full.
+    '''
+
+    def prepare(self, record):
+        # records are formatted by the listener, only the message is filled in
+        # now, so arguments changed after logging aren't written as changed
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            logRecordsDropped.inc("queue_full")
+
+class BlockingStopListener(QueueListener):
+    '''
+    Queue listener whose stop waits for room on a full queue, so every queued record is written before it stops.
+    '''
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+# pipeline, while logging is started
+queueHandler = None
+listener = None
+
+def startLogging(level = logging.INFO, jsonOutput = False, sampleRates = None, queueSize = None, stream = None):
+    '''
+    Send every record logged in this process through the pipeline, written to stream (stderr by default).
+    '''
+    global queueHandler, listener
+
+    stopLogging()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if jsonOutput else logging.Formatter(TEXT_FORMAT))
+
+    queueHandler = DroppingQueueHandler(queue.Queue(maxsize=queueSize or DEFAULT_QUEUE_SIZE))
+    if sampleRates:
+        queueHandler.addFilter(SamplingFilter(sampleRates))
+
+    root = logging.getLogger()
+    # replace any handlers already set up (e.g. by basicConfig)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queueHandler)
+    # level may be given by name, e.g. "INFO" from credentials.py
+    root.setLevel(level)
+
+    listener = BlockingStopListener(queueHandler.queue, output)
+    listener.start()
+
+    return listener
+
+def stopLogging():
+    '''
+    Write every record already queued, then stop the writing thread.
+    '''
+    global listener
+
+    if listener != None:
+        listener.stop()
+        listener = None
+
+def restartAfterFork():
+    '''
+    Give a forked process its own queue & writing thread, as the parent's thread doesn't exist in it.
+    '''
+    global listener
+
+    if listener == None:
+        return
+
+    # the parent's queue may have been forked mid put / get, with its lock held
+    queueHandler.queue = queue.Queue(maxsize=queueHandler.queue.maxsize)
+    listener = BlockingStopListener(queueHandler.queue, *listener.handlers)
+    listener.start()
+
+os.register_at_fork(after_in_child=restartAfterFork)
+
+# records still queued when the process exits are written
+atexit.register(stopLogging)
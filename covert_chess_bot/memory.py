@@ -0,0 +1,329 @@
+# ------------------------------------------------------------------------------
+# Memory
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Memory accounting, for running within a small hard memory cap.
+#
+# Subsystems (codec tables, caches, session stores, queued replies...) are
+# registered with a function giving the bytes they hold, and optionally one
+# shrinking them. A background thread samples the process's RSS, and the bytes
+# held by each subsystem, every SAMPLE_INTERVAL seconds in to the metrics.
+#
+# Given a soft limit (below the platform's hard limit), every shrinkable
+# subsystem is shrunk whenever RSS is over it, and freed memory is handed back
+# to the operating system, so the process sheds its caches rather than being
+# killed. Caches just refill as they are used again.
+#
+# Python allocations can be traced on demand, from the metrics server's
+# /memory page (e.g. http://127.0.0.1:metrics_port/memory):
+#   /memory                     RSS, subsystems & (while tracing) top allocations
+#   /memory?trace=start         start tracing allocations (frames=N for deeper tracebacks)
+#   /memory?top=N&group=lineno  N largest allocation sites (lineno, filename or traceback)
+#   /memory?diff=1              allocation growth since the previous snapshot
+#   /memory?trace=stop          stop tracing (tracing slows every allocation)
+# ------------------------------------------------------------------------------
+
+import gc
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+from types import BuiltinFunctionType, FunctionType, MethodType, ModuleType
+from covert_chess_bot import metrics
+
+# optional, not available on every platform
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# seconds between samples of memory use
+SAMPLE_INTERVAL = 15
+
+# allocation sites listed on /memory by default
+DEFAULT_TOP = 25
+
+# objects shared by the whole process, never counted as part of a subsystem
+# (bound methods are skipped too, so e.g. a queued bot.send_message doesn't count the whole bot)
+sharedTypes = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType)
+
+# objects holding no references to other objects
+atomicTypes = (str, bytes, bytearray, int, float, bool, type(None))
+
+rssBytes = metrics.Gauge("covert_chess_memory_rss_bytes", "Resident set size of the process.")
+
+peakRssBytes = metrics.Gauge("covert_chess_memory_peak_rss_bytes", "Largest resident set size the process has had.")
+
+allocatedBlocks = metrics.Gauge("covert_chess_memory_allocated_blocks", "Memory blocks currently allocated by the Python interpreter.")
+
+tracedBytes = metrics.Gauge("covert_chess_memory_traced_bytes", "Bytes of Python allocations traced by tracemalloc (only while tracing).")
+
+subsystemBytes = metrics.Gauge("covert_chess_memory_subsystem_bytes", "Bytes held by each subsystem, as last sampled.", ["subsystem"])
+
+softLimitBytes = metrics.Gauge("covert_chess_memory_soft_limit_bytes", "RSS above which caches are shrunk (0 if there is no soft limit).")
+
+memoryShrinks = metrics.Counter("covert_chess_memory_shrinks_total", "Times caches were shrunk for being over the soft memory limit.")
+
+def deepSize(obj, seen = None):
+    '''
+    Returns bytes used by obj & every object reachable from it, not counting
+    classes, modules, functions & bound methods (which are shared), or any
+    object whose id is in seen.
+    '''
+    seen = set() if seen == None else seen
+    size = 0
+
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, sharedTypes):
+            continue
+        seen.add(id(obj))
+
+        size += sys.getsizeof(obj)
+        if not isinstance(obj, atomicTypes):
+            # contents of containers, attributes of objects
+            stack.extend(gc.get_referents(obj))
+
+    return size
+
+def lruCacheSize(function):
+    '''
+    Returns bytes held by the cache of an lru_cache decorated function.
+    '''
+    # the cache can only be reached through the garbage collector, whose referents of the function are its cached keys & results
+    seen = {id(function.__dict__)}
+    return sum(deepSize(referent, seen) for referent in gc.get_referents(function) if type(referent) is not object)
+
+def currentRss():
+    '''
+    Returns resident set size of this process in bytes, its peak RSS where the current RSS isn't available.
+    '''
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    # no /proc or os.sysconf, e.g. on Windows
+    except (OSError, ValueError, IndexError, AttributeError):
+        return peakRss()
+
+def peakRss():
+    '''
+    Returns largest resident set size this process has had in bytes, 0 where it isn't available.
+    '''
+    if resource == None:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, other than on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def releaseFreeMemory():
+    '''
+    Collect garbage, then hand freed heap memory back to the operating system where possible.
+    '''
+    gc.collect()
+
+    # glibc otherwise keeps freed memory for reuse, so RSS wouldn't go down
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def formatBytes(size):
+    '''
+    Returns number of bytes as readable text, e.g. "12.5 MiB".
+    '''
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+    return f"{size:.1f} GiB"
+
+class MemoryMonitor:
+    '''
+    Samples memory use of this process & each registered subsystem, shrinking caches when over a soft limit.
+    '''
+
+    def __init__(self, softLimit = None, interval = SAMPLE_INTERVAL):
+        # bytes of RSS above which caches are shrunk, None for no limit
+        self.softLimit = softLimit
+        self.interval = interval
+
+        # name -> (function returning bytes held, function shrinking it or None)
+        self.subsystems = {}
+        self.lock = threading.Lock()
+
+        # previous snapshot taken for /memory, to show growth since
+        self.snapshot = None
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def track(self, name, size, shrink = None):
+        '''
+        Account for memory held by a subsystem (replacing any already tracked by name).
+        '''
+        with self.lock:
+            self.subsystems[name] = (size, shrink)
+
+        subsystemBytes.set(0, name)
+
+    def sizes(self):
+        '''
+        Returns dict of name -> bytes held by each subsystem.
+        '''
+        with self.lock:
+            subsystems = dict(self.subsystems)
+
+        sizes = {}
+        for name, (size, shrink) in subsystems.items():
+            try:
+                sizes[name] = size()
+            # e.g. a container changed size while it was being walked, just skip it this time
+            except Exception:
+                logger.exception("sizing %s failed", name)
+
+        return sizes
+
+    def shrink(self):
+        '''
+        Shrink every shrinkable subsystem, then release freed memory.
+        '''
+        with self.lock:
+            shrinks = [(name, shrink) for name, (size, shrink) in self.subsystems.items() if shrink != None]
+
+        for name, shrink in shrinks:
+            try:
+                shrink()
+            except Exception:
+                logger.exception("shrinking %s failed", name)
+
+        releaseFreeMemory()
+        memoryShrinks.inc()
+
+    def sample(self):
+        '''
+        Record memory use in the metrics, shrinking caches if RSS is over the soft limit.
+        '''
+        rss = currentRss()
+        rssBytes.set(rss)
+        peakRssBytes.set(peakRss())
+        allocatedBlocks.set(sys.getallocatedblocks())
+        tracedBytes.set(tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0)
+
+        sizes = self.sizes()
+        for name, size in sizes.items():
+            subsystemBytes.set(size, name)
+
+        if self.softLimit != None and rss > self.softLimit:
+            largest = sorted(sizes.items(), key=lambda item: -item[1])[:3]
+            self.shrink()
+            logger.warning("RSS %s over soft limit of %s, shrank caches (largest subsystems were %s), RSS now %s",
+                           formatBytes(rss), formatBytes(self.softLimit),
+                           ", ".join(f"{name} {formatBytes(size)}" for name, size in largest), formatBytes(currentRss()))
+
+    def start(self):
+        '''
+        Start sampling memory use on a background thread.
+        '''
+        softLimitBytes.set(self.softLimit or 0)
+
+        self.thread = threading.Thread(target=self.sampleLoop, name="memory-monitor", daemon=True)
+        self.thread.start()
+
+    def sampleLoop(self):
+        while True:
+            try:
+                self.sample()
+            # never let a failed sample stop future ones
+            except Exception:
+                logger.exception("memory sample failed")
+
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+    def report(self, query):
+        '''
+        Returns text of /memory page, given its query parameters (see top of file).
+        '''
+        top = int(query.get("top", DEFAULT_TOP))
+        group = query.get("group", "lineno")
+        if group not in ("lineno", "filename", "traceback"):
+            raise ValueError("group must be lineno, filename or traceback")
+
+        trace = query.get("trace")
+        if trace == "start" and not tracemalloc.is_tracing():
+            tracemalloc.start(int(query.get("frames", 1)))
+            self.snapshot = None
+        elif trace == "stop" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.snapshot = None
+
+        lines = [f"RSS: {formatBytes(currentRss())} (peak {formatBytes(peakRss())})"]
+        lines.append(f"soft limit: {formatBytes(self.softLimit) if self.softLimit != None else 'none'}")
+        lines.append(f"python allocated blocks: {sys.getallocatedblocks()}")
+
+        lines += ["", "subsystems:"]
+        for name, size in sorted(self.sizes().items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<24} {formatBytes(size):>12}")
+
+        lines.append("")
+        if not tracemalloc.is_tracing():
+            lines.append("allocations aren't being traced, start tracing with /memory?trace=start")
+            return "\n".join(lines) + "\n"
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"traced python allocations: {formatBytes(current)} (peak {formatBytes(peak)})")
+
+        # allocations of tracemalloc itself would otherwise top the list
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+        if query.get("diff") and self.snapshot != None:
+            lines.append(f"top {top} allocation sites by growth since previous snapshot:")
+            statistics = snapshot.compare_to(self.snapshot, group)
+            for statistic in statistics[:top]:
+                lines.append(f"  {formatBytes(statistic.size_diff):>12} ({statistic.count_diff:+} blocks) {self.location(statistic.traceback, group)}")
+        else:
+            lines.append(f"top {top} allocation sites:")
+            for statistic in snapshot.statistics(group)[:top]:
+                lines.append(f"  {formatBytes(statistic.size):>12} ({statistic.count} blocks) {self.location(statistic.traceback, group)}")
+
+        self.snapshot = snapshot
+
+        return "\n".join(lines) + "\n"
+
+    def location(self, traceback, group):
+        if group == "traceback":
+            return "\n      " + "\n      ".join(traceback.format())
+        if group == "filename":
+            return traceback[0].filename
+        return f"{traceback[0].filename}:{traceback[0].lineno}"
+
+# monitor of this process, once started
+monitor = None
+
+def startMonitor(softLimit = None):
+    '''
+    Start sampling memory use of this process (shrinking caches over softLimit bytes), and serve /memory from the metrics server, returns monitor.
+    '''
+    global monitor
+
+    if monitor != None:
+        monitor.stop()
+
+    monitor = MemoryMonitor(softLimit)
+    monitor.start()
+    metrics.addPage("/memory", monitor.report)
+
+    return monitor
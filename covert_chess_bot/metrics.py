@@ -0,0 +1,339 @@
+# ------------------------------------------------------------------------------
+# Metrics
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Minimal in-process metrics (counters, gauges & histograms) which can be
+# served on a local HTTP port in the Prometheus text exposition format.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Recording a value only updates a few numbers under a lock, all formatting is
+# deferred until the metrics page is actually scraped, so the overhead is
+# negligible when nothing is scraping.
+# ------------------------------------------------------------------------------
+
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# default histogram bucket upper bounds (in seconds)
+defaultBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# every metric created in this module, in the order they were created
+registry = []
+
+def formatLabels(labelNames, labelValues, extra = None):
+    '''
+    Returns label set in Prometheus format e.g. {command="encode"}
+    '''
+    pairs = list(zip(labelNames, labelValues))
+
+    if extra != None:
+        pairs.append(extra)
+
+    if len(pairs) == 0:
+        return ""
+
+    # escape characters which are not allowed unescaped in a label value
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+
+    return "{" + ",".join(escaped) + "}"
+
+def formatValue(value):
+    '''
+    Returns number formatted as Prometheus expects it.
+    '''
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+class Counter:
+    '''
+    Value which only ever goes up, optionally split by labels.
+    '''
+
+    def __init__(self, name, description, labelNames = ()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labelValues, amount = 1):
+        '''
+        Increase value of counter for given labels.
+        '''
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def get(self, *labelValues):
+        '''
+        Returns current value of counter for given labels.
+        '''
+        return self.values.get(labelValues, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+
+        with self.lock:
+            values = sorted(self.values.items())
+
+        for labelValues, value in values:
+            lines.append(f"{self.name}{formatLabels(self.labelNames, labelValues)} {formatValue(value)}")
+
+        return lines
+
+class Gauge:
+    '''
+    Value which can go up and down, optionally split by labels.
+    Either set directly, or computed by a callback each time it is scraped.
+    '''
+
+    def __init__(self, name, description, labelNames = ()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.values = {}
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def set(self, value, *labelValues):
+        '''
+        Set value of gauge for given labels.
+        '''
+        with self.lock:
+            self.values[labelValues] = value
+
+    def setFunction(self, function, *labelValues):
+        '''
+        Set a function which is called to get gauge value when it is scraped.
+        '''
+        with self.lock:
+            self.callbacks[labelValues] = function
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+
+        with self.lock:
+            values = dict(self.values)
+            callbacks = dict(self.callbacks)
+
+        # callbacks are run outside of lock, as they may be slow
+        for labelValues, function in callbacks.items():
+            try:
+                values[labelValues] = function()
+            # never let a broken callback take down the whole metrics page
+            except Exception:
+                continue
+
+        for labelValues, value in sorted(values.items()):
+            lines.append(f"{self.name}{formatLabels(self.labelNames, labelValues)} {formatValue(value)}")
+
+        return lines
+
+class Histogram:
+    '''
+    Distribution of observed values (e.g. latencies), optionally split by labels.
+    '''
+
+    def __init__(self, name, description, labelNames = (), buckets = defaultBuckets):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count in each bucket (+ 1 overflow bucket), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labelValues):
+        '''
+        Record a single observed value for given labels.
+        '''
+        # find bucket outside of lock
+        bucket = bisect_left(self.buckets, value)
+
+        with self.lock:
+            entry = self.values.get(labelValues)
+
+            if entry == None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[labelValues] = entry
+
+            entry[0][bucket] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labelValues):
+        '''
+        Returns context manager which observes how long its body took to run.
+        '''
+        return Timer(self, labelValues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+
+        with self.lock:
+            values = sorted((labelValues, (list(entry[0]), entry[1], entry[2])) for labelValues, entry in self.values.items())
+
+        for labelValues, (bucketCounts, total, count) in values:
+            # prometheus buckets are cumulative
+            cumulative = 0
+            for upperBound, bucketCount in zip(self.buckets + (float("inf"),), bucketCounts):
+                cumulative += bucketCount
+                labels = formatLabels(self.labelNames, labelValues, ("le", formatValue(upperBound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = formatLabels(self.labelNames, labelValues)
+            lines.append(f"{self.name}_sum{labels} {formatValue(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+
+        return lines
+
+class Timer:
+    '''
+    Context manager which observes time taken by its body in a histogram.
+    '''
+
+    def __init__(self, histogram, labelValues):
+        self.histogram = histogram
+        self.labelValues = labelValues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exceptionInfo):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelValues)
+
+def timed(histogram, *labelValues):
+    '''
+    Decorator which observes how long each call to a function takes.
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labelValues)
+        return wrapper
+    return decorator
+
+def render():
+    '''
+    Returns all metrics in Prometheus text format.
+    '''
+    lines = []
+
+    for metric in list(registry):
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
+
+# other plain text pages served alongside the metrics, path -> function taking
+# dict of query parameters & returning page text (e.g. /memory, see memory.py)
+pages = {}
+
+def addPage(path, function):
+    '''
+    Serve text returned by function (given query parameters) on path of the metrics server.
+    '''
+    pages[path] = function
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Serves rendered metrics on /metrics, and any pages added with addPage.
+    '''
+
+    def do_GET(self):
+        path, query = urlsplit(self.path)[2:4]
+
+        if path in pages:
+            try:
+                body = pages[path](dict(parse_qsl(query))).encode("utf8")
+            # e.g. a malformed query parameter
+            except ValueError as error:
+                self.send_error(400, str(error))
+                return
+            contentType = "text/plain; charset=utf-8"
+
+        elif path in ("/", "/metrics"):
+            body = render().encode("utf8")
+            contentType = "text/plain; version=0.0.4; charset=utf-8"
+
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes happen every few seconds, don't fill up the bot's log with them
+        pass
+
+def startServer(port, address = "127.0.0.1"):
+    '''
+    Serve metrics on given port from a background thread, returns server.
+    '''
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+
+    return server
+
+# ------------------------------------------------------------------------------
+# Metrics recorded by the bot
+# ------------------------------------------------------------------------------
+updates = Counter("covert_chess_updates_total", "Updates handled, by handler.", ["handler"])
+
+handlerSeconds = Histogram("covert_chess_handler_seconds", "Time taken to handle an update, by handler.", ["handler"])
+
+handlerErrors = Counter("covert_chess_handler_errors_total", "Updates which fell through to a handler's error reply, by handler.", ["handler"])
+
+codecSeconds = Histogram("covert_chess_codec_seconds", "Time spent in covert_chess functions, by function.", ["function"])
+
+botApiSeconds = Histogram("covert_chess_bot_api_seconds", "Latency of outbound Telegram Bot API calls, by method.", ["method"])
+
+botApiErrors = Counter("covert_chess_bot_api_errors_total", "Outbound Telegram Bot API calls which raised an error, by method.", ["method"])
+
+botApiConnectionWaitSeconds = Histogram("covert_chess_bot_api_connection_wait_seconds", "Time outbound Bot API calls waited for a free pooled connection.")
+
+botApiConnectionsOpened = Counter("covert_chess_bot_api_connections_opened_total", "Connections opened to the Bot API, each a new TCP (& TLS) handshake.")
+
+dispatcherQueueDepth = Gauge("covert_chess_dispatcher_queue_depth", "Updates waiting in the dispatcher queue.")
+
+def instrument(handlerName, callback):
+    '''
+    Wraps a handler callback so its updates, latency & errors are recorded.
+    '''
+    @wraps(callback)
+    def wrapper(update, context):
+        updates.inc(handlerName)
+        start = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            handlerErrors.inc(handlerName)
+            raise
+        finally:
+            handlerSeconds.observe(time.perf_counter() - start, handlerName)
+    return wrapper
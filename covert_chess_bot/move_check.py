@@ -0,0 +1,242 @@
+# ------------------------------------------------------------------------------
+# Move Check
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Checks that one position follows from another by exactly one legal move, so
+# a correspondence game can't be moved on by a mistyped (or doctored) position.
+#
+# The board must differ by one legal move of the side to move (including
+# castling, en passant & promotion), and the rest of the position must be what
+# that move leaves: the other side to move, castling rights lost by moving a
+# king or rook (or capturing a rook), the en passant square after a double
+# step, the half move clock reset by a pawn move or capture (else one more),
+# and the full move number one more after black's move.
+#
+# Only moves from & to squares which changed are tried, rather than every legal
+# move, so a check costs a handful of move generations.
+#
+# When both positions are original scheme encodings, they are compared emoji by
+# emoji and only the emoji which changed are decoded on to the previous board:
+# a move changes at most 4 of the 22 square emoji, plus the state & move
+# counter emoji. (A dense encoding is one number, so has to be decoded whole.)
+# ------------------------------------------------------------------------------
+
+from covert_chess_bot import covert_chess, framing, metrics, shadow
+from covert_chess_bot.position import Position, pawnAttacks, squareName
+
+# piece of each original scheme square value (0 empty, 1-12 pieces, in FEN letter order)
+squarePieces = [None] + list("PNBRQKpnbrqk")
+
+# positions of the state & (2) move counter emoji in an original scheme position
+STATE_EMOJI = 1 + framing.SQUARE_EMOJI
+COUNTER_EMOJI = STATE_EMOJI + 1
+
+def colourName(colour):
+    return "white" if colour == "w" else "black"
+
+def referenceDecodeChanges(previous, previousIndexes, currentIndexes):
+    '''
+    Returns FEN of original scheme emoji indexes decoded whole by the reference codec, to check decodeChanges against in shadow mode.
+    '''
+    # undecorated, so shadow comparisons aren't counted as codec calls
+    return covert_chess.decode.__wrapped__("".join(covert_chess.emojiList[index] for index in currentIndexes))
+
+@shadow.shadowed("decode_changes", referenceDecodeChanges, key=Position.fen)
+def decodeChanges(previous, previousIndexes, currentIndexes):
+    '''
+    Returns position of original scheme emoji indexes, decoding only the emoji
+    which differ from those of the previous position (whose emoji indexes are given).
+    '''
+    board = previous.board[:]
+
+    # 1st emoji is the A8 square alone
+    if currentIndexes[0] != previousIndexes[0]:
+        board[0] = squarePieces[currentIndexes[0] - covert_chess.originalSchemeFirstIndex]
+
+    # then 3 squares per emoji, each emoji shifted by a further offset
+    for i in range(framing.SQUARE_EMOJI):
+        index = currentIndexes[1 + i]
+        if index == previousIndexes[1 + i]:
+            continue
+        value = (index - i * framing.SQUARE_OFFSET) % 3178
+        square = 1 + 3 * i
+        board[square] = squarePieces[value // 169]
+        board[square + 1] = squarePieces[value // 13 % 13]
+        board[square + 2] = squarePieces[value % 13]
+
+    nextToMove, castleRights, enPassant = previous.nextToMove, previous.castleRights, previous.enPassant
+    state = currentIndexes[STATE_EMOJI]
+    if state != previousIndexes[STATE_EMOJI]:
+        nextToMove = "b" if state >= 1040 else "w"
+        castleRights = "".join(right for right, value in zip("KQkq", (520, 260, 130, 65)) if state % (2 * value) >= value)
+        # en passant value is 1 + square index, 0 for none
+        enPassant = state % 65 - 1 if state % 65 else None
+
+    halfMoves, fullMoves = previous.halfMoves, previous.fullMoves
+    counters = currentIndexes[COUNTER_EMOJI : COUNTER_EMOJI + 2]
+    if counters != previousIndexes[COUNTER_EMOJI : COUNTER_EMOJI + 2]:
+        fullMoves, halfMoves = divmod(counters[0] * 3178 + counters[1], 101)
+
+    return Position(board, nextToMove, castleRights, enPassant, halfMoves, fullMoves)
+
+def isCapturable(position):
+    '''
+    Checks if a pawn of the side to move could take en passant on the position's en passant square.
+    '''
+    if position.enPassant == None:
+        return False
+
+    pawn = "P" if position.nextToMove == "w" else "p"
+    # squares a pawn taking en passant moves from are those a pawn of the other colour on the en passant square would attack
+    attackers = pawnAttacks["b" if position.nextToMove == "w" else "w"][position.enPassant]
+
+    return any(position.board[square] == pawn for square in attackers)
+
+def findMove(previous, current):
+    '''
+    Returns (move in SAN or None, list of problems) of the move from previous
+    to current position, with no problems if it is exactly one legal move.
+    '''
+    colour = previous.nextToMove
+    changed = {square for square in range(64) if previous.board[square] != current.board[square]}
+
+    if len(changed) == 0:
+        return None, ["no piece has moved"]
+
+    # a move changes 2 squares, 3 taking en passant, 4 castling
+    after = None
+    move = None
+    if len(changed) <= 4:
+        for candidate in previous.pseudoLegalMoves():
+            if candidate[0] not in changed or candidate[1] not in changed:
+                continue
+            position = previous.push(candidate)
+            if position.board == current.board and not position.isCheck(colour):
+                move, after = candidate, position
+                break
+
+    if move == None:
+        squares = ", ".join(squareName(square) for square in sorted(changed))
+        return None, [f"the pieces on {squares} changed, which isn't one legal move by {colourName(colour)}"]
+
+    problems = []
+
+    if current.nextToMove != after.nextToMove:
+        problems.append(f"it should be {colourName(after.nextToMove)} to move, not {colourName(current.nextToMove)}")
+
+    if current.castleRights != after.castleRights:
+        problems.append(f"castling rights should be {after.castleRights or '-'}, not {current.castleRights or '-'}")
+
+    # FEN writers differ on giving the en passant square after a double step no pawn can take on
+    if current.enPassant != after.enPassant and not (current.enPassant == None and not isCapturable(after)):
+        expected = squareName(after.enPassant) if after.enPassant != None else "-"
+        given = squareName(current.enPassant) if current.enPassant != None else "-"
+        problems.append(f"en passant square should be {expected}, not {given}")
+
+    if current.halfMoves != after.halfMoves:
+        problems.append(f"half move clock should be {after.halfMoves}, not {current.halfMoves}")
+
+    if current.fullMoves != after.fullMoves:
+        problems.append(f"full move number should be {after.fullMoves}, not {current.fullMoves}")
+
+    return previous.san(move), problems
+
+def moveNumber(position, san):
+    '''
+    Returns move written with its number, e.g. "1. e4" or "1... e5".
+    '''
+    return f'{position.fullMoves}{"." if position.nextToMove == "w" else "..."} {san}'
+
+def result(previous, current, san, problems):
+    return {
+        "move": moveNumber(previous, san) if san != None else None,
+        "previous": previous.fen(),
+        "fen": current.fen(),
+        "problems": problems,
+        "legal": san != None and len(problems) == 0,
+    }
+
+@metrics.timed(metrics.codecSeconds, "check")
+def checkPositions(previousFen, currentFen):
+    '''
+    Returns dict of result of checking FEN position current follows previous by one legal move:
+        move (numbered SAN, None if no move changes the board this way),
+        previous, fen (FEN of current position), problems (list of why it isn't legal), legal
+    '''
+    previous = Position.fromFen(previousFen)
+    current = Position.fromFen(currentFen)
+
+    return result(previous, current, *findMove(previous, current))
+
+def nextFrame(indexes, start, previous = None):
+    '''
+    Returns (index after, its emoji indexes, Position) of the first valid position in emoji indexes
+    at or after start, None if there is none. If previous is given, as (emoji
+    indexes, Position), an original scheme position following an original
+    scheme previous position is decoded from the emoji which changed alone.
+    '''
+    i = start
+    while i < len(indexes):
+        length = framing.candidateLength(indexes[i])
+
+        # not the 1st emoji of a complete position
+        if length == None or i + length > len(indexes):
+            i += 1
+            continue
+
+        frame = indexes[i : i + length]
+        position = None
+
+        if previous != None and len(previous[0]) == covert_chess.originalSchemeLength == length and framing.isOriginalFrame(frame):
+            position = decodeChanges(previous[1], previous[0], frame)
+            fen = position.fen()
+            if not covert_chess.isValidFen(fen) or not framing.isPossiblePlacement(fen):
+                position = None
+        else:
+            decoded = framing.decodeFrame(frame)
+            if decoded != None:
+                position = Position.fromFen(decoded[1])
+
+        if position == None:
+            i += 1
+            continue
+
+        end = i + length
+        # resignation marker after position
+        if end < len(indexes) and indexes[end] == covert_chess.resignIndex:
+            end += 1
+
+        return end, frame, position
+
+    return None
+
+@metrics.timed(metrics.codecSeconds, "check")
+def checkEncodings(text, previousFen = None):
+    '''
+    Returns result (see checkPositions) of checking the 2nd emoji position in
+    text follows the 1st by one legal move, or if text has only one position,
+    that it follows FEN position previousFen. Raises ValueError if there aren't
+    two positions to compare.
+    '''
+    # message is split in to emoji once, for both positions
+    indexes = [covert_chess.emojiIndex(emoji) for emoji in covert_chess.findEmoji(text)]
+
+    first = nextFrame(indexes, 0)
+    if first == None:
+        raise ValueError("no emoji position")
+    end, previousIndexes, previous = first
+
+    second = nextFrame(indexes, end, (previousIndexes, previous))
+    if second == None:
+        if previousFen == None:
+            raise ValueError("only one emoji position")
+        # only position given is the current one
+        current = previous
+        previous = Position.fromFen(previousFen)
+    else:
+        current = second[2]
+
+    return result(previous, current, *findMove(previous, current))
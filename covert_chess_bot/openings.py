@@ -0,0 +1,165 @@
+# ------------------------------------------------------------------------------
+# Openings
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Recognises which opening (ECO code & name) a position is.
+# https://en.wikipedia.org/wiki/Encyclopaedia_of_Chess_Openings
+#
+# The table of openings (data/openings.tsv, ECO code / name / moves) is turned
+# in to a compact index ahead of time, so no moves need to be played through
+# while the bot is running:
+#   python3 -m covert_chess_bot.openings
+#
+# The index (data/openings.idx) holds the Zobrist key of each opening's position
+# as a sorted array of 64 bit integers, which is memory mapped and searched with
+# bisect, so recognising a position is one hash and a binary search.
+#
+# index file layout (little endian):
+#   magic "CCOI" / version (u32) / number of openings n (u32)
+#   n keys (u64), sorted
+#   n (name offset (u32), name length (u32)), in same order as keys
+#   names (utf8), "ECO name"
+# ------------------------------------------------------------------------------
+
+import mmap
+import struct
+import sys
+import threading
+from bisect import bisect_left
+from covert_chess_bot.position import Position
+
+# default file locations of opening table & the index built from it
+openingsFileLocation = "data/openings.tsv"
+indexFileLocation = "data/openings.idx"
+
+INDEX_MAGIC = b"CCOI"
+INDEX_VERSION = 1
+headerFormat = "<4sII"
+headerSize = struct.calcsize(headerFormat)
+entryFormat = "<II"
+entrySize = struct.calcsize(entryFormat)
+
+startingFen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+def openingPositions(fileLocation = None):
+    '''
+    Yields (Zobrist key, "ECO name") of position at the end of each opening in table.
+    '''
+    with open(fileLocation or openingsFileLocation, "r", encoding="utf8") as openingsFile:
+        # skip header line
+        next(openingsFile)
+
+        for lineNumber, line in enumerate(openingsFile, 2):
+            if line.strip() == "":
+                continue
+
+            eco, name, moves = line.rstrip("\n").split("\t")
+
+            position = Position.fromFen(startingFen)
+            for san in moves.split():
+                # move numbers, e.g. "1."
+                if san.endswith("."):
+                    continue
+                try:
+                    position = position.push(position.parseSan(san))
+                except ValueError as error:
+                    raise ValueError(f"line {lineNumber} ({name}): {error}")
+
+            yield position.zobristKey(), f"{eco} {name}"
+
+def buildIndex(openingsLocation = None, indexLocation = None):
+    '''
+    Build index file from opening table, returns number of openings indexed.
+    '''
+    openings = {}
+    for key, name in openingPositions(openingsLocation):
+        # openings reaching the same position by a different move order, the first listed is kept
+        openings.setdefault(key, name)
+
+    keys = sorted(openings)
+
+    names = b""
+    entries = b""
+    for key in keys:
+        name = openings[key].encode("utf8")
+        entries += struct.pack(entryFormat, len(names), len(name))
+        names += name
+
+    with open(indexLocation or indexFileLocation, "wb") as indexFile:
+        indexFile.write(struct.pack(headerFormat, INDEX_MAGIC, INDEX_VERSION, len(keys)))
+        indexFile.write(struct.pack(f"<{len(keys)}Q", *keys))
+        indexFile.write(entries)
+        indexFile.write(names)
+
+    return len(keys)
+
+class OpeningIndex:
+    '''
+    Memory mapped index of opening positions, searched by Zobrist key.
+    '''
+
+    def __init__(self, indexLocation = None):
+        with open(indexLocation or indexFileLocation, "rb") as indexFile:
+            self.map = mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count = struct.unpack_from(headerFormat, self.map, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("not an openings index, or built by a different version")
+
+        keysEnd = headerSize + 8 * self.count
+        self.entriesStart = keysEnd
+        self.namesStart = keysEnd + entrySize * self.count
+
+        # keys are read straight from the mapped file, no copy is made
+        if sys.byteorder == "little":
+            self.keys = memoryview(self.map)[headerSize:keysEnd].cast("Q")
+        else:
+            self.keys = struct.unpack_from(f"<{self.count}Q", self.map, headerSize)
+
+    def lookup(self, key):
+        '''
+        Returns "ECO name" of opening with given Zobrist key, None if it isn't an opening.
+        '''
+        i = bisect_left(self.keys, key)
+        if i == self.count or self.keys[i] != key:
+            return None
+
+        offset, length = struct.unpack_from(entryFormat, self.map, self.entriesStart + entrySize * i)
+        start = self.namesStart + offset
+
+        return self.map[start : start + length].decode("utf8")
+
+# loaded on first use
+index = None
+indexLock = threading.Lock()
+
+def openingName(fenPosition):
+    '''
+    Returns "ECO name" of opening of given FEN position, None if it isn't a known opening (or there is no index).
+    '''
+    global index
+
+    if index == None:
+        with indexLock:
+            if index == None:
+                try:
+                    index = OpeningIndex()
+                # index hasn't been built, openings just aren't recognised
+                except (OSError, ValueError):
+                    index = False
+
+    if index == False:
+        return None
+
+    try:
+        key = Position.fromFen(fenPosition).zobristKey()
+    except (ValueError, IndexError, KeyError):
+        return None
+
+    return index.lookup(key)
+
+if __name__ == "__main__":
+    print(f"indexed {buildIndex()} openings in to {indexFileLocation}")
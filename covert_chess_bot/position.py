@@ -0,0 +1,465 @@
+# ------------------------------------------------------------------------------
+# Position
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Chess rules for a position given in FEN: legal move generation, making moves,
+# reading & writing moves in standard algebraic notation (SAN), and Zobrist
+# hashing of positions.
+# https://en.wikipedia.org/wiki/Algebraic_notation_(chess)
+# https://en.wikipedia.org/wiki/Zobrist_hashing
+#
+# Squares are numbered 0 (A8) to 63 (H1), the order they appear in FEN (and in
+# both emoji encoding schemes). Moves are (from square, to square, promotion)
+# tuples, with promotion being None or a lowercase piece letter.
+# ------------------------------------------------------------------------------
+
+import random
+
+# piece letters, white uppercase & black lowercase as in FEN
+pieceLetters = "PNBRQKpnbrqk"
+
+# (row, file) steps of each kind of piece
+knightSteps = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+kingSteps = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+bishopDirections = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+rookDirections = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+def squareName(square):
+    '''
+    Returns name of square, e.g. 0 -> "a8".
+    '''
+    return "abcdefgh"[square % 8] + str(8 - square // 8)
+
+def squareIndex(name):
+    '''
+    Returns index of named square, e.g. "a8" -> 0.
+    '''
+    return (8 - int(name[1])) * 8 + "abcdefgh".index(name[0])
+
+def stepTargets(steps):
+    '''
+    Returns list (by square) of squares reachable from each square with a single one of given steps.
+    '''
+    targets = []
+    for square in range(64):
+        row, file = divmod(square, 8)
+        targets.append([(row + rowStep) * 8 + file + fileStep for rowStep, fileStep in steps
+                        if 0 <= row + rowStep < 8 and 0 <= file + fileStep < 8])
+    return targets
+
+def rayTargets(directions):
+    '''
+    Returns list (by square) of rays (lists of squares, nearest first) from each square in given directions.
+    '''
+    rays = []
+    for square in range(64):
+        row, file = divmod(square, 8)
+        squareRays = []
+        for rowStep, fileStep in directions:
+            ray = []
+            r, f = row + rowStep, file + fileStep
+            while 0 <= r < 8 and 0 <= f < 8:
+                ray.append(r * 8 + f)
+                r, f = r + rowStep, f + fileStep
+            if ray:
+                squareRays.append(ray)
+        rays.append(squareRays)
+    return rays
+
+# precomputed, so move generation is just lookups
+knightTargets = stepTargets(knightSteps)
+kingTargets = stepTargets(kingSteps)
+bishopRays = rayTargets(bishopDirections)
+rookRays = rayTargets(rookDirections)
+
+# squares a pawn of each colour on a square attacks
+pawnAttacks = {
+    "w": stepTargets([(-1, -1), (-1, 1)]),
+    "b": stepTargets([(1, -1), (1, 1)]),
+}
+
+# castling: right -> (king from, king to, rook from, rook to, squares which must be empty, squares which must not be attacked)
+castlingMoves = {
+    "K": (60, 62, 63, 61, (61, 62), (60, 61, 62)),
+    "Q": (60, 58, 56, 59, (57, 58, 59), (60, 59, 58)),
+    "k": (4, 6, 7, 5, (5, 6), (4, 5, 6)),
+    "q": (4, 2, 0, 3, (1, 2, 3), (4, 3, 2)),
+}
+
+# castling rights lost when a piece moves from / to a square
+castlingSquares = {60: "KQ", 63: "K", 56: "Q", 4: "kq", 7: "k", 0: "q"}
+
+# Zobrist keys, from a fixed seed so every process (and the openings index) agree
+zobristGenerator = random.Random(20210517)
+zobristPieceKeys = {piece: [zobristGenerator.getrandbits(64) for square in range(64)] for piece in pieceLetters}
+zobristBlackKey = zobristGenerator.getrandbits(64)
+zobristCastlingKeys = {right: zobristGenerator.getrandbits(64) for right in "KQkq"}
+zobristEnPassantKeys = [zobristGenerator.getrandbits(64) for file in range(8)]
+
+def colourOf(piece):
+    '''
+    Returns colour ("w" or "b") of a piece letter.
+    '''
+    return "w" if piece.isupper() else "b"
+
+class Position:
+    '''
+    Chess position, with the rules needed to find & make legal moves.
+    '''
+
+    def __init__(self, board, nextToMove = "w", castleRights = "", enPassant = None, halfMoves = 0, fullMoves = 1):
+        # piece letter or None for each square, A8 to H1
+        self.board = board
+        self.nextToMove = nextToMove
+        # subset of "KQkq"
+        self.castleRights = castleRights
+        # square a pawn can be captured en passant on, or None
+        self.enPassant = enPassant
+        self.halfMoves = halfMoves
+        self.fullMoves = fullMoves
+
+    @classmethod
+    def fromFen(cls, fenPosition):
+        '''
+        Returns position described by a FEN position.
+        '''
+        fields = fenPosition.split()
+        if len(fields) != 6:
+            raise ValueError("FEN position must have 6 fields")
+
+        board = []
+        for char in fields[0]:
+            if char == "/":
+                continue
+            if char in "12345678":
+                board.extend([None] * int(char))
+            elif char in pieceLetters:
+                board.append(char)
+            else:
+                raise ValueError(f"{char} is not a piece")
+        if len(board) != 64:
+            raise ValueError("FEN position must describe 64 squares")
+
+        castleRights = "".join(right for right in "KQkq" if right in fields[2])
+        enPassant = None if fields[3] == "-" else squareIndex(fields[3])
+
+        return cls(board, fields[1], castleRights, enPassant, int(fields[4]), int(fields[5]))
+
+    def fen(self):
+        '''
+        Returns FEN position of this position.
+        '''
+        ranks = []
+        for row in range(8):
+            rank = ""
+            empty = 0
+            for piece in self.board[row * 8 : (row + 1) * 8]:
+                if piece == None:
+                    empty += 1
+                else:
+                    if empty:
+                        rank += str(empty)
+                        empty = 0
+                    rank += piece
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+
+        enPassant = "-" if self.enPassant == None else squareName(self.enPassant)
+
+        return f'{"/".join(ranks)} {self.nextToMove} {self.castleRights or "-"} {enPassant} {self.halfMoves} {self.fullMoves}'
+
+    def kingSquare(self, colour):
+        '''
+        Returns square of given colour's king, None if it has no king.
+        '''
+        king = "K" if colour == "w" else "k"
+        try:
+            return self.board.index(king)
+        except ValueError:
+            return None
+
+    def isAttacked(self, square, byColour):
+        '''
+        Checks if a square is attacked by any piece of given colour.
+        '''
+        board = self.board
+
+        if byColour == "w":
+            pawn, knight, bishop, rook, queen, king = "PNBRQK"
+        else:
+            pawn, knight, bishop, rook, queen, king = "pnbrqk"
+
+        # a pawn attacks this square if this square, as a pawn of the other colour, would attack it
+        for target in pawnAttacks["b" if byColour == "w" else "w"][square]:
+            if board[target] == pawn:
+                return True
+
+        for target in knightTargets[square]:
+            if board[target] == knight:
+                return True
+
+        for target in kingTargets[square]:
+            if board[target] == king:
+                return True
+
+        for ray in bishopRays[square]:
+            for target in ray:
+                piece = board[target]
+                if piece != None:
+                    if piece == bishop or piece == queen:
+                        return True
+                    break
+
+        for ray in rookRays[square]:
+            for target in ray:
+                piece = board[target]
+                if piece != None:
+                    if piece == rook or piece == queen:
+                        return True
+                    break
+
+        return False
+
+    def isCheck(self, colour = None):
+        '''
+        Checks if given colour (by default, the side to move) is in check.
+        '''
+        colour = colour or self.nextToMove
+        kingSquare = self.kingSquare(colour)
+
+        return kingSquare != None and self.isAttacked(kingSquare, "b" if colour == "w" else "w")
+
+    def pseudoLegalMoves(self):
+        '''
+        Returns list of moves following how pieces move, which may leave own king in check.
+        '''
+        board = self.board
+        colour = self.nextToMove
+        opponent = "b" if colour == "w" else "w"
+        moves = []
+
+        for square, piece in enumerate(board):
+            if piece == None or colourOf(piece) != colour:
+                continue
+
+            kind = piece.upper()
+
+            if kind == "P":
+                forward = -8 if colour == "w" else 8
+                startRow = 6 if colour == "w" else 1
+                lastRow = 0 if colour == "w" else 7
+
+                targets = []
+                target = square + forward
+                if 0 <= target < 64 and board[target] == None:
+                    targets.append(target)
+                    # double step from starting rank
+                    if square // 8 == startRow and board[target + forward] == None:
+                        targets.append(target + forward)
+
+                for target in pawnAttacks[colour][square]:
+                    if (board[target] != None and colourOf(board[target]) == opponent) or target == self.enPassant:
+                        targets.append(target)
+
+                for target in targets:
+                    if target // 8 == lastRow:
+                        for promotion in "qrbn":
+                            moves.append((square, target, promotion))
+                    else:
+                        moves.append((square, target, None))
+
+            elif kind == "N" or kind == "K":
+                for target in (knightTargets if kind == "N" else kingTargets)[square]:
+                    if board[target] == None or colourOf(board[target]) == opponent:
+                        moves.append((square, target, None))
+
+            else:
+                rays = []
+                if kind != "R":
+                    rays += bishopRays[square]
+                if kind != "B":
+                    rays += rookRays[square]
+
+                for ray in rays:
+                    for target in ray:
+                        if board[target] == None:
+                            moves.append((square, target, None))
+                        else:
+                            if colourOf(board[target]) == opponent:
+                                moves.append((square, target, None))
+                            break
+
+        # castling, king may not castle out of, through or in to check
+        for right in (("K", "Q") if colour == "w" else ("k", "q")):
+            if right not in self.castleRights:
+                continue
+            kingFrom, kingTo, rookFrom, rookTo, empty, safe = castlingMoves[right]
+            rook = "R" if colour == "w" else "r"
+            king = "K" if colour == "w" else "k"
+            if board[kingFrom] != king or board[rookFrom] != rook:
+                continue
+            if any(board[emptySquare] != None for emptySquare in empty):
+                continue
+            if any(self.isAttacked(safeSquare, opponent) for safeSquare in safe):
+                continue
+            moves.append((kingFrom, kingTo, None))
+
+        return moves
+
+    def legalMoves(self):
+        '''
+        Returns list of legal moves in this position.
+        '''
+        colour = self.nextToMove
+        return [move for move in self.pseudoLegalMoves() if not self.push(move).isCheck(colour)]
+
+    def push(self, move):
+        '''
+        Returns position after making given move (which isn't checked for legality).
+        '''
+        fromSquare, toSquare, promotion = move
+        board = self.board[:]
+        piece = board[fromSquare]
+        captured = board[toSquare]
+        colour = self.nextToMove
+
+        board[toSquare] = piece
+        board[fromSquare] = None
+
+        enPassant = None
+
+        if piece in "Pp":
+            # en passant capture, captured pawn is behind the square moved to
+            if toSquare == self.enPassant and captured == None:
+                board[toSquare + (8 if colour == "w" else -8)] = None
+            # double step, can be captured en passant next move
+            if abs(toSquare - fromSquare) == 16:
+                enPassant = (fromSquare + toSquare) // 2
+            if promotion != None:
+                board[toSquare] = promotion.upper() if colour == "w" else promotion
+
+        # castling, move rook too
+        if piece in "Kk" and abs(toSquare - fromSquare) == 2:
+            for right, (kingFrom, kingTo, rookFrom, rookTo, empty, safe) in castlingMoves.items():
+                if kingFrom == fromSquare and kingTo == toSquare:
+                    board[rookTo] = board[rookFrom]
+                    board[rookFrom] = None
+
+        castleRights = self.castleRights
+        for square in (fromSquare, toSquare):
+            if square in castlingSquares:
+                castleRights = "".join(right for right in castleRights if right not in castlingSquares[square])
+
+        halfMoves = 0 if piece in "Pp" or captured != None else self.halfMoves + 1
+        fullMoves = self.fullMoves + 1 if colour == "b" else self.fullMoves
+
+        return Position(board, "b" if colour == "w" else "w", castleRights, enPassant, halfMoves, fullMoves)
+
+    def parseSan(self, san):
+        '''
+        Returns legal move given in standard algebraic notation (e.g. "Nf3", "exd5", "O-O", "e8=Q+").
+        '''
+        san = san.rstrip("+#!?")
+
+        if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+            kingFrom = 60 if self.nextToMove == "w" else 4
+            kingTo = kingFrom + (2 if len(san) == 3 else -2)
+            for move in self.legalMoves():
+                if move[0] == kingFrom and move[1] == kingTo and self.board[kingFrom] in "Kk":
+                    return move
+            raise ValueError(f"{san} is not legal")
+
+        promotion = None
+        if "=" in san:
+            san, promotion = san.split("=")
+            promotion = promotion.lower()
+
+        kind = san[0] if san[0] in "NBRQK" else "P"
+        if kind != "P":
+            san = san[1:]
+
+        destination = squareIndex(san[-2:])
+        # file and / or rank of moving piece, when needed to tell pieces apart
+        disambiguation = san[:-2].replace("x", "")
+
+        candidates = []
+        for move in self.legalMoves():
+            fromSquare, toSquare, movePromotion = move
+            if toSquare != destination or self.board[fromSquare].upper() != kind or movePromotion != promotion:
+                continue
+            name = squareName(fromSquare)
+            if all(char in name for char in disambiguation):
+                candidates.append(move)
+
+        if len(candidates) != 1:
+            raise ValueError(f"{san} is not legal" if len(candidates) == 0 else f"{san} is ambiguous")
+
+        return candidates[0]
+
+    def san(self, move):
+        '''
+        Returns given legal move in standard algebraic notation.
+        '''
+        fromSquare, toSquare, promotion = move
+        piece = self.board[fromSquare]
+        kind = piece.upper()
+
+        if kind == "K" and abs(toSquare - fromSquare) == 2:
+            san = "O-O" if toSquare > fromSquare else "O-O-O"
+        else:
+            capture = self.board[toSquare] != None or (kind == "P" and toSquare == self.enPassant)
+
+            if kind == "P":
+                san = (squareName(fromSquare)[0] + "x" if capture else "") + squareName(toSquare)
+                if promotion != None:
+                    san += "=" + promotion.upper()
+            else:
+                # other pieces of the same kind which could also move here (only
+                # their moves are checked for legality, rather than every move)
+                others = [other for other, target, otherPromotion in self.pseudoLegalMoves()
+                          if target == toSquare and other != fromSquare and self.board[other] == piece
+                          and not self.push((other, target, otherPromotion)).isCheck(self.nextToMove)]
+                disambiguation = ""
+                if others:
+                    if all(other % 8 != fromSquare % 8 for other in others):
+                        disambiguation = squareName(fromSquare)[0]
+                    elif all(other // 8 != fromSquare // 8 for other in others):
+                        disambiguation = squareName(fromSquare)[1]
+                    else:
+                        disambiguation = squareName(fromSquare)
+                san = kind + disambiguation + ("x" if capture else "") + squareName(toSquare)
+
+        after = self.push(move)
+        if after.isCheck():
+            san += "#" if len(after.legalMoves()) == 0 else "+"
+
+        return san
+
+    def zobristKey(self):
+        '''
+        Returns 64 bit Zobrist hash of pieces, side to move, castling rights & (capturable) en passant square.
+        '''
+        key = 0
+        for square, piece in enumerate(self.board):
+            if piece != None:
+                key ^= zobristPieceKeys[piece][square]
+
+        if self.nextToMove == "b":
+            key ^= zobristBlackKey
+
+        for right in self.castleRights:
+            key ^= zobristCastlingKeys[right]
+
+        # only when a pawn could actually capture en passant, as FEN writers differ
+        # on whether the square is given after every double step
+        if self.enPassant != None:
+            pawn = "P" if self.nextToMove == "w" else "p"
+            attackers = pawnAttacks["b" if self.nextToMove == "w" else "w"][self.enPassant]
+            if any(self.board[square] == pawn for square in attackers):
+                key ^= zobristEnPassantKeys[self.enPassant % 8]
+
+        return key
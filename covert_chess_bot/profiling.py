@@ -0,0 +1,190 @@
+# ------------------------------------------------------------------------------
+# Profiling
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Statistical profiler which captures where the time went in slow requests.
+#
+# While any update is being handled, a background thread samples the stack of
+# each handling thread every few milliseconds. When an update takes longer than
+# a threshold, its samples are written out in the collapsed stack format read by
+# flamegraph tools (e.g. flamegraph.pl, speedscope, inferno):
+#   root;caller;callee sample_count
+# Samples of updates handled within the threshold are just thrown away.
+#
+# Each file is named after the time, handler, argument size & latency of the
+# update, which are also added as root frames so they show up in the graph.
+# The oldest files are deleted to keep within a file count and size limit.
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+# default seconds an update must take before its samples are kept
+DEFAULT_THRESHOLD = 1.0
+
+# seconds between samples
+DEFAULT_INTERVAL = 0.005
+
+# default limits on files kept in profile directory
+DEFAULT_MAX_FILES = 100
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+
+# extension of written profile files
+PROFILE_EXTENSION = ".folded"
+
+def frameName(frame):
+    '''
+    Returns name of a stack frame as shown in a flamegraph.
+    '''
+    code = frame.f_code
+    # collapsed format separates frames with ; so it can't appear in a name
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+def collapseStack(frame):
+    '''
+    Returns stack of frame in collapsed format, outermost frame first.
+    '''
+    names = []
+    while frame != None:
+        names.append(frameName(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+class SlowRequestProfiler:
+    '''
+    Samples stacks of threads handling updates, keeping samples of slow updates.
+    '''
+
+    def __init__(self, directory, threshold = DEFAULT_THRESHOLD, interval = DEFAULT_INTERVAL,
+                 maxFiles = DEFAULT_MAX_FILES, maxBytes = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self.maxFiles = maxFiles
+        self.maxBytes = maxBytes
+
+        os.makedirs(directory, exist_ok=True)
+
+        # thread id -> Counter of collapsed stacks, for threads handling an update
+        self.active = {}
+        self.lock = threading.Lock()
+
+        # set while there are threads to sample
+        self.sampling = threading.Event()
+
+        self.thread = threading.Thread(target=self.samplerLoop, name="profiler", daemon=True)
+        self.thread.start()
+
+    def samplerLoop(self):
+        '''
+        Sample stacks of active threads, run by background thread.
+        '''
+        ownId = threading.get_ident()
+
+        while True:
+            # sleep until an update is being handled
+            self.sampling.wait()
+
+            frames = sys._current_frames()
+
+            with self.lock:
+                for threadId, samples in self.active.items():
+                    frame = frames.get(threadId)
+                    if frame != None and threadId != ownId:
+                        samples[collapseStack(frame)] += 1
+
+                if len(self.active) == 0:
+                    self.sampling.clear()
+
+            # don't keep frames (and everything they reference) alive while sleeping
+            del frames
+
+            time.sleep(self.interval)
+
+    def wrap(self, handlerName, callback):
+        '''
+        Wraps a handler callback so slow updates it handles are profiled.
+        '''
+        @wraps(callback)
+        def wrapper(update, context):
+            threadId = threading.get_ident()
+            samples = Counter()
+
+            with self.lock:
+                self.active[threadId] = samples
+            self.sampling.set()
+
+            start = time.perf_counter()
+            try:
+                return callback(update, context)
+            finally:
+                elapsed = time.perf_counter() - start
+
+                with self.lock:
+                    del self.active[threadId]
+
+                if elapsed >= self.threshold and len(samples) > 0:
+                    self.write(handlerName, argumentSize(update), elapsed, samples)
+
+        return wrapper
+
+    def write(self, handlerName, argumentSize, elapsed, samples):
+        '''
+        Write samples of a slow update to a collapsed stack file.
+        '''
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        milliseconds = int(elapsed * 1000)
+        fileName = f"{timestamp}-{handlerName}-{argumentSize}b-{milliseconds}ms-{threading.get_ident()}{PROFILE_EXTENSION}"
+
+        # details of update are added as root frames
+        root = f"{handlerName};argument size {argumentSize} bytes;{milliseconds} ms"
+
+        lines = [f"{root};{stack} {count}\n" for stack, count in samples.most_common()]
+
+        try:
+            with open(os.path.join(self.directory, fileName), "w", encoding="utf8") as profileFile:
+                profileFile.writelines(lines)
+            self.prune()
+        # never let profiling break handling of updates
+        except OSError:
+            pass
+
+    def prune(self):
+        '''
+        Delete oldest profile files until within file count and size limits.
+        '''
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(PROFILE_EXTENSION):
+                status = entry.stat()
+                profiles.append((status.st_mtime, entry.path, status.st_size))
+
+        # oldest first
+        profiles.sort()
+
+        totalBytes = sum(size for modified, path, size in profiles)
+
+        while profiles and (len(profiles) > self.maxFiles or totalBytes > self.maxBytes):
+            modified, path, size = profiles.pop(0)
+            os.remove(path)
+            totalBytes -= size
+
+def argumentSize(update):
+    '''
+    Returns size in bytes of text sent in an update.
+    '''
+    if update.message != None and update.message.text != None:
+        return len(update.message.text.encode("utf8"))
+
+    if update.inline_query != None:
+        return len(update.inline_query.query.encode("utf8"))
+
+    return 0
@@ -0,0 +1,348 @@
+# ------------------------------------------------------------------------------
+# Reminders
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Move reminders for correspondence games. A chat which has asked for them
+# (/remind hours) is nudged once no new position has been seen in it for that
+# many hours. Each new position in the chat pushes its reminder back again.
+#
+# Reminders are kept in a hierarchical timing wheel rather than a job or thread
+# each: 4 levels of 64 slots, a slot of the lowest level being one tick (a
+# minute), a slot of the next 64 ticks, and so on (64^4 minutes, ~31 years, in
+# total). A reminder goes in the slot of the lowest level its due time fits
+# within, and as time moves on the reminders of each higher level slot are
+# moved down a level, until they reach the lowest level & are due. Scheduling
+# & cancelling a reminder are both O(1) (a dict insert / delete), however many
+# are pending, and each reminder is moved at most 3 times before it is due.
+#
+# One background thread advances the wheel every tick, hands every reminder due
+# in that tick to be sent as one batch, and writes reminders changed since the
+# last tick to SQLite in one transaction. Reminders (and when they are due) are
+# loaded back from the database when the bot starts, so none are lost across a
+# restart, and any which came due while it was down are sent straight away.
+# ------------------------------------------------------------------------------
+
+import logging
+import math
+import sqlite3
+import threading
+import time
+from covert_chess_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# seconds per tick of the wheel, reminders are sent within a tick of being due
+TICK_SECONDS = 60
+
+# slots per level of the wheel (a power of 2), and number of levels
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_LEVELS = 4
+
+# range of hours a reminder can be set for
+MIN_HOURS = 1 / 60
+MAX_HOURS = 30 * 24
+
+remindersPending = metrics.Gauge("covert_chess_reminders_pending", "Reminders waiting to come due.")
+
+remindersSent = metrics.Counter("covert_chess_reminders_sent_total", "Due reminders handed to be sent, by result (queued or deferred when the send queue was full).", ["result"])
+
+class TimingWheel:
+    '''
+    Hierarchical timing wheel of keys due at given ticks, with O(1) schedule & cancel.
+    '''
+
+    def __init__(self, tick):
+        # current tick, every key due at or before it has been expired
+        self.tick = tick
+        # level -> slot -> {key: (due tick, value)}
+        self.levels = [[{} for slot in range(WHEEL_SLOTS)] for level in range(WHEEL_LEVELS)]
+        # key -> slot dict it is in
+        self.location = {}
+
+    def __len__(self):
+        return len(self.location)
+
+    def __contains__(self, key):
+        return key in self.location
+
+    def place(self, key, dueTick, value, now):
+        '''
+        Put key in slot for its due tick (tick now if it is already due), relative to tick now.
+        '''
+        dueTick = max(dueTick, now)
+        delta = dueTick - now
+
+        # lowest level whose span reaches due tick
+        level = 0
+        while delta >= 1 << (WHEEL_BITS * (level + 1)):
+            level += 1
+            if level == WHEEL_LEVELS:
+                raise ValueError("due too far in the future for timing wheel")
+
+        slot = self.levels[level][(dueTick >> (WHEEL_BITS * level)) & (WHEEL_SLOTS - 1)]
+        slot[key] = (dueTick, value)
+        self.location[key] = slot
+
+    def schedule(self, key, dueTick, value = None):
+        '''
+        Schedule key to be due at given tick, replacing any time it was already scheduled for.
+        '''
+        self.cancel(key)
+        # nothing can be due before the next tick
+        self.place(key, dueTick, value, self.tick + 1)
+
+    def cancel(self, key):
+        '''
+        Unschedule key, returns False if it wasn't scheduled.
+        '''
+        slot = self.location.pop(key, None)
+        if slot == None:
+            return False
+
+        del slot[key]
+        return True
+
+    def advance(self, toTick):
+        '''
+        Move wheel on to given tick, returns list of (key, value) which came due, in due order.
+        '''
+        expired = []
+
+        while self.tick < toTick:
+            nextTick = self.tick + 1
+
+            # higher level slots starting at next tick are moved down, highest
+            # first, so keys due at next tick end up in the lowest level slot
+            # expired below
+            level = 1
+            while level < WHEEL_LEVELS and nextTick & ((1 << (WHEEL_BITS * level)) - 1) == 0:
+                level += 1
+            for cascadeLevel in range(level - 1, 0, -1):
+                index = (nextTick >> (WHEEL_BITS * cascadeLevel)) & (WHEEL_SLOTS - 1)
+                slot = self.levels[cascadeLevel][index]
+                self.levels[cascadeLevel][index] = {}
+                for key, (dueTick, value) in slot.items():
+                    self.place(key, dueTick, value, nextTick)
+
+            self.tick = nextTick
+
+            # every key in lowest level slot is due at this tick
+            index = nextTick & (WHEEL_SLOTS - 1)
+            slot = self.levels[0][index]
+            if slot:
+                self.levels[0][index] = {}
+                for key, (dueTick, value) in slot.items():
+                    del self.location[key]
+                    expired.append((key, value))
+
+        return expired
+
+def formatHours(hours):
+    '''
+    Returns hours as readable text, e.g. "1 hour", "36 hours", "30 minutes".
+    '''
+    if hours < 1:
+        minutes = round(hours * 60)
+        return f'{minutes} minute{"" if minutes == 1 else "s"}'
+
+    if hours == int(hours):
+        return f'{int(hours)} hour{"" if hours == 1 else "s"}'
+
+    return f'{hours:g} hours'
+
+class ReminderStore:
+    '''
+    Reminder of each chat which has asked for one, in a timing wheel backed by SQLite.
+    Keys are (bot name, chat id), the bot name being empty unless serving several bots.
+    '''
+
+    def __init__(self, databaseLocation, deliver, tickSeconds = TICK_SECONDS, owns = None):
+        # called with list of (key, hours) of reminders due, returns keys which couldn't be sent yet
+        self.deliver = deliver
+        self.tickSeconds = tickSeconds
+
+        # single connection, only used by one thread at a time (setup, then the ticking thread)
+        self.connection = sqlite3.connect(databaseLocation, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS reminders (
+                bot TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                hours REAL NOT NULL,
+                due REAL,
+                PRIMARY KEY (bot, chat_id)
+            )
+        ''')
+        self.connection.commit()
+
+        # key -> hours, of every chat with reminders on
+        self.hours = {}
+        # key -> time due, of reminders waiting to come due (a reminder already
+        # sent isn't due again until there is a new position)
+        self.due = {}
+        # key -> latest position seen, so only a new position pushes a reminder
+        # back (kept in memory only, the first position after a restart is taken as new)
+        self.positions = {}
+        self.wheel = TimingWheel(self.currentTick())
+        # keys changed since they were last written
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+        # when several processes share the database, each only loads its own chats
+        for bot, chatId, hours, due in self.connection.execute("SELECT bot, chat_id, hours, due FROM reminders"):
+            key = (bot, chatId)
+            if owns != None and not owns(key):
+                continue
+            self.hours[key] = hours
+            if due != None:
+                self.due[key] = due
+                self.wheel.schedule(key, self.dueTick(due))
+
+        remindersPending.setFunction(lambda: len(self.wheel))
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.tickLoop, name="reminders", daemon=True)
+        self.thread.start()
+
+    def currentTick(self):
+        return int(time.time() // self.tickSeconds)
+
+    def dueTick(self, due):
+        return math.ceil(due / self.tickSeconds)
+
+    def get(self, key):
+        '''
+        Returns hours of reminders set for key, None if reminders are off.
+        '''
+        return self.hours.get(key)
+
+    def set(self, key, hours, fen = None):
+        '''
+        Turn on reminders for key (whose current position is fen, if known), the first being due in given hours.
+        '''
+        if not MIN_HOURS <= hours <= MAX_HOURS:
+            raise ValueError("reminder hours out of range")
+
+        due = time.time() + hours * 3600
+
+        with self.lock:
+            self.hours[key] = hours
+            self.positions[key] = fen
+            self.due[key] = due
+            self.wheel.schedule(key, self.dueTick(due))
+            self.dirty.add(key)
+
+    def touch(self, key, fen):
+        '''
+        Push reminder of key back to its full number of hours from now, if fen is a new position.
+        '''
+        # most chats have no reminders, checked without taking lock
+        if key not in self.hours:
+            return
+
+        with self.lock:
+            hours = self.hours.get(key)
+            # e.g. /show of the current position
+            if hours == None or self.positions.get(key) == fen:
+                return
+
+            self.positions[key] = fen
+
+            due = time.time() + hours * 3600
+            self.due[key] = due
+            self.wheel.schedule(key, self.dueTick(due))
+            self.dirty.add(key)
+
+    def cancel(self, key):
+        '''
+        Turn off reminders for key, returns False if they weren't on.
+        '''
+        with self.lock:
+            if self.hours.pop(key, None) == None:
+                return False
+
+            self.due.pop(key, None)
+            self.positions.pop(key, None)
+            self.wheel.cancel(key)
+            self.dirty.add(key)
+
+        return True
+
+    def expire(self):
+        '''
+        Move wheel on to current tick & hand every reminder due to be sent.
+        '''
+        with self.lock:
+            expired = self.wheel.advance(self.currentTick())
+
+            batch = []
+            for key, value in expired:
+                # not due again until there is a new position
+                self.due.pop(key, None)
+                self.dirty.add(key)
+                batch.append((key, self.hours[key]))
+
+        if len(batch) == 0:
+            return
+
+        deferred = self.deliver(batch) or []
+        remindersSent.inc("queued", amount=len(batch) - len(deferred))
+        remindersSent.inc("deferred", amount=len(deferred))
+
+        # send queue is full, try these again next tick
+        with self.lock:
+            for key in deferred:
+                if key in self.hours and key not in self.due:
+                    self.due[key] = time.time()
+                    self.wheel.schedule(key, self.wheel.tick + 1)
+
+    def flush(self):
+        '''
+        Write every reminder changed since the last flush in one transaction.
+        '''
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+            rows = [(key[0], key[1], self.hours.get(key), self.due.get(key)) for key in self.dirty]
+            self.dirty = set()
+
+        try:
+            with self.connection:
+                self.connection.executemany("DELETE FROM reminders WHERE bot = ? AND chat_id = ?",
+                                            [(bot, chatId) for bot, chatId, hours, due in rows if hours == None])
+                self.connection.executemany('''
+                    INSERT INTO reminders (bot, chat_id, hours, due) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(bot, chat_id) DO UPDATE SET hours = excluded.hours, due = excluded.due
+                ''', [row for row in rows if row[2] != None])
+        # mark reminders as changed again, so they are written next time
+        except sqlite3.Error:
+            with self.lock:
+                self.dirty.update((bot, chatId) for bot, chatId, hours, due in rows)
+            raise
+
+    def tickLoop(self):
+        '''
+        Send due reminders & write changed ones every tick, run by background thread.
+        '''
+        while not self.stopped.wait((self.currentTick() + 1) * self.tickSeconds - time.time()):
+            try:
+                self.expire()
+                self.flush()
+            # e.g. database locked, reminders stay marked as changed until written
+            except Exception:
+                logger.exception("reminder tick failed")
+
+    def close(self):
+        '''
+        Stop ticking, write any changed reminders, then close database.
+        '''
+        self.stopped.set()
+        self.thread.join()
+
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,320 @@
+# ------------------------------------------------------------------------------
+# Scanner
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Finds every chess position mixed in to the messages of exported chat
+# histories (telegram desktop's "Export chat history" JSON, either a single
+# chat's result.json or a full account export with many chats).
+#
+# Exports can be gigabytes, so files are read incrementally, one message at a
+# time, never as a whole. Messages are handed in batches to a pool of worker
+# processes, which find the emoji in them with an Aho-Corasick automaton built
+# from the emoji table. The emoji of each chat are then searched, in order and
+# across message boundaries (a position may be split over several messages),
+# for valid position frames (see framing.py), which are output as JSON lines, e.g.
+#   {"file": "result.json", "chat_id": 1, "message_ids": [10, 11], "scheme": "original", "fen": "...", "resigned": false}
+#
+# usage (from the root folder of this repository):
+#   python3 -m covert_chess_bot.scanner result.json [more.json ...] [--workers N] [--output found.jsonl]
+# ------------------------------------------------------------------------------
+
+import argparse
+import json
+import multiprocessing
+import re
+import sys
+from collections import deque
+from covert_chess_bot import covert_chess, framing
+from covert_chess_bot.emoji_automaton import EmojiAutomaton
+
+# characters read from an export at a time
+READ_SIZE = 1024 * 1024
+
+# messages handed to a worker at a time
+BATCH_SIZE = 2000
+
+# start of a chat's list of messages, and a chat's id, in an export
+messagesPattern = re.compile(r'"messages"\s*:\s*\[')
+idPattern = re.compile(r'"id"\s*:\s*(-?\d+)')
+
+# built once per worker process
+automaton = None
+
+def readMessages(fileLocation, readSize = READ_SIZE):
+    '''
+    Yields (chat id, message dict) for every message in an exported chat history, reading it incrementally.
+    '''
+    decoder = json.JSONDecoder()
+
+    with open(fileLocation, "r", encoding="utf8") as exportFile:
+        buffer = ""
+        position = 0
+        endOfFile = False
+        inMessages = False
+        chatId = None
+
+        def readMore():
+            nonlocal buffer, position, endOfFile
+            chunk = exportFile.read(readSize)
+            if chunk == "":
+                endOfFile = True
+            # drop what has already been parsed
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        while True:
+            # between chats, looking for the next chat's messages
+            if not inMessages:
+                match = messagesPattern.search(buffer, position)
+
+                if match == None:
+                    if endOfFile:
+                        return
+                    # keep the end, a match (or id) could be split over the next read
+                    # (only cut after a comma, so a chat's id is never cut in half)
+                    cut = max(position, buffer.rfind(",", position, len(buffer) - 64))
+                    chatId = lastChatId(buffer[position:cut], chatId)
+                    position = cut
+                    readMore()
+                    continue
+
+                # a chat's id comes before its messages
+                chatId = lastChatId(buffer[position:match.start()], chatId)
+                position = match.end()
+                inMessages = True
+                continue
+
+            # skip separators between messages
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+
+            if position == len(buffer):
+                if endOfFile:
+                    raise ValueError(f"{fileLocation} ends part way through a list of messages")
+                readMore()
+                continue
+
+            # end of this chat's messages
+            if buffer[position] == "]":
+                position += 1
+                inMessages = False
+                continue
+
+            try:
+                message, end = decoder.raw_decode(buffer, position)
+            # message continues in the part of the file not read yet
+            except json.JSONDecodeError:
+                if endOfFile:
+                    raise
+                readMore()
+                continue
+
+            position = end
+            yield chatId, message
+
+def lastChatId(text, chatId):
+    '''
+    Returns last chat id given in a part of an export, or given chat id if there is none.
+    '''
+    ids = idPattern.findall(text)
+
+    return int(ids[-1]) if ids else chatId
+
+def messageText(message):
+    '''
+    Returns all text of an exported message, including text of links, formatting etc.
+    '''
+    text = message.get("text", "")
+
+    # formatted messages are a list of plain strings & entity dicts
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+    return text
+
+def batches(messages, batchSize = BATCH_SIZE):
+    '''
+    Yields lists of (chat id, message id, text) of messages which could contain emoji.
+    '''
+    batch = []
+
+    for chatId, message in messages:
+        text = messageText(message)
+
+        # emoji are never ascii, so most messages are skipped without a worker seeing them
+        if text.isascii():
+            continue
+
+        batch.append((chatId, message.get("id"), text))
+
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def startWorker():
+    '''
+    Build automaton, run once in each worker process.
+    '''
+    global automaton
+    automaton = EmojiAutomaton(covert_chess.emojiIndexes)
+
+def findBatchEmoji(batch):
+    '''
+    Returns list of (chat id, message id, emoji indexes) of messages in batch with any emoji, run by workers.
+    '''
+    if automaton == None:
+        startWorker()
+
+    found = []
+    for chatId, messageId, text in batch:
+        indexes = automaton.findAll(text)
+        if indexes:
+            found.append((chatId, messageId, indexes))
+
+    return found
+
+class PositionFinder:
+    '''
+    Finds positions in the emoji of one chat, fed in order, across message boundaries.
+    '''
+
+    def __init__(self, chatId):
+        self.chatId = chatId
+        # (emoji index, message id) not yet ruled out of being part of a position
+        self.tokens = deque()
+
+    def add(self, messageId, indexes):
+        '''
+        Add emoji of next message, returns list of positions now found.
+        '''
+        self.tokens.extend((index, messageId) for index in indexes)
+
+        return self.search(endOfChat=False)
+
+    def finish(self):
+        '''
+        No more messages in chat, returns list of any remaining positions found.
+        '''
+        return self.search(endOfChat=True)
+
+    def search(self, endOfChat):
+        '''
+        Returns positions found at the start of tokens, dropping tokens which can't start one.
+        '''
+        tokens = self.tokens
+        positions = []
+
+        while tokens:
+            length = framing.candidateLength(tokens[0][0])
+
+            # can't be the 1st emoji of a position
+            if length == None:
+                tokens.popleft()
+                continue
+
+            # wait for rest of position (and a possible resignation marker after it)
+            if len(tokens) <= length and not endOfChat:
+                break
+
+            if len(tokens) < length:
+                tokens.popleft()
+                continue
+
+            candidate = [tokens[i] for i in range(length)]
+            position = self.decodeCandidate(candidate)
+
+            # just emoji which happen to start like a position, try again from the next emoji
+            if position == None:
+                tokens.popleft()
+                continue
+
+            for i in range(length):
+                tokens.popleft()
+
+            # resignation marker after position
+            if tokens and tokens[0][0] == covert_chess.resignIndex:
+                position["resigned"] = True
+                position["message_ids"] = sorted(set(position["message_ids"]) | {tokens[0][1]})
+                tokens.popleft()
+
+            positions.append(position)
+
+        return positions
+
+    def decodeCandidate(self, candidate):
+        '''
+        Returns dict of position encoded by candidate (emoji index, message id) list, None if it isn't a plausible position.
+        '''
+        frame = framing.decodeFrame([index for index, messageId in candidate])
+        if frame == None:
+            return None
+
+        scheme, fen = frame
+
+        return {
+            "chat_id": self.chatId,
+            "message_ids": sorted(set(messageId for index, messageId in candidate)),
+            "scheme": scheme,
+            "fen": fen,
+            "resigned": False,
+        }
+
+def scanFile(fileLocation, pool = None, batchSize = BATCH_SIZE):
+    '''
+    Yields dict of every position found in an exported chat history, in order.
+    '''
+    messageBatches = batches(readMessages(fileLocation), batchSize)
+
+    # batches are processed in parallel, but results come back in file order
+    if pool != None:
+        results = pool.imap(findBatchEmoji, messageBatches)
+    else:
+        results = map(findBatchEmoji, messageBatches)
+
+    finders = {}
+
+    for found in results:
+        for chatId, messageId, indexes in found:
+            finder = finders.get(chatId)
+            if finder == None:
+                finder = finders[chatId] = PositionFinder(chatId)
+
+            for position in finder.add(messageId, indexes):
+                position["file"] = fileLocation
+                yield position
+
+    for finder in finders.values():
+        for position in finder.finish():
+            position["file"] = fileLocation
+            yield position
+
+def main():
+    parser = argparse.ArgumentParser(description="Find every chess position mixed in to exported telegram chat histories.")
+    parser.add_argument("files", nargs="+", help="exported chat history JSON files (result.json)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="worker processes finding emoji")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="messages handed to a worker at a time")
+    parser.add_argument("--output", default=None, help="file to write found positions to (default: stdout)")
+    arguments = parser.parse_args()
+
+    output = open(arguments.output, "w", encoding="utf8") if arguments.output else sys.stdout
+
+    found = 0
+    with multiprocessing.Pool(arguments.workers, initializer=startWorker) as pool:
+        for fileLocation in arguments.files:
+            for position in scanFile(fileLocation, pool, arguments.batch_size):
+                output.write(json.dumps(position, ensure_ascii=False) + "\n")
+                found += 1
+
+    if output is not sys.stdout:
+        output.close()
+
+    print(f"found {found} positions", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+# ------------------------------------------------------------------------------
+# Send Queue
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Schedules all outbound messages so the bot stays within Telegram's flood
+# limits, rather than every handler sending straight away and being slowed down
+# by 429 (Too Many Requests) errors and their retries.
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+#
+# - a global token bucket limits messages per second across all chats
+# - a token bucket per chat limits messages per second to any one chat
+#   (with a lower rate for groups, which are limited per minute)
+# - chats waiting to send are served in priority order, so interactive replies
+#   are sent before bulk messages (e.g. reminders)
+# - a 429 response pauses only the chat it was for, for the time telegram asks
+# - when too many messages are queued, callers are blocked until the queue has
+#   drained, which pushes back on the dispatcher instead of queueing forever
+# ------------------------------------------------------------------------------
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from covert_chess_bot import metrics
+
+from telegram.error import RetryAfter
+
+# priorities messages can be sent with, lower values are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+# telegram allows ~30 messages per second overall, ~1 per second to a chat and
+# 20 per minute to a group, rates here are kept a little below these limits
+GLOBAL_RATE = 25
+GLOBAL_BURST = 25
+CHAT_RATE = 1
+CHAT_BURST = 2
+GROUP_RATE = 20 / 60
+GROUP_BURST = 2
+
+# queue sizes at which backpressure starts / stops being applied
+HIGH_WATERMARK = 1000
+LOW_WATERMARK = 500
+
+# default number of threads sending messages
+SENDERS = 4
+
+queueDepth = metrics.Gauge("covert_chess_send_queue_depth", "Outbound messages waiting to be sent.")
+
+queueSeconds = metrics.Histogram("covert_chess_send_queue_seconds", "Time outbound messages spent waiting in the send queue, by priority.", ["priority"])
+
+sendResults = metrics.Counter("covert_chess_sends_total", "Outbound messages sent through the send queue, by result.", ["result"])
+
+backpressureSeconds = metrics.Histogram("covert_chess_send_backpressure_seconds", "Time callers were blocked by a full send queue.")
+
+class TokenBucket:
+    '''
+    Allows an average of `rate` events per second, with bursts of up to `burst`.
+    '''
+
+    def __init__(self, rate, burst, now = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now == None else now
+
+    def refill(self, now):
+        '''
+        Add tokens accumulated since the bucket was last updated.
+        '''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def waitTime(self, now):
+        '''
+        Returns seconds until a token is available (0 if one is available now).
+        '''
+        self.refill(now)
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        '''
+        Use up a token, returns False if none were available.
+        '''
+        if self.waitTime(now) > 0:
+            return False
+
+        self.tokens -= 1
+        return True
+
+class SendJob:
+    '''
+    A single queued call to the Bot API.
+    '''
+
+    def __init__(self, chatId, function, args, kwargs, priority, sequence):
+        self.chatId = chatId
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.sequence = sequence
+        self.queued = time.monotonic()
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+class ChatState:
+    '''
+    Messages waiting to be sent to a single chat, and that chat's rate limit.
+    '''
+
+    def __init__(self, chatId, now):
+        # negative chat ids are groups / channels, which have a lower limit
+        if chatId < 0:
+            self.bucket = TokenBucket(GROUP_RATE, GROUP_BURST, now)
+        else:
+            self.bucket = TokenBucket(CHAT_RATE, CHAT_BURST, now)
+
+        # heap of jobs, highest priority first then in order they were queued
+        self.jobs = []
+
+        # time before which nothing may be sent to this chat (after a 429)
+        self.blockedUntil = 0
+
+        # True while a sender thread is sending a message to this chat
+        self.sending = False
+
+    def waitTime(self, now):
+        '''
+        Returns seconds until next message can be sent to this chat.
+        '''
+        return max(self.blockedUntil - now, self.bucket.waitTime(now))
+
+class SendQueue:
+    '''
+    Rate limited, prioritised queue of outbound Bot API calls, sent by a small
+    pool of sender threads.
+    '''
+
+    def __init__(self, bot, senders = SENDERS, globalRate = GLOBAL_RATE, globalBurst = GLOBAL_BURST,
+                 highWatermark = HIGH_WATERMARK, lowWatermark = LOW_WATERMARK):
+        self.bot = bot
+        self.globalBucket = TokenBucket(globalRate, globalBurst)
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+
+        # chat id -> ChatState, for chats with messages queued or being sent
+        self.chats = {}
+
+        # heap of (priority, sequence, chat id) for chats which could send now
+        self.ready = []
+
+        # heap of (time, sequence, chat id) for chats waiting on their rate limit
+        self.waiting = []
+
+        # number of jobs queued but not yet sent
+        self.depth = 0
+
+        # True while callers are being held back until queue drains
+        self.congested = False
+
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.drained = threading.Condition(self.condition)
+        self.running = True
+
+        queueDepth.setFunction(lambda: self.depth)
+
+        self.threads = []
+        for i in range(senders):
+            thread = threading.Thread(target=self.senderLoop, name=f"send-queue-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, chatId, function, *args, priority = PRIORITY_INTERACTIVE, block = True, **kwargs):
+        '''
+        Queue a call of function(*args, **kwargs) which sends something to given chat.
+        Returns a Future of its result, or None if the queue is full and block is False.
+        '''
+        with self.condition:
+            # backpressure, wait until enough queued messages have been sent
+            if self.congested or self.depth >= self.highWatermark:
+                self.congested = True
+
+                if not block:
+                    sendResults.inc("rejected")
+                    return None
+
+                start = time.monotonic()
+                while self.congested and self.running:
+                    self.drained.wait()
+                backpressureSeconds.observe(time.monotonic() - start)
+
+            job = self.queueJob(chatId, function, args, kwargs, priority, time.monotonic())
+
+            self.condition.notify_all()
+
+        return job.future
+
+    def queueJob(self, chatId, function, args, kwargs, priority, now):
+        '''
+        Add a job to its chat's queue, returns it, must hold lock.
+        '''
+        job = SendJob(chatId, function, args, kwargs, priority, next(self.sequence))
+
+        chat = self.chats.get(chatId)
+        if chat == None:
+            chat = ChatState(chatId, now)
+            self.chats[chatId] = chat
+
+        previousHead = chat.jobs[0] if chat.jobs else None
+        heapq.heappush(chat.jobs, job)
+        self.depth += 1
+
+        # chat only needs scheduling if this job is now at the front of it
+        # (otherwise it's already scheduled, or is being sent to right now)
+        if (not chat.sending) and (previousHead == None or job < previousHead):
+            self.schedule(chat, now)
+
+        return job
+
+    def send(self, chatId, text, priority = PRIORITY_INTERACTIVE, block = True, **kwargs):
+        '''
+        Queue a text message to given chat, returns a Future of the sent Message.
+        '''
+        return self.submit(chatId, self.bot.send_message, chatId, text, priority=priority, block=block, **kwargs)
+
+    def sendMany(self, messages, priority = PRIORITY_BULK):
+        '''
+        Queue a batch of (chat id, text) messages at once without ever waiting,
+        returns list of a Future of each sent Message, None for those not queued
+        because the queue is full.
+        '''
+        futures = []
+
+        with self.condition:
+            now = time.monotonic()
+
+            for chatId, text in messages:
+                if self.congested or self.depth >= self.highWatermark:
+                    self.congested = True
+                    sendResults.inc("rejected")
+                    futures.append(None)
+                    continue
+
+                futures.append(self.queueJob(chatId, self.bot.send_message, (chatId, text), {}, priority, now).future)
+
+            self.condition.notify_all()
+
+        return futures
+
+    def schedule(self, chat, now):
+        '''
+        Put chat with queued jobs on ready or waiting heap, must hold lock.
+        '''
+        head = chat.jobs[0]
+        wait = chat.waitTime(now)
+
+        # heap entries can become stale when a chat is rescheduled, they are
+        # checked against chat's current front job when popped
+        if wait <= 0:
+            heapq.heappush(self.ready, (head.priority, head.sequence, head.chatId))
+        else:
+            heapq.heappush(self.waiting, (now + wait, head.sequence, head.chatId))
+
+    def nextJob(self):
+        '''
+        Wait for and return next job which can be sent within rate limits.
+        '''
+        with self.condition:
+            while self.running:
+                now = time.monotonic()
+
+                # move chats whose rate limit has expired to ready heap
+                while self.waiting and self.waiting[0][0] <= now:
+                    wakeTime, sequence, chatId = heapq.heappop(self.waiting)
+                    chat = self.chats.get(chatId)
+                    if chat != None and chat.jobs and (not chat.sending) and chat.jobs[0].sequence == sequence:
+                        self.schedule(chat, now)
+
+                # drop stale entries from front of ready heap
+                while self.ready:
+                    priority, sequence, chatId = self.ready[0]
+                    chat = self.chats.get(chatId)
+                    if chat != None and chat.jobs and (not chat.sending) and chat.jobs[0].sequence == sequence:
+                        break
+                    heapq.heappop(self.ready)
+
+                # work out how long to sleep for if nothing can be sent yet
+                if self.ready:
+                    timeout = self.globalBucket.waitTime(now)
+                    if timeout <= 0:
+                        break
+                elif self.waiting:
+                    timeout = self.waiting[0][0] - now
+                else:
+                    timeout = None
+
+                self.condition.wait(timeout)
+            else:
+                return None
+
+            priority, sequence, chatId = heapq.heappop(self.ready)
+            chat = self.chats[chatId]
+            job = heapq.heappop(chat.jobs)
+
+            self.globalBucket.take(now)
+            chat.bucket.take(now)
+            chat.sending = True
+
+            return job
+
+    def finishJob(self, job, retryAfter = None):
+        '''
+        Record that a job has been attempted, requeueing it if told to retry.
+        '''
+        with self.condition:
+            now = time.monotonic()
+            chat = self.chats[job.chatId]
+            chat.sending = False
+
+            if retryAfter != None:
+                # put job back at front of its chat, and pause that chat only
+                chat.blockedUntil = now + retryAfter
+                heapq.heappush(chat.jobs, job)
+            else:
+                self.depth -= 1
+
+            if chat.jobs:
+                self.schedule(chat, now)
+            else:
+                # no need to keep state for idle chats
+                del self.chats[job.chatId]
+
+            # release callers held back by backpressure
+            if self.congested and self.depth <= self.lowWatermark:
+                self.congested = False
+                self.drained.notify_all()
+
+            self.condition.notify_all()
+
+    def senderLoop(self):
+        '''
+        Repeatedly send next job, run by each sender thread.
+        '''
+        while True:
+            job = self.nextJob()
+
+            if job == None:
+                return
+
+            try:
+                result = job.function(*job.args, **job.kwargs)
+
+            # flood limit hit anyway (e.g. limits shared with another process)
+            except RetryAfter as error:
+                sendResults.inc("retry_after")
+                self.finishJob(job, retryAfter=error.retry_after)
+                continue
+
+            except Exception as error:
+                sendResults.inc("error")
+                queueSeconds.observe(time.monotonic() - job.queued, str(job.priority))
+                self.finishJob(job)
+                job.future.set_exception(error)
+                continue
+
+            sendResults.inc("sent")
+            queueSeconds.observe(time.monotonic() - job.queued, str(job.priority))
+            self.finishJob(job)
+            job.future.set_result(result)
+
+    def join(self, timeout = None):
+        '''
+        Wait until every queued job has been sent, returns False on timeout.
+        '''
+        deadline = None if timeout == None else time.monotonic() + timeout
+
+        with self.condition:
+            while self.depth > 0:
+                remaining = None if deadline == None else deadline - time.monotonic()
+                if remaining != None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+        return True
+
+    def stop(self):
+        '''
+        Stop sender threads, anything still queued is not sent.
+        '''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+            self.drained.notify_all()
+
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,214 @@
+# ------------------------------------------------------------------------------
+# Sessions
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Remembers the current position of the game being played in each chat, so
+# commands can be used without re-sending the whole emoji encoding each turn.
+#
+# Sessions are stored in SQLite (in WAL mode, so reads are never blocked by a
+# write) behind an in-memory write-behind cache. Reads are served from the
+# cache, and changed sessions are written to the database in batches by a
+# background thread rather than with one synchronous write per message.
+# ------------------------------------------------------------------------------
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from covert_chess_bot import metrics
+
+# seconds between writes of changed sessions to the database
+FLUSH_INTERVAL = 2
+
+# number of changed sessions which triggers a write before the interval is up
+FLUSH_BATCH_SIZE = 200
+
+# maximum number of sessions kept in memory (changed sessions are always kept until written)
+CACHE_SIZE = 10000
+
+cacheLookups = metrics.Counter("covert_chess_session_cache_lookups_total", "Session lookups, by whether they were served from memory.", ["result"])
+
+flushSeconds = metrics.Histogram("covert_chess_session_flush_seconds", "Time taken to write a batch of changed sessions to the database.")
+
+flushedSessions = metrics.Counter("covert_chess_session_writes_total", "Sessions written to the database.")
+
+class Session:
+    '''
+    Current position of the game being played in a chat.
+    '''
+
+    def __init__(self, chatId, fen, encoding, updated = None):
+        self.chatId = chatId
+        self.fen = fen
+        self.encoding = encoding
+        self.updated = time.time() if updated == None else updated
+
+class SessionStore:
+    '''
+    Per chat sessions, in SQLite behind a write-behind cache.
+    '''
+
+    def __init__(self, databaseLocation, flushInterval = FLUSH_INTERVAL, batchSize = FLUSH_BATCH_SIZE, cacheSize = CACHE_SIZE):
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        self.cacheSize = cacheSize
+
+        # single connection shared by all threads, access is serialised by lock
+        self.connection = sqlite3.connect(databaseLocation, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # safe with WAL, database can't be corrupted, at worst the last batch is lost on power loss
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                chat_id INTEGER PRIMARY KEY,
+                fen TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+        ''')
+        self.connection.commit()
+        self.databaseLock = threading.Lock()
+
+        # chat id -> Session, least recently used first
+        self.cache = OrderedDict()
+        # chat ids of sessions changed since they were last written
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+        self.flushRequested = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.flushLoop, name="session-writer", daemon=True)
+        self.thread.start()
+
+    def get(self, chatId):
+        '''
+        Returns session of given chat, or None if it has no session.
+        '''
+        with self.lock:
+            session = self.cache.get(chatId)
+            if session != None:
+                self.cache.move_to_end(chatId)
+                cacheLookups.inc("hit")
+                return session
+
+        cacheLookups.inc("miss")
+
+        with self.databaseLock:
+            row = self.connection.execute("SELECT fen, encoding, updated FROM sessions WHERE chat_id = ?", (chatId,)).fetchone()
+
+        if row == None:
+            return None
+
+        session = Session(chatId, row[0], row[1], row[2])
+
+        with self.lock:
+            # may have been set by another thread while reading
+            if chatId in self.cache:
+                return self.cache[chatId]
+            self.cache[chatId] = session
+            self.evict()
+
+        return session
+
+    def set(self, chatId, fen, encoding):
+        '''
+        Set current position of given chat, written to database later.
+        '''
+        session = Session(chatId, fen, encoding)
+
+        with self.lock:
+            self.cache[chatId] = session
+            self.cache.move_to_end(chatId)
+            self.dirty.add(chatId)
+            self.evict()
+
+            if len(self.dirty) >= self.batchSize:
+                self.flushRequested.set()
+
+        return session
+
+    def evict(self, size = None):
+        '''
+        Remove least recently used unchanged sessions until cache is no bigger than size (cache size by default), must hold lock.
+        '''
+        excess = len(self.cache) - (self.cacheSize if size == None else size)
+        if excess <= 0:
+            return
+
+        victims = []
+        for chatId in self.cache:
+            if len(victims) >= excess:
+                break
+            if chatId not in self.dirty:
+                victims.append(chatId)
+
+        for chatId in victims:
+            del self.cache[chatId]
+
+    def shrink(self):
+        '''
+        Halve number of cached sessions, e.g. when short of memory (changed sessions are kept until written).
+        '''
+        with self.lock:
+            self.evict(len(self.cache) // 2)
+
+    def flush(self):
+        '''
+        Write all changed sessions to database in a single transaction.
+        '''
+        # sessions stay marked as changed (so are never evicted) until written, as
+        # a session evicted before its write is committed would be read back stale
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+            sessions = [self.cache[chatId] for chatId in self.dirty]
+
+        rows = [(session.chatId, session.fen, session.encoding, session.updated) for session in sessions]
+
+        start = time.perf_counter()
+
+        with self.databaseLock:
+            with self.connection:
+                self.connection.executemany('''
+                    INSERT INTO sessions (chat_id, fen, encoding, updated) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET fen = excluded.fen, encoding = excluded.encoding, updated = excluded.updated
+                ''', rows)
+
+        with self.lock:
+            for session in sessions:
+                # unless changed again while being written, which is written next time
+                if self.cache.get(session.chatId) is session:
+                    self.dirty.discard(session.chatId)
+
+        flushSeconds.observe(time.perf_counter() - start)
+        flushedSessions.inc(amount=len(rows))
+
+    def flushLoop(self):
+        '''
+        Periodically write changed sessions, run by background thread.
+        '''
+        while self.running:
+            self.flushRequested.wait(self.flushInterval)
+            self.flushRequested.clear()
+
+            try:
+                self.flush()
+            # keep trying, sessions stay marked as changed until written
+            except sqlite3.Error:
+                time.sleep(self.flushInterval)
+
+    def close(self):
+        '''
+        Write any changed sessions, then close database.
+        '''
+        self.running = False
+        self.flushRequested.set()
+        self.thread.join()
+
+        self.flush()
+
+        with self.databaseLock:
+            self.connection.close()
@@ -0,0 +1,269 @@
+# ------------------------------------------------------------------------------
+# Shadow
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Shadow mode, checking faster codec paths against the reference codec
+# (covert_chess.encode / decode) on real traffic, before relying on them.
+#
+# A fast path is decorated with shadowed(operation, reference), reference
+# being a function taking the same arguments which works out the same result
+# the slow, obvious way. While shadow mode is on, a sample of calls to the fast
+# path are timed, then handed (arguments, result & time taken) to a background
+# thread, which runs the reference on the same arguments & compares results.
+# The caller only pays for timing the call & putting it on a queue, however
+# slow the reference is. If the queue is full, the comparison is dropped rather
+# than the caller being held up.
+#
+# Mismatches are written with their arguments to a file, as a line of JSON
+# each, until it reaches MAX_MISMATCH_BYTES. Time spent in each path, and how
+# many times faster the fast path is than the reference, are in the metrics.
+#
+# Shadowed paths:
+#   encode_dense    covert_chess.encodeDense, when turned on for new encodings, compared by
+#                   decoding it again against a round trip through the
+#                   original scheme (the two schemes give different emoji)
+#   decode_frame    framing.decodeFrame, positions found by the bot, the codec
+#                   server & the streaming decoder, from emoji table indexes
+#   decode_changes  move_check.decodeChanges, decoding only the emoji which
+#                   changed since the previous position
+# (decodes are only compared when they decoded a position, as the fast paths
+# reject positions which couldn't be real before decoding them, which the
+# reference doesn't)
+#
+# On shutdown, stop() makes the comparisons already queued before returning,
+# so none are lost part way through.
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from functools import wraps
+from covert_chess_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# comparisons waiting for the background thread, beyond which new ones are dropped
+QUEUE_SIZE = 1000
+
+# bytes of mismatches written to the mismatch file, after which more are only counted
+MAX_MISMATCH_BYTES = 1024 * 1024
+
+# longest argument or result written to the mismatch file, in characters
+MAX_VALUE_LENGTH = 2000
+
+# seconds to wait on shutdown for comparisons already queued to be made
+STOP_TIMEOUT = 10
+
+shadowComparisons = metrics.Counter("covert_chess_shadow_comparisons_total", "Sampled fast codec path calls compared with the reference codec, by operation & result (match, mismatch, error or dropped).", ["operation", "result"])
+
+shadowSeconds = metrics.Histogram("covert_chess_shadow_seconds", "Seconds taken by sampled calls, by operation & path (active or reference).", ["operation", "path"])
+
+shadowSpeedup = metrics.Gauge("covert_chess_shadow_speedup", "Times faster the active path is than the reference, over every sampled call, by operation.", ["operation"])
+
+def describe(value):
+    '''
+    Returns value to write to the mismatch file, its repr (shortened to MAX_VALUE_LENGTH) if it isn't JSON or is too long.
+    '''
+    try:
+        if len(json.dumps(value, ensure_ascii=False)) <= MAX_VALUE_LENGTH:
+            return value
+    except (TypeError, ValueError):
+        pass
+
+    text = repr(value)
+    if len(text) > MAX_VALUE_LENGTH:
+        return text[:MAX_VALUE_LENGTH] + "..."
+
+    return text
+
+class ShadowRunner:
+    '''
+    Compares a sample of fast path results with the reference codec, on a background thread.
+    '''
+
+    def __init__(self, sampleRate, mismatchFile = None, maxMismatchBytes = MAX_MISMATCH_BYTES, queueSize = QUEUE_SIZE):
+        # fraction (0-1) of calls compared
+        self.sampleRate = sampleRate
+        self.mismatchFile = mismatchFile
+        self.maxMismatchBytes = maxMismatchBytes
+        self.mismatchBytes = os.path.getsize(mismatchFile) if mismatchFile and os.path.exists(mismatchFile) else 0
+
+        # (operation, reference, key, arguments, keyword arguments, result, seconds), None to stop
+        self.queue = queue.Queue(maxsize=queueSize)
+
+        # operation -> [total active seconds, total reference seconds], only used by the background thread
+        self.totals = {}
+        # operations a mismatch has been logged for, later ones are only counted & written to the mismatch file
+        self.logged = set()
+
+        self.thread = threading.Thread(target=self.compareLoop, name="shadow", daemon=True)
+        self.thread.start()
+
+    def sampled(self):
+        '''
+        Checks if this call should be compared.
+        '''
+        return random.random() < self.sampleRate
+
+    def submit(self, operation, reference, key, args, kwargs, result, seconds):
+        '''
+        Queue a fast path result to be compared with the reference, dropping it if the queue is full.
+        '''
+        try:
+            self.queue.put_nowait((operation, reference, key, args, kwargs, result, seconds))
+        except queue.Full:
+            shadowComparisons.inc(operation, "dropped")
+
+    def compareLoop(self):
+        '''
+        Run reference for each queued result & compare, run by background thread.
+        '''
+        while True:
+            item = self.queue.get()
+            if item == None:
+                self.queue.task_done()
+                return
+
+            try:
+                self.compare(*item)
+            # never let one failed comparison stop the rest
+            except Exception:
+                logger.exception("shadow comparison failed")
+            finally:
+                self.queue.task_done()
+
+    def compare(self, operation, reference, key, args, kwargs, result, seconds):
+        '''
+        Run reference on the arguments a fast path was called with, and record whether its result is the same.
+        '''
+        if key != None:
+            result = key(result)
+
+        start = time.perf_counter()
+        try:
+            expected = reference(*args, **kwargs)
+        except Exception as error:
+            shadowComparisons.inc(operation, "error")
+            self.record(operation, args, kwargs, result, f"{type(error).__name__}: {error}")
+            return
+        referenceSeconds = time.perf_counter() - start
+
+        shadowSeconds.observe(seconds, operation, "active")
+        shadowSeconds.observe(referenceSeconds, operation, "reference")
+
+        totals = self.totals.setdefault(operation, [0.0, 0.0])
+        totals[0] += seconds
+        totals[1] += referenceSeconds
+        if totals[0] > 0:
+            shadowSpeedup.set(totals[1] / totals[0], operation)
+
+        if result == expected:
+            shadowComparisons.inc(operation, "match")
+            return
+
+        shadowComparisons.inc(operation, "mismatch")
+        if operation not in self.logged:
+            self.logged.add(operation)
+            logger.warning("shadow %s mismatch: active %r, reference %r (further mismatches are only counted & written to %s)",
+                           operation, result, expected, self.mismatchFile)
+        self.record(operation, args, kwargs, result, expected)
+
+    def record(self, operation, args, kwargs, result, expected):
+        '''
+        Write a mismatch to the mismatch file, unless it is full.
+        '''
+        if not self.mismatchFile:
+            return
+
+        line = json.dumps({
+            "time": time.time(),
+            "operation": operation,
+            "args": [describe(argument) for argument in args],
+            "kwargs": {name: describe(value) for name, value in kwargs.items()},
+            "active": describe(result),
+            "reference": describe(expected),
+        }, ensure_ascii=False) + "\n"
+        size = len(line.encode("utf8"))
+
+        if self.mismatchBytes + size > self.maxMismatchBytes:
+            return
+
+        with open(self.mismatchFile, "a", encoding="utf8") as mismatchFile:
+            mismatchFile.write(line)
+        self.mismatchBytes += size
+
+    def join(self, timeout = None):
+        '''
+        Wait until every queued comparison has been made (or timeout seconds have passed).
+        '''
+        deadline = time.monotonic() + (timeout if timeout != None else float("inf"))
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stop(self, timeout = None):
+        '''
+        Make every comparison already queued, then stop the background thread (or give up after timeout seconds).
+        '''
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+# shadow runner of this process, None while shadow mode is off
+runner = None
+
+def start(sampleRate, mismatchFile = None):
+    '''
+    Turn on shadow mode, comparing given fraction of fast path calls with the reference codec, returns runner.
+    '''
+    global runner
+
+    if runner != None:
+        runner.stop()
+
+    runner = ShadowRunner(sampleRate, mismatchFile)
+    logger.info("shadow mode comparing %g of fast codec path calls with the reference", sampleRate)
+
+    return runner
+
+def stop(timeout = STOP_TIMEOUT):
+    '''
+    Turn off shadow mode, once comparisons already queued have been made.
+    '''
+    global runner
+
+    if runner != None:
+        shadowRunner = runner
+        # no more calls are sampled while the queue is finished
+        runner = None
+        shadowRunner.stop(timeout)
+
+def shadowed(operation, reference, key = None):
+    '''
+    Decorator comparing a sample of a fast path's results with reference (a
+    function taking the same arguments) while shadow mode is on. key, if given,
+    turns the fast path's result in to what the reference returns. Calls
+    returning None aren't compared.
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            shadow = runner
+            if shadow == None or not shadow.sampled():
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            seconds = time.perf_counter() - start
+
+            if result != None:
+                shadow.submit(operation, reference, key, args, kwargs, result, seconds)
+
+            return result
+        return wrapper
+    return decorator
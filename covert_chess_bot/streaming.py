@@ -0,0 +1,348 @@
+# ------------------------------------------------------------------------------
+# Streaming
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Incremental, resumable decoding of emoji positions from text arriving in
+# chunks, e.g. a long mixed message split over several telegram messages, or a
+# carrier cut off part way through its position.
+#
+# Each chunk is fed through a shared emoji automaton (so an emoji split between
+# chunks is still found), and each emoji is checked as it arrives against the
+# position it would be part of: an original scheme square emoji must hold legal
+# piece values, the state emoji a possible en passant square, and so on (see
+# framing.py). Only the emoji of the position in progress are held (at most 26),
+# so each chunk costs the same however much text came before it, rather than
+# the whole history being rescanned. Board squares of an original scheme
+# position are known as soon as their emoji arrive, 3 to an emoji (a dense
+# position is one number, so nothing is known of it until it is complete).
+#
+# Given the same text, in however many chunks, the positions found are the
+# same as framing.findPositions finds, other than a position still in progress
+# at the end of the text, which is kept for the next chunk.
+# ------------------------------------------------------------------------------
+
+import threading
+import time
+from collections import OrderedDict, deque
+from covert_chess_bot import covert_chess, framing, metrics
+from covert_chess_bot.emoji_automaton import EmojiAutomaton
+from covert_chess_bot.move_check import squarePieces
+
+# chats with a position in progress kept at once, the least recently used are dropped beyond this
+MAX_PARTIAL_CHATS = 1000
+
+# seconds a position in progress is kept waiting for the rest of it
+PARTIAL_TIMEOUT = 15 * 60
+
+assembledPositions = metrics.Counter("covert_chess_assembled_positions_total", "Positions decoded from emoji split across several chunks (e.g. messages).")
+
+# automaton shared by every decoder, built the first time one is made
+automaton = None
+automatonLock = threading.Lock()
+
+def sharedAutomaton():
+    '''
+    Returns emoji automaton shared by every decoder, building it if it hasn't been yet.
+    '''
+    global automaton
+
+    with automatonLock:
+        if automaton == None:
+            automaton = EmojiAutomaton(covert_chess.emojiIndexes)
+
+    return automaton
+
+class StreamingDecoder:
+    '''
+    Decodes emoji positions from text fed in any number of chunks.
+    '''
+
+    def __init__(self):
+        self.automaton = sharedAutomaton().stream()
+        # emoji indexes not yet ruled out of being part of a position, and the chunk each was in
+        self.indexes = deque()
+        self.indexChunks = deque()
+        # emoji of position starting at 1st emoji already checked
+        self.checked = 0
+        # chunks fed so far
+        self.chunks = 0
+
+    def feed(self, text):
+        '''
+        Feed next chunk of text, returns list of positions now complete (see framing.findPositions,
+        each also giving the number of chunks it was spread over).
+        '''
+        self.chunks += 1
+        self.add(self.automaton.feed(text))
+
+        return self.search(final=False)
+
+    def flush(self):
+        '''
+        End of a whole piece of text (e.g. a message), returns list of positions
+        now complete. Any position still in progress is kept for later chunks.
+        '''
+        self.add(self.automaton.flush())
+
+        return self.search(final=True)
+
+    def add(self, matches):
+        for start, index in matches:
+            self.indexes.append(index)
+            self.indexChunks.append(self.chunks)
+
+    def search(self, final):
+        '''
+        Returns positions found at the start of emoji held, dropping emoji which can't start one.
+        '''
+        held = self.indexes
+        positions = []
+
+        while held:
+            length = framing.candidateLength(held[0])
+
+            # can't be the 1st emoji of a position, or emoji so far can't be part of a real one
+            if length == None or not self.checkEmoji(length):
+                self.drop()
+                continue
+
+            if len(held) < length:
+                # wait for the rest of position, unless there is a whole position within it
+                if final and self.hasLaterPosition():
+                    self.drop()
+                    continue
+                break
+
+            # wait for a possible resignation marker after position
+            if len(held) == length and not final:
+                break
+
+            indexes = [held[i] for i in range(length)]
+            frame = framing.decodeFrame(indexes)
+            # just emoji which happen to start like a position, try again from the next emoji
+            if frame == None:
+                self.drop()
+                continue
+
+            firstChunk = self.indexChunks[0]
+            lastChunk = self.indexChunks[length - 1]
+            for i in range(length):
+                self.drop()
+
+            resigned = len(held) > 0 and held[0] == covert_chess.resignIndex
+            if resigned:
+                indexes.append(held[0])
+                self.drop()
+
+            scheme, fen = frame
+            positions.append({
+                "emoji": "".join(covert_chess.emojiList[index] for index in indexes),
+                "fen": fen,
+                "scheme": scheme,
+                "resigned": resigned,
+                "chunks": lastChunk - firstChunk + 1,
+            })
+
+            if lastChunk != firstChunk:
+                assembledPositions.inc()
+
+        return positions
+
+    def drop(self):
+        '''
+        Drop 1st emoji, it doesn't start a position (or the position it starts is complete).
+        '''
+        self.indexes.popleft()
+        self.indexChunks.popleft()
+        self.checked = 0
+
+    def checkEmoji(self, length):
+        '''
+        Checks emoji of position starting at 1st emoji, which haven't been checked yet, could be part of a real position.
+        '''
+        indexes = self.indexes
+        end = min(len(indexes), length)
+
+        while self.checked < end:
+            i = self.checked
+            if length == covert_chess.originalSchemeLength:
+                if not framing.isOriginalEmoji(indexes, i):
+                    return False
+            # encoder never writes a leading zero digit
+            elif i == 1 and length > 2 and indexes[1] == 0:
+                return False
+            self.checked += 1
+
+        return True
+
+    def hasLaterPosition(self):
+        '''
+        Checks if there is a whole valid position starting after the 1st emoji.
+        '''
+        indexes = list(self.indexes)
+
+        for i in range(1, len(indexes)):
+            length = framing.candidateLength(indexes[i])
+            if length != None and i + length <= len(indexes) and framing.decodeFrame(indexes[i : i + length]) != None:
+                return True
+
+        return False
+
+    def couldContinue(self, messageEmoji):
+        '''
+        Checks list of emoji of the next chunk could carry on the position in progress,
+        rather than being unrelated emoji (e.g. a lone 👍 sent for its emoji info).
+        '''
+        if not self.inProgress or len(messageEmoji) == 0:
+            return False
+
+        length = self.needed
+        indexes = list(self.indexes)
+
+        # each emoji must be one the position could have in its place (see checkEmoji)
+        for emoji in messageEmoji[:length - len(indexes)]:
+            indexes.append(covert_chess.emojiIndex(emoji))
+            i = len(indexes) - 1
+            if length == covert_chess.originalSchemeLength:
+                if not framing.isOriginalEmoji(indexes, i):
+                    return False
+            elif i == 1 and length > 2 and indexes[1] == 0:
+                return False
+
+        # a lone emoji only carries on a position by completing it
+        if len(indexes) < length:
+            return len(messageEmoji) > 1
+
+        return framing.decodeFrame(indexes[:length]) != None
+
+    @property
+    def inProgress(self):
+        '''
+        Checks if some emoji of a position have been received, but not all of them.
+        '''
+        # every emoji held is part of the position started by the 1st one
+        return len(self.indexes) > 0
+
+    @property
+    def received(self):
+        '''
+        Number of emoji of the position in progress received so far, 0 if there isn't one.
+        '''
+        return min(len(self.indexes), self.needed) if self.inProgress else 0
+
+    @property
+    def needed(self):
+        '''
+        Number of emoji in the position in progress, None if there isn't one.
+        '''
+        return framing.candidateLength(self.indexes[0]) if self.inProgress else None
+
+    @property
+    def spread(self):
+        '''
+        Number of chunks the position in progress has been spread over so far, 0 if there isn't one.
+        '''
+        return self.chunks - self.indexChunks[0] + 1 if self.inProgress else 0
+
+    def squares(self):
+        '''
+        Returns list of the 64 squares (A8 to H1) of the position in progress,
+        each its FEN piece letter, "" if empty, or None if it isn't known yet.
+        '''
+        board = [None] * 64
+        if not self.inProgress or self.needed != covert_chess.originalSchemeLength:
+            return board
+
+        indexes = list(self.indexes)[:1 + framing.SQUARE_EMOJI]
+
+        # 1st emoji is the A8 square alone, then 3 squares per emoji, each emoji shifted by a further offset
+        board[0] = squarePieces[indexes[0] - covert_chess.originalSchemeFirstIndex] or ""
+        for i, index in enumerate(indexes[1:]):
+            value = (index - i * framing.SQUARE_OFFSET) % 3178
+            square = 1 + 3 * i
+            board[square] = squarePieces[value // 169] or ""
+            board[square + 1] = squarePieces[value // 13 % 13] or ""
+            board[square + 2] = squarePieces[value % 13] or ""
+
+        return board
+
+    def reset(self):
+        '''
+        Forget any position in progress & partly matched emoji.
+        '''
+        self.automaton.reset()
+        self.indexes.clear()
+        self.indexChunks.clear()
+        self.checked = 0
+
+class PartialPositions:
+    '''
+    Decoder of each chat with a position in progress, dropped when unused for PARTIAL_TIMEOUT seconds.
+    '''
+
+    def __init__(self, maxChats = MAX_PARTIAL_CHATS, timeout = PARTIAL_TIMEOUT):
+        self.maxChats = maxChats
+        self.timeout = timeout
+        # key -> (decoder, time last used), least recently used first
+        self.decoders = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.decoders)
+
+    def get(self, key):
+        '''
+        Returns decoder of key, None if it has no position in progress.
+        '''
+        with self.lock:
+            entry = self.decoders.pop(key, None)
+            if entry == None or time.monotonic() - entry[1] > self.timeout:
+                return None
+            self.decoders[key] = (entry[0], time.monotonic())
+
+        return entry[0]
+
+    def start(self, key):
+        '''
+        Returns new decoder for key, replacing any it had.
+        '''
+        decoder = StreamingDecoder()
+
+        with self.lock:
+            self.put(key, decoder)
+
+        return decoder
+
+    def keep(self, key, decoder):
+        '''
+        Keep decoder of key while it has a position in progress, drop it once it hasn't.
+        '''
+        with self.lock:
+            if not decoder.inProgress:
+                if key in self.decoders and self.decoders[key][0] is decoder:
+                    del self.decoders[key]
+                return
+            self.put(key, decoder)
+
+    def put(self, key, decoder):
+        '''
+        Make decoder key's most recently used, dropping least recently used beyond maxChats (lock must be held).
+        '''
+        self.decoders.pop(key, None)
+        self.decoders[key] = (decoder, time.monotonic())
+        while len(self.decoders) > self.maxChats:
+            self.decoders.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.decoders.pop(key, None)
+
+    def shrink(self):
+        '''
+        Drop every position in progress.
+        '''
+        with self.lock:
+            self.decoders.clear()
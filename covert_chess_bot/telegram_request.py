@@ -0,0 +1,195 @@
+# ------------------------------------------------------------------------------
+# Telegram Request
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# HTTP request object used by the bot for all outbound Telegram Bot API calls.
+# Behaves like the python-telegram-bot default, but records the latency of every
+# call in the bot's metrics, and reuses its connections under load.
+#
+# The library's connection pool hands out a brand new connection whenever every
+# pooled one is in use, then throws it away afterwards, so a burst of replies
+# costs a new TCP & TLS handshake per reply over the pool size. Here the pool is
+# sized to the threads making calls (see connectionPoolSize), and a call waits
+# for a pooled connection to be free instead, so connections are kept alive &
+# reused. How long calls wait for a connection, and how many connections are
+# opened, are recorded in the metrics.
+#
+# Running this module directly compares reply latency of the library default &
+# this request object against a local HTTPS stand-in for telegram:
+#   python3 -m covert_chess_bot.telegram_request [--threads N] [--calls N] [--latency S] [--gap S]
+# ------------------------------------------------------------------------------
+
+import time
+from covert_chess_bot import metrics
+from covert_chess_bot.send_queue import SENDERS
+
+from telegram.utils.request import Request
+
+# same urllib3 as the library uses, it prefers its own vendored copy
+try:
+    from telegram.vendor.ptb_urllib3.urllib3 import HTTPConnectionPool, HTTPSConnectionPool, PoolManager, ProxyManager
+    from telegram.vendor.ptb_urllib3.urllib3.connection import HTTPConnection, HTTPSConnection
+except ImportError:
+    from urllib3 import HTTPConnectionPool, HTTPSConnectionPool, PoolManager, ProxyManager
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+
+# seconds a call waits for a free connection before failing with a NetworkError
+DEFAULT_POOL_TIMEOUT = 10.0
+
+def connectionPoolSize(handlerThreads, senderThreads = SENDERS):
+    '''
+    Returns number of connections needed so no thread making Bot API calls ever waits for one.
+    '''
+    # handlers (e.g. answering inline queries) & send queue threads can all be
+    # mid call at once, plus a long polling getUpdates & a spare
+    return handlerThreads + senderThreads + 2
+
+class MeteredHTTPConnection(HTTPConnection):
+    '''
+    HTTP connection which counts each time it connects.
+    '''
+
+    def connect(self):
+        metrics.botApiConnectionsOpened.inc()
+        return super().connect()
+
+class MeteredHTTPSConnection(HTTPSConnection):
+    '''
+    HTTPS connection which counts each time it connects (& so does a TLS handshake).
+    '''
+
+    def connect(self):
+        metrics.botApiConnectionsOpened.inc()
+        return super().connect()
+
+class MeteredPoolMixin:
+    '''
+    Records how long each call waits for a pooled connection.
+    '''
+
+    def __init__(self, *args, pool_timeout = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # used when a call doesn't give its own pool timeout
+        self.poolTimeout = pool_timeout
+
+    def _get_conn(self, timeout = None):
+        start = time.perf_counter()
+        try:
+            return super()._get_conn(timeout=self.poolTimeout if timeout == None else timeout)
+        finally:
+            metrics.botApiConnectionWaitSeconds.observe(time.perf_counter() - start)
+
+class MeteredHTTPConnectionPool(MeteredPoolMixin, HTTPConnectionPool):
+    ConnectionCls = MeteredHTTPConnection
+
+class MeteredHTTPSConnectionPool(MeteredPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = MeteredHTTPSConnection
+
+meteredPoolClasses = {
+    "http": MeteredHTTPConnectionPool,
+    "https": MeteredHTTPSConnectionPool,
+}
+
+class MeteredRequest(Request):
+    '''
+    Request which records latency and errors of each Bot API call by method,
+    and waits for a pooled keep-alive connection rather than opening extra ones.
+    '''
+
+    def __init__(self, con_pool_size = 1, pool_timeout = DEFAULT_POOL_TIMEOUT, ca_certs = None, **kwargs):
+        super().__init__(con_pool_size=con_pool_size, **kwargs)
+
+        # SOCKS proxies & app engine have their own kinds of pool, which are left as they are
+        manager = self._con_pool
+        if type(manager) in (PoolManager, ProxyManager):
+            # block rather than open a throwaway connection when every pooled one is in use
+            manager.connection_pool_kw.update(block=True, pool_timeout=pool_timeout)
+            # e.g. the certificate of a local stand-in for telegram
+            if ca_certs != None:
+                manager.connection_pool_kw["ca_certs"] = ca_certs
+            manager.pool_classes_by_scheme = meteredPoolClasses
+
+    def _request_wrapper(self, *args, **kwargs):
+        # args are passed through to urllib3, i.e. (http method, url, ...)
+        apiMethod = str(args[1]).rsplit("/", 1)[-1]
+
+        start = time.perf_counter()
+        try:
+            return super()._request_wrapper(*args, **kwargs)
+        except Exception:
+            metrics.botApiErrors.inc(apiMethod)
+            raise
+        finally:
+            metrics.botApiSeconds.observe(time.perf_counter() - start, apiMethod)
+
+def benchmark(threads = 16, calls = 800, latency = 0.02, gap = 0.01):
+    '''
+    Send messages from many threads at once to a local HTTPS fake Bot API, with
+    the library's default request object & with this one, printing the results.
+    Each thread waits a random time of up to gap seconds between its messages,
+    as send queue threads do between jobs, so calls don't finish in lock step.
+    '''
+    import logging
+    import random
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from covert_chess_bot.fake_bot_api import FakeBotApi, selfSignedCertificate
+
+    from telegram import Bot
+
+    def run(name, makeRequest):
+        fakeApi = FakeBotApi(enforceLimits=False, latency=latency, certFile=certFile, keyFile=keyFile)
+        request = makeRequest()
+        bot = Bot("123456:benchmark", base_url=fakeApi.baseUrl, request=request)
+
+        def send(i):
+            time.sleep(random.random() * gap)
+            start = time.perf_counter()
+            bot.send_message(i % 100 + 1, f"reply {i}")
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            latencies = sorted(executor.map(send, range(calls)))
+        elapsed = time.perf_counter() - start
+
+        print(f"{name}:")
+        print(f"  calls per second:     {calls / elapsed:.0f}")
+        print(f"  median latency:       {latencies[len(latencies) // 2] * 1000:.1f} ms")
+        print(f"  99th pct latency:     {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+        print(f"  connections opened:   {fakeApi.connections}")
+
+        request.stop()
+        fakeApi.stop()
+
+    # the library's pool warns every time it throws a connection away
+    logging.getLogger("telegram.vendor.ptb_urllib3.urllib3.connectionpool").setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as directory:
+        certFile, keyFile = selfSignedCertificate(directory)
+
+        def libraryRequest(poolSize):
+            # the library always verifies against certifi's certificates, so is pointed at the stand-in's here
+            request = Request(con_pool_size=poolSize)
+            request._con_pool.connection_pool_kw["ca_certs"] = certFile
+            return request
+
+        print(f"{calls} messages from {threads} threads, {latency * 1000:.0f} ms simulated api latency, up to {gap * 1000:.0f} ms between messages\n")
+        run("library default (Bot(token), 1 connection)", lambda: libraryRequest(1))
+        run(f"library, {connectionPoolSize(threads, 0)} connections", lambda: libraryRequest(connectionPoolSize(threads, 0)))
+        run(f"pooled keep-alive, {connectionPoolSize(threads, 0)} connections", lambda: MeteredRequest(con_pool_size=connectionPoolSize(threads, 0), ca_certs=certFile))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare Bot API request objects against a local HTTPS fake Bot API.")
+    parser.add_argument("--threads", type=int, default=16, help="threads sending messages at once")
+    parser.add_argument("--calls", type=int, default=800, help="messages sent with each request object")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the fake api takes to answer each call")
+    parser.add_argument("--gap", type=float, default=0.01, help="most seconds each thread waits between its messages")
+    arguments = parser.parse_args()
+
+    benchmark(arguments.threads, arguments.calls, arguments.latency, arguments.gap)
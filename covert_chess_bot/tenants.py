@@ -0,0 +1,358 @@
+# ------------------------------------------------------------------------------
+# Tenants
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Serves several bots (e.g. differently branded copies of the bot, each with its
+# own token) from one process, rather than one process per bot each with its
+# own interpreter, emoji tables & caches.
+#
+# Every bot's updates go through one shared dispatcher running the bot's normal
+# handlers, so the codec tables, board image cache, opening book & hint
+# processes are all shared. What telegram keeps separate for each bot is kept
+# separate for each tenant too:
+#   - its own Bot, so replies are sent from the bot the update came to
+#   - its own send queue, as telegram's rate limits are per bot
+#   - its own sessions database, so a user playing with two bots has two games
+# Handlers find the tenant of an update from the bot it was received by (see
+# tenantOf), and context.bot is that tenant's bot.
+#
+# Updates are either long polled (one thread per bot), or received by one
+# webhook server, which routes each request to its tenant by the token in the
+# URL path (each bot's webhook is set to webhook_url + its token).
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from covert_chess_bot import metrics, send_queue
+from covert_chess_bot.send_queue import SendQueue
+from covert_chess_bot.sessions import SessionStore
+from covert_chess_bot.telegram_request import MeteredRequest, connectionPoolSize
+from covert_chess_bot.workers import AcceptGate, RecentUpdates
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import CallbackContext, ContextTypes, Dispatcher
+
+logger = logging.getLogger(__name__)
+
+# seconds each getUpdates long poll waits for updates
+POLL_TIMEOUT = 10
+
+# seconds to wait before polling again after a failed poll
+POLL_RETRY = 5
+
+# seconds to wait on shutdown for updates already received to be handled
+DRAIN_TIMEOUT = 10
+
+tenantUpdates = metrics.Counter("covert_chess_tenant_updates_total", "Updates received, by tenant.", ["tenant"])
+
+tenantWebhookRejections = metrics.Counter("covert_chess_tenant_webhook_rejections_total", "Webhook requests not queued, by tenant & reason.", ["tenant", "reason"])
+
+tenantQueueDepth = metrics.Gauge("covert_chess_tenant_send_queue_depth", "Outbound messages waiting to be sent, by tenant.", ["tenant"])
+
+def parseTenants(botTokens):
+    '''
+    Returns list of (name, token) of bot_tokens from credentials.py, either a
+    list of tokens (each named by its bot id) or a dict of name -> token.
+    '''
+    if isinstance(botTokens, dict):
+        return list(botTokens.items())
+
+    # bot id is the part of the token before the colon, which isn't secret
+    return [(token.split(":", 1)[0], token) for token in botTokens]
+
+def tenantDatabase(databaseLocation, name):
+    '''
+    Returns location of a tenant's sessions database, e.g. data/sessions.db -> data/sessions.name.db
+    '''
+    root, extension = os.path.splitext(databaseLocation)
+
+    return f"{root}.{name}{extension}"
+
+def botOf(update):
+    '''
+    Returns Bot an update was received by, None if it has nothing sent to a bot in it.
+    '''
+    for value in (update.effective_message, update.inline_query, update.chosen_inline_result, update.callback_query):
+        if value != None:
+            return value.bot
+
+    return None
+
+class Tenant:
+    '''
+    One of the bots being served, with its own Bot, send queue & sessions.
+    '''
+
+    def __init__(self, name, token, baseUrl = None, sessionsDatabase = None):
+        self.name = name
+        self.token = token
+
+        # handlers (on the dispatcher's one thread), send queue threads & its poller can all be mid call at once
+        self.bot = Bot(token, base_url=baseUrl, request=MeteredRequest(con_pool_size=connectionPoolSize(1)))
+        self.sendQueue = SendQueue(self.bot)
+        tenantQueueDepth.setFunction(lambda: self.sendQueue.depth, name)
+
+        self.sessions = None
+        if sessionsDatabase:
+            self.sessions = SessionStore(tenantDatabase(sessionsDatabase, name))
+
+        # update ids already received through the webhook
+        self.recentUpdates = RecentUpdates()
+
+class TenantContext(CallbackContext):
+    '''
+    Callback context whose bot is the bot of the tenant an update was received by.
+    '''
+
+    tenant = None
+
+    @classmethod
+    def from_update(cls, update, dispatcher):
+        self = super().from_update(update, dispatcher)
+
+        if isinstance(update, Update):
+            self.tenant = dispatcher.bot_data["tenants"].tenantOf(update)
+
+        return self
+
+    @property
+    def bot(self):
+        if self.tenant != None:
+            return self.tenant.bot
+
+        return super().bot
+
+class TenantRunner:
+    '''
+    Receives updates for every tenant & handles them with one shared dispatcher.
+    '''
+
+    def __init__(self, botTokens, baseUrl = None, sessionsDatabase = None, webhookPort = None, webhookUrl = None,
+                 listen = "0.0.0.0"):
+        self.tenants = [Tenant(name, token, baseUrl, sessionsDatabase) for name, token in parseTenants(botTokens)]
+        if len(self.tenants) == 0:
+            raise ValueError("no bot tokens given")
+
+        # bot token -> tenant
+        self.byToken = {tenant.token: tenant for tenant in self.tenants}
+
+        # name -> tenant
+        self.byName = {tenant.name: tenant for tenant in self.tenants}
+
+        # url path -> tenant, when using a webhook
+        self.byPath = {"/" + tenant.token: tenant for tenant in self.tenants}
+
+        self.webhookPort = webhookPort
+        self.webhookUrl = webhookUrl
+        self.listen = listen
+
+        # total over every tenant, rather than whichever send queue was created last
+        send_queue.queueDepth.setFunction(lambda: sum(tenant.sendQueue.depth for tenant in self.tenants))
+
+        # dispatcher needs a bot, but handlers are given their tenant's bot through TenantContext
+        self.dispatcher = Dispatcher(self.tenants[0].bot, queue.Queue(), workers=1,
+                                     context_types=ContextTypes(context=TenantContext))
+        self.dispatcher.bot_data["tenants"] = self
+
+        self.server = None
+        # closed on stop, after which webhook requests are refused so telegram re-sends them after a restart
+        self.gate = AcceptGate()
+        self.threads = []
+        self.running = threading.Event()
+
+    def tenantOf(self, update):
+        '''
+        Returns tenant an update was received by, None if it isn't from any tenant's bot.
+        '''
+        bot = botOf(update)
+        if bot == None:
+            return None
+
+        return self.byToken.get(bot.token)
+
+    def receive(self, tenant, update):
+        '''
+        Queue an update received by a tenant's bot to be handled.
+        '''
+        tenantUpdates.inc(tenant.name)
+        self.dispatcher.update_queue.put(update)
+
+    def pollLoop(self, tenant):
+        '''
+        Long poll for a tenant's updates until stopped, run by a thread per tenant.
+        '''
+        offset = None
+
+        while self.running.is_set():
+            try:
+                updates = tenant.bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+            except TelegramError:
+                logger.exception("polling for tenant %s failed, retrying in %d seconds", tenant.name, POLL_RETRY)
+                time.sleep(POLL_RETRY)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                self.receive(tenant, update)
+
+    def requestHandler(self):
+        '''
+        Returns a webhook request handler class bound to this runner.
+        '''
+        runner = self
+
+        class TenantWebhookRequestHandler(BaseHTTPRequestHandler):
+            # telegram keeps its webhook connections alive
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+
+                # path is the token of the bot the update was sent to
+                tenant = runner.byPath.get(self.path)
+                if tenant == None:
+                    self.respond(403)
+                    return
+
+                self.respond(runner.accept(tenant, body))
+
+            def respond(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                # stopping, don't keep serving requests on this connection
+                if runner.gate.closed:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return TenantWebhookRequestHandler
+
+    def accept(self, tenant, body):
+        '''
+        Queue update sent to a tenant's webhook unless it is a duplicate, returns http status to reply with.
+        '''
+        # stopping, so the update may never be handled, let telegram re-send it
+        if not self.gate.enter():
+            tenantWebhookRejections.inc(tenant.name, "stopping")
+            return 503
+
+        try:
+            return self.queueUpdate(tenant, body)
+        finally:
+            self.gate.leave()
+
+    def queueUpdate(self, tenant, body):
+        '''
+        Queue update sent to a tenant's webhook unless it is a duplicate, returns http status to reply with (accept must have let it through).
+        '''
+        try:
+            data = json.loads(body)
+            updateId = data["update_id"]
+            update = Update.de_json(data, tenant.bot)
+        except (ValueError, KeyError, TypeError):
+            tenantWebhookRejections.inc(tenant.name, "invalid")
+            return 400
+
+        # already queued, telegram is re-sending it
+        if not tenant.recentUpdates.add(updateId):
+            tenantWebhookRejections.inc(tenant.name, "duplicate")
+            return 200
+
+        self.receive(tenant, update)
+        return 200
+
+    def start(self):
+        '''
+        Start handling updates, then start receiving them for every tenant.
+        '''
+        self.running.set()
+
+        thread = threading.Thread(target=self.dispatcher.start, name="tenant-dispatcher", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        metrics.dispatcherQueueDepth.setFunction(self.dispatcher.update_queue.qsize)
+
+        if self.webhookPort != None:
+            self.server = ThreadingHTTPServer((self.listen, self.webhookPort), self.requestHandler())
+            self.webhookPort = self.server.server_address[1]
+            threading.Thread(target=self.server.serve_forever, name="tenant-webhook", daemon=True).start()
+
+            # tell telegram where to send each bot's updates
+            if self.webhookUrl != None:
+                for tenant in self.tenants:
+                    tenant.bot.set_webhook(self.webhookUrl + tenant.token)
+
+            logger.info("webhook listening on port %d for %d bots", self.webhookPort, len(self.tenants))
+            return
+
+        for tenant in self.tenants:
+            # getUpdates can't be used while a webhook is set
+            tenant.bot.delete_webhook()
+
+            thread = threading.Thread(target=self.pollLoop, args=(tenant,), name=f"tenant-poll-{tenant.name}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        logger.info("polling for %d bots", len(self.tenants))
+
+    def stop(self):
+        '''
+        Stop receiving updates, handle those already received, then send every queued reply.
+        '''
+        self.running.clear()
+
+        # refuse any more webhook updates (including on keep-alive connections, which outlive the server),
+        # then wait for requests already queueing theirs, so every update acknowledged is drained below
+        self.gate.close()
+
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+
+        # updates already received are handled before the dispatcher is stopped
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.dispatcher.update_queue.qsize() > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.dispatcher.stop()
+
+        for tenant in self.tenants:
+            tenant.sendQueue.join(timeout=10)
+            tenant.sendQueue.stop()
+
+            # write any sessions changed since they were last written
+            if tenant.sessions != None:
+                tenant.sessions.close()
+
+        logger.info("all tenants stopped")
+
+    def serve(self):
+        '''
+        Start, then run until SIGINT / SIGTERM is received and shutdown is complete.
+        '''
+        self.start()
+
+        stopRequested = threading.Event()
+
+        def requestStop(signum, frame):
+            stopRequested.set()
+
+        signal.signal(signal.SIGINT, requestStop)
+        signal.signal(signal.SIGTERM, requestStop)
+
+        while not stopRequested.wait(1):
+            pass
+
+        self.stop()
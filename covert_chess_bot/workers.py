@@ -0,0 +1,447 @@
+# ------------------------------------------------------------------------------
+# Webhook Workers
+# ------------------------------------------------------------------------------
+# Author: Paul Frisby
+# Email: mail@paulfrisby.com
+# Github: https://github.com/paulfrisby/
+# ------------------------------------------------------------------------------
+# Multi-process deployment of the bot when using a webhook, so update handling
+# (which is CPU bound, and so limited to one core by the GIL in one process)
+# scales across all cores.
+#
+# A small front process receives webhook requests from telegram, drops any
+# update it has already seen (telegram re-sends an update if it thinks its
+# webhook request failed), and feeds updates through local queues to N worker
+# processes. Each worker runs the bot's normal handlers with its own dispatcher.
+# Updates from a chat always go to the same worker, so they are handled in
+# order and that worker's cached session for the chat is always up to date.
+# Workers are forked after the emoji tables have been mapped, so start quickly,
+# and all share the one read only copy of them (see emoji_table.py). Logging's
+# writing thread is already running when they are forked, and is restarted in
+# each worker by log_pipeline's at-fork hook.
+#
+# On SIGINT / SIGTERM the front refuses any more requests (with 503, so telegram
+# re-sends them later) and waits for those already being queued, then every
+# worker finishes the updates already queued & sends their replies before
+# exiting.
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from covert_chess_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# number of update ids remembered for dropping duplicate deliveries
+RECENT_UPDATES = 100000
+
+# updates which can be waiting for a worker before telegram is told to retry later
+QUEUE_SIZE_PER_WORKER = 100
+
+# seconds a webhook request waits for space in a full queue
+QUEUE_TIMEOUT = 5
+
+webhookUpdates = metrics.Counter("covert_chess_webhook_updates_total", "Webhook deliveries received by the front process, by result.", ["result"])
+
+workerQueueDepth = metrics.Gauge("covert_chess_worker_queue_depth", "Updates waiting to be picked up by a worker process, by worker.", ["worker"])
+
+class RecentUpdates:
+    '''
+    Bounded set of the most recently seen update ids.
+    '''
+
+    def __init__(self, capacity = RECENT_UPDATES):
+        self.capacity = capacity
+        self.ids = set()
+        self.order = deque()
+        self.lock = threading.Lock()
+
+    def add(self, updateId):
+        '''
+        Remember update id, returns False if it had already been seen.
+        '''
+        with self.lock:
+            if updateId in self.ids:
+                return False
+
+            self.ids.add(updateId)
+            self.order.append(updateId)
+
+            # forget oldest id once full
+            if len(self.order) > self.capacity:
+                self.ids.discard(self.order.popleft())
+
+            return True
+
+    def discard(self, updateId):
+        '''
+        Forget update id, so a re-delivery of it will be accepted.
+        '''
+        with self.lock:
+            self.ids.discard(updateId)
+
+class AcceptGate:
+    '''
+    Lets webhook requests queue their update until closed, then waits for those already queueing to finish.
+
+    Stopping the http server isn't enough on its own: it only stops new
+    connections, while telegram's keep-alive connections are each served by a
+    daemon thread which carries on reading & answering requests.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # requests let through which haven't finished queueing their update
+        self.inFlight = 0
+        self.closed = False
+
+    def enter(self):
+        '''
+        Let a request through to queue its update, returns False once closed.
+        '''
+        with self.condition:
+            if self.closed:
+                return False
+            self.inFlight += 1
+            return True
+
+    def leave(self):
+        '''
+        A request let through has finished queueing its update (or failed to).
+        '''
+        with self.condition:
+            self.inFlight -= 1
+            if self.inFlight == 0:
+                self.condition.notify_all()
+
+    def close(self, timeout = None):
+        '''
+        Stop letting requests through, then wait for those already let through, returns False if timeout passed first.
+        '''
+        with self.condition:
+            self.closed = True
+            return self.condition.wait_for(lambda: self.inFlight == 0, timeout)
+
+def chatIdOf(update):
+    '''
+    Returns id of chat (or user) an update dict is from, None if it has neither.
+    '''
+    for value in update.values():
+        if isinstance(value, dict):
+            if isinstance(value.get("chat"), dict):
+                return value["chat"].get("id")
+            # e.g. inline queries, which come from a user rather than a chat
+            if isinstance(value.get("from"), dict):
+                return value["from"].get("id")
+
+    return None
+
+def workerMain(token, baseUrl, updateQueue, workerNumber, workerCount, metricsPort, globalRate, sessionsDatabase,
+               profileDirectory, profileThreshold, hintProcesses, hintSeconds, remindersDatabase, memorySoftLimit,
+               shadowSampleRate, shadowMismatchFile):
+    '''
+    Run by each worker process, handles updates from queue until told to stop.
+    '''
+    # imported here, as bot imports this module
+    from covert_chess_bot import bot as covertChessBot, memory, shadow
+    from covert_chess_bot.engine import HintPool, DEFAULT_SECONDS
+    from covert_chess_bot.profiling import SlowRequestProfiler
+    from covert_chess_bot.reminders import ReminderStore
+    from covert_chess_bot.send_queue import SendQueue, GLOBAL_RATE, GLOBAL_BURST
+    from covert_chess_bot.sessions import SessionStore
+    from covert_chess_bot.telegram_request import MeteredRequest, connectionPoolSize
+
+    from telegram import Bot, Update
+    from telegram.ext import Dispatcher
+
+    # shutdown is coordinated by front process, through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    bot = Bot(token, base_url=baseUrl, request=MeteredRequest(con_pool_size=connectionPoolSize(1)))
+
+    # updates are handled one at a time on this thread, parallelism comes from
+    # running many workers (replies are sent from the send queue's threads)
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=1)
+
+    # profiler must exist before handlers are registered, so they are wrapped by it
+    if profileDirectory:
+        covertChessBot.profiler = SlowRequestProfiler(profileDirectory, threshold=profileThreshold)
+
+    covertChessBot.add_handlers(dispatcher)
+
+    # telegram's global rate limit is shared between all workers
+    if globalRate == None:
+        globalRate = GLOBAL_RATE
+    covertChessBot.sendQueue = SendQueue(bot, globalRate=globalRate / workerCount, globalBurst=max(1, min(globalRate, GLOBAL_BURST) / workerCount))
+
+    # workers share the sessions database, but each caches only its own chats' sessions
+    if sessionsDatabase:
+        covertChessBot.sessions = SessionStore(sessionsDatabase)
+
+    # workers share the reminders database too, each sending reminders of only the chats routed to it
+    if remindersDatabase:
+        covertChessBot.reminders = ReminderStore(remindersDatabase, covertChessBot.send_reminders,
+                                                 owns=lambda key: key[1] % workerCount == workerNumber)
+
+    # each worker has its own metrics, served on consecutive ports after the front's
+    if metricsPort:
+        metrics.startServer(metricsPort + workerNumber + 1)
+
+    # each worker samples its own memory use, within an equal share of the soft limit
+    covertChessBot.track_memory(memory.startMonitor(memorySoftLimit // workerCount if memorySoftLimit else None))
+
+    # each worker checks its own sample of codec calls, writing mismatches to its own file
+    if shadowSampleRate:
+        root, extension = os.path.splitext(shadowMismatchFile or "")
+        shadow.start(shadowSampleRate, f"{root}.{workerNumber}{extension}" if shadowMismatchFile else None)
+
+    # each worker has its own processes searching for hints, so a long search never holds up its updates
+    covertChessBot.hints = HintPool(processes=hintProcesses or 1, seconds=hintSeconds or DEFAULT_SECONDS)
+
+    while True:
+        body = updateQueue.get()
+
+        # sentinel, no more updates will be queued
+        if body == None:
+            break
+
+        try:
+            dispatcher.process_update(Update.de_json(json.loads(body), bot))
+        except Exception:
+            logger.exception("worker %d failed to handle update", workerNumber)
+
+    # finish sending replies to updates already handled
+    covertChessBot.sendQueue.join(timeout=30)
+    covertChessBot.sendQueue.stop()
+
+    if covertChessBot.reminders != None:
+        covertChessBot.reminders.close()
+
+    if covertChessBot.sessions != None:
+        covertChessBot.sessions.close()
+
+    covertChessBot.hints.shutdown()
+
+    # finish comparing codec calls already sampled
+    shadow.stop()
+
+class WebhookWorkerPool:
+    '''
+    Front webhook server feeding de-duplicated updates to worker processes.
+    '''
+
+    def __init__(self, token, port, workers, listen = "0.0.0.0", urlPath = None, webhookUrl = None,
+                 baseUrl = None, metricsPort = None, globalRate = None, sessionsDatabase = None,
+                 profileDirectory = None, profileThreshold = None, hintProcesses = None, hintSeconds = None,
+                 remindersDatabase = None, memorySoftLimit = None, shadowSampleRate = None, shadowMismatchFile = None):
+        self.token = token
+        self.port = port
+        self.workerCount = workers
+        self.listen = listen
+        self.urlPath = "/" + (urlPath if urlPath != None else token)
+        self.webhookUrl = webhookUrl
+        self.baseUrl = baseUrl
+        self.metricsPort = metricsPort
+        # messages per second all workers may send in total (None for telegram's limit)
+        self.globalRate = globalRate
+        self.sessionsDatabase = sessionsDatabase
+        self.profileDirectory = profileDirectory
+        self.profileThreshold = profileThreshold
+        self.hintProcesses = hintProcesses
+        self.hintSeconds = hintSeconds
+        self.remindersDatabase = remindersDatabase
+        # bytes of RSS all workers may use in total before shrinking their caches
+        self.memorySoftLimit = memorySoftLimit
+        # fraction of codec calls each worker checks against the reference codec (see shadow.py)
+        self.shadowSampleRate = shadowSampleRate
+        self.shadowMismatchFile = shadowMismatchFile
+
+        self.recentUpdates = RecentUpdates()
+
+        # fork where available, so workers share already loaded emoji tables
+        if "fork" in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context("fork")
+        else:
+            self.context = multiprocessing.get_context()
+
+        # one queue per worker
+        self.updateQueues = [self.context.Queue(maxsize=QUEUE_SIZE_PER_WORKER) for i in range(workers)]
+        self.processes = []
+        self.server = None
+        # closed on stop, after which requests are refused so telegram re-sends them after a restart
+        self.gate = AcceptGate()
+        self.stopped = threading.Event()
+
+    def requestHandler(self):
+        '''
+        Returns a request handler class bound to this pool.
+        '''
+        pool = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            # telegram keeps its webhook connections alive
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+
+                if self.path != pool.urlPath:
+                    self.respond(403)
+                    return
+
+                self.respond(pool.accept(body))
+
+            def respond(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                # stopping, don't keep serving requests on this connection
+                if pool.gate.closed:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return WebhookRequestHandler
+
+    def accept(self, body):
+        '''
+        Queue update for a worker unless it is a duplicate, returns http status to reply with.
+        '''
+        # stopping, so the update may never be handled, let telegram re-send it
+        if not self.gate.enter():
+            webhookUpdates.inc("stopping")
+            return 503
+
+        try:
+            return self.queueUpdate(body)
+        finally:
+            self.gate.leave()
+
+    def queueUpdate(self, body):
+        '''
+        Queue update for a worker unless it is a duplicate, returns http status to reply with (accept must have let it through).
+        '''
+        try:
+            update = json.loads(body)
+            updateId = update["update_id"]
+        except (ValueError, KeyError, TypeError):
+            webhookUpdates.inc("invalid")
+            return 400
+
+        # already queued, telegram is re-sending it
+        if not self.recentUpdates.add(updateId):
+            webhookUpdates.inc("duplicate")
+            return 200
+
+        # same chat always goes to same worker
+        chatId = chatIdOf(update)
+        updateQueue = self.updateQueues[(chatId if chatId != None else updateId) % self.workerCount]
+
+        try:
+            updateQueue.put(body, timeout=QUEUE_TIMEOUT)
+        # workers can't keep up, let telegram retry this update later
+        except queue.Full:
+            self.recentUpdates.discard(updateId)
+            webhookUpdates.inc("rejected")
+            return 503
+
+        webhookUpdates.inc("queued")
+        return 200
+
+    def start(self):
+        '''
+        Start worker processes, then the front webhook server.
+        '''
+        # workers are forked before the front's threads start, but the log_pipeline
+        # listener thread is already running, so forking is only safe because
+        # log_pipeline's at-fork hook gives each worker a new queue & listener
+        for workerNumber in range(self.workerCount):
+            self.processes.append(self.startWorker(workerNumber))
+
+        self.server = ThreadingHTTPServer((self.listen, self.port), self.requestHandler())
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="webhook-front", daemon=True).start()
+
+        if self.metricsPort:
+            for workerNumber, updateQueue in enumerate(self.updateQueues):
+                workerQueueDepth.setFunction(updateQueue.qsize, str(workerNumber))
+            metrics.startServer(self.metricsPort)
+
+        # tell telegram where to send updates
+        if self.webhookUrl != None:
+            from covert_chess_bot.telegram_request import MeteredRequest
+            from telegram import Bot
+
+            Bot(self.token, base_url=self.baseUrl, request=MeteredRequest()).set_webhook(self.webhookUrl)
+
+        logger.info("webhook front listening on port %d with %d workers", self.port, self.workerCount)
+
+    def startWorker(self, workerNumber):
+        '''
+        Start worker process handling updates from given worker's queue.
+        '''
+        process = self.context.Process(
+            target=workerMain,
+            args=(self.token, self.baseUrl, self.updateQueues[workerNumber], workerNumber, self.workerCount,
+                  self.metricsPort, self.globalRate, self.sessionsDatabase, self.profileDirectory, self.profileThreshold,
+                  self.hintProcesses, self.hintSeconds, self.remindersDatabase, self.memorySoftLimit,
+                  self.shadowSampleRate, self.shadowMismatchFile),
+            name=f"covert-chess-worker-{workerNumber}",
+        )
+        process.start()
+
+        return process
+
+    def stop(self):
+        '''
+        Stop accepting updates, then wait for workers to finish those already queued.
+        '''
+        # refuse any more updates (including on keep-alive connections, which outlive the server),
+        # then wait for requests already queueing theirs, so none is queued after a worker's sentinel
+        self.gate.close()
+
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+
+        for updateQueue in self.updateQueues:
+            updateQueue.put(None)
+
+        for process in self.processes:
+            process.join()
+
+        self.stopped.set()
+        logger.info("all webhook workers stopped")
+
+    def serve(self):
+        '''
+        Start, then run until SIGINT / SIGTERM is received and shutdown is complete.
+        '''
+        self.start()
+
+        stopRequested = threading.Event()
+
+        def requestStop(signum, frame):
+            stopRequested.set()
+
+        signal.signal(signal.SIGINT, requestStop)
+        signal.signal(signal.SIGTERM, requestStop)
+
+        while not stopRequested.wait(1):
+            # restart any worker which has died unexpectedly
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("worker %d exited with code %s, restarting it", i, process.exitcode)
+                    self.processes[i] = self.startWorker(i)
+
+        self.stop()
@@ -0,0 +1,15 @@
+# ------------------------------------------------------------------------------
+# Test Setup
+# ------------------------------------------------------------------------------
+# bot.py reads credentials.py, which only exists once the bot has been set up,
+# so tests without one use the values in credentials_template.py (no test talks
+# to telegram, only to the local stand-in in fake_bot_api.py).
+# ------------------------------------------------------------------------------
+
+import importlib
+import sys
+
+try:
+    importlib.import_module("covert_chess_bot.credentials")
+except ImportError:
+    sys.modules["covert_chess_bot.credentials"] = importlib.import_module("covert_chess_bot.credentials_template")
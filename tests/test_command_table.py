@@ -0,0 +1,29 @@
+# ------------------------------------------------------------------------------
+# Command Table Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+from types import SimpleNamespace
+import pytest
+from covert_chess_bot import command_table
+
+@pytest.mark.parametrize("text, parsed", [
+    ("/encode", ("encode", None, "")),
+    ("/Decode@CovertChessBot  🎮😀 ", ("decode", "CovertChessBot", "🎮😀")),
+    ("/mix fen\nmessage=hello", ("mix", None, "fen\nmessage=hello")),
+    ("hello", None),
+    ("/", None),
+    ("/-x", None),
+    (None, None),
+])
+def test_parse_command(text, parsed):
+    assert command_table.parseCommand(text) == parsed
+
+def test_dispatch_ignores_text_which_isnt_a_command():
+    from covert_chess_bot import bot
+
+    # e.g. a bot_command entity which isn't \w+, passes Filters.command but not commandPattern
+    update = SimpleNamespace(message=SimpleNamespace(text="/-x"))
+
+    assert bot.dispatch_command(update, SimpleNamespace()) == None
@@ -0,0 +1,120 @@
+# ------------------------------------------------------------------------------
+# Covert Chess Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import pytest
+from covert_chess_bot import command_table, covert_chess, framing
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# original scheme encodings written by the bot before the dense scheme was added,
+# which must always decode to the same position
+ORIGINAL_ENCODINGS = {
+    START_FEN: "♟️👯‍♂️😤🧑🏻‍🔧👨🏿‍🦽🎥☄️👐🏿👩🏼‍🦼📟👩‍🦰🚣🏼‍♂️🧯💁🏿🤾🏾‍♀️🅰️👩🏿‍🏫🥔😄👼🏾📇🧑🏾‍🦲🧑‍🚀😀🤖",
+    "r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4": "♟️💛😱🧑🏻‍🔧🧑🏾‍🦽🎥🧨🙏👩🏼‍🦼📟🚴🏼‍♂️🥍😗💁🏿🤾🏾‍♀️🅰️👩🏿‍🏫🥔🇬🇸👼🏾📹😆🧑‍🚀😀👧🏽",
+    "8/8/8/4k3/8/8/4K3/8 b - - 50 80": "🎮😀👳🏾‍♀️🌄🤚🧜🏽‍♂️☄️👐🏿👩🏼‍🦼📟👑🚣🏼‍♂️🧯💁🏿🤾🏾‍♀️🅰️👩🏾‍🏫👩‍❤️‍💋‍👨🧑🏼‍🔧👨🏽‍🎤🌴🇹🇿🕵🏿‍♂️😄🛀🏿",
+}
+
+def loadFens():
+    with open("data/positions.txt", "r", encoding="utf8") as positionsFile:
+        return [line.strip() for line in positionsFile if line.strip() != ""]
+
+@pytest.mark.parametrize("scheme", [covert_chess.DENSE_SCHEME, covert_chess.ORIGINAL_SCHEME])
+def test_round_trip(scheme):
+    for fen in loadFens() + list(ORIGINAL_ENCODINGS):
+        encoding = covert_chess.encode(fen, scheme)
+        assert covert_chess.positionScheme(covert_chess.findEmoji(encoding)) == scheme
+        assert covert_chess.decode(encoding) == fen
+
+def test_original_scheme_is_default_and_dense_shorter():
+    for fen in loadFens():
+        dense = covert_chess.findEmoji(covert_chess.encode(fen, covert_chess.DENSE_SCHEME))
+        original = covert_chess.findEmoji(covert_chess.encode(fen))
+        assert covert_chess.positionScheme(original) == covert_chess.ORIGINAL_SCHEME
+        assert len(dense) == covert_chess.positionLength(dense) < len(original) == covert_chess.originalSchemeLength
+
+def test_dense_edge_positions():
+    for fen in ["8/8/8/8/8/8/8/8 w - - 0 1",
+                "4k3/8/8/8/8/8/8/4K3 b - - 100 9999",
+                "r3k2r/pppppppp/8/3pP3/8/8/PPPP1PPP/R3K2R w KQkq d6 0 12"]:
+        assert covert_chess.decode(covert_chess.encode(fen, covert_chess.DENSE_SCHEME)) == fen
+
+def test_dense_header_range():
+    first = covert_chess.denseSchemeFirstIndex
+    for index in range(first + 1, first + covert_chess.denseSchemeMaxDigits + 1):
+        assert covert_chess.positionScheme([covert_chess.emojiList[index]]) == covert_chess.DENSE_SCHEME
+
+    # resignation marker, and other emoji above the dense headers, start no position
+    for index in (first, first + covert_chess.denseSchemeMaxDigits + 1, 2500, covert_chess.resignIndex, 3177):
+        with pytest.raises(ValueError):
+            covert_chess.positionScheme([covert_chess.emojiList[index]])
+        assert not covert_chess.isCompletePosition(covert_chess.emojiList[index] * 30)
+
+@pytest.mark.parametrize("fen", [
+    "4k3/8/8/8/8/8/8/4K3 w kK - 0 1",
+    "4k3/8/8/8/8/8/8/4K3 w KX - 0 1",
+    "4k3/8/8/8/8/8/8/4K3 w  - 0 1",
+    "4k3/8/8/8/8/8/8/4K3 w - e4 0 1",
+    "4k3/8/8/8/8/8/8/4K3 w - e 0 1",
+    "4k3/8/8/8/8/8/8/4K3 w - - 0 10000",
+])
+def test_dense_rejects_bad_fields(fen):
+    with pytest.raises(ValueError):
+        covert_chess.encodeDense(fen)
+
+def test_original_encodings_still_decode():
+    for fen, encoding in ORIGINAL_ENCODINGS.items():
+        assert covert_chess.encode(fen, covert_chess.ORIGINAL_SCHEME) == encoding
+        assert covert_chess.decode(encoding) == fen
+        assert framing.findPositions(f"look 👍 {encoding} 🎉")[0]["fen"] == fen
+
+def test_resigned_and_mixed():
+    for scheme in (covert_chess.DENSE_SCHEME, covert_chess.ORIGINAL_SCHEME):
+        encoding = covert_chess.encode(START_FEN, scheme)
+        resigned = encoding + covert_chess.emojiList[covert_chess.resignIndex]
+
+        assert covert_chess.isResigned(resigned)
+        assert not covert_chess.isResigned(encoding)
+        assert covert_chess.decode(resigned) == START_FEN
+
+        mixed = covert_chess.mix(resigned, "The quick brown fox jumps over the lazy dog.")
+        assert covert_chess.unmix(mixed) == resigned
+        assert framing.findPositions(mixed) == [{"emoji": resigned, "fen": START_FEN, "scheme": scheme, "resigned": True}]
+
+def test_incomplete_position_rejected():
+    for scheme in (covert_chess.DENSE_SCHEME, covert_chess.ORIGINAL_SCHEME):
+        positionEmoji = covert_chess.findEmoji(covert_chess.encode(START_FEN, scheme))
+        partial = "".join(positionEmoji[:-1])
+
+        assert not covert_chess.isCompletePosition(partial)
+        with pytest.raises(ValueError):
+            covert_chess.decode(partial)
+        assert framing.findPositions(partial) == []
+
+# valid FEN positions whose pieces couldn't be on the board in a real game
+IMPOSSIBLE_FENS = [
+    "8/8/8/8/8/8/8/8 w - - 0 1",
+    "4k3/8/8/8/8/8/8/3KK3 w - - 0 1",
+    "P3k3/8/8/8/8/8/8/4K3 w - - 0 1",
+    "QQQQQQQQ/QQQQQQQQ/QQQQQQQQ/8/8/8/8/4K2k b - - 0 1",
+]
+
+@pytest.mark.parametrize("scheme", [covert_chess.DENSE_SCHEME, covert_chess.ORIGINAL_SCHEME])
+@pytest.mark.parametrize("fen", IMPOSSIBLE_FENS)
+def test_impossible_positions_still_encode_and_decode(fen, scheme):
+    assert not framing.isPossiblePlacement(fen)
+
+    encoding = covert_chess.encode(fen, scheme)
+    resigned = encoding + covert_chess.emojiList[covert_chess.resignIndex]
+
+    # a plain position is decoded strictly
+    assert covert_chess.decode(encoding) == fen
+    assert framing.readPositions(encoding) == [{"emoji": encoding, "fen": fen, "scheme": scheme, "resigned": False}]
+    assert framing.readPositions(resigned)[0]["resigned"]
+    assert command_table.positionFen(encoding) == fen
+
+    # placement check only frames positions in noisy text
+    assert framing.findPositions(f"look 👍 {encoding} 🎉") == []
+    assert framing.readPositions(f"look 👍 {encoding} 🎉") == []
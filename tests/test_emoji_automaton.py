@@ -0,0 +1,91 @@
+# ------------------------------------------------------------------------------
+# Emoji Automaton Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import random
+import pytest
+from covert_chess_bot import covert_chess
+from covert_chess_bot.emoji_automaton import EmojiAutomaton
+
+# emoji which start or end with other emoji (skin tones, zwj sequences, flags,
+# keycaps & variation selectors), where leftmost longest matching matters
+OVERLAPPING = ["👍", "👍🏽", "🏽", "👨", "👩", "👨‍👩‍👧‍👦", "👩‍❤️‍💋‍👨", "👨‍🦰", "🏳️", "🏳️‍🌈", "🇬🇧", "🇬", "#️⃣", "❤️", "❤", "‍", "️", "♟️"]
+
+@pytest.fixture(scope="module")
+def automaton():
+    return EmojiAutomaton(covert_chess.emojiIndexes)
+
+def randomText(rng):
+    '''
+    Returns text of emoji (often overlapping ones), both qualified forms, and plain text.
+    '''
+    parts = []
+    for i in range(rng.randint(0, 40)):
+        choice = rng.random()
+        if choice < 0.4:
+            parts.append(rng.choice(OVERLAPPING))
+        elif choice < 0.6:
+            parts.append(rng.choice(covert_chess.emojiList))
+        elif choice < 0.7:
+            parts.append(rng.choice(covert_chess.emojiListLessQualified))
+        else:
+            parts.append(rng.choice(["a", " ", "hello ", "é", "\n", "1", "#"]))
+
+    return "".join(parts)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_same_emoji_as_find_emoji(automaton, seed):
+    rng = random.Random(seed)
+
+    for i in range(50):
+        text = randomText(rng)
+        assert automaton.findAll(text) == [covert_chess.emojiIndex(emoji) for emoji in covert_chess.findEmoji(text)]
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_matches_in_any_pieces(automaton, seed):
+    rng = random.Random(seed)
+
+    for i in range(50):
+        text = randomText(rng)
+        expected = automaton.findAll(text)
+
+        # fed a character at a time, and in random pieces, by separate streams
+        stream = automaton.stream()
+        matches = []
+        for character in text:
+            matches += stream.feed(character)
+        matches += stream.flush()
+        assert [index for start, index in matches] == expected
+
+        cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 6))))
+        stream = automaton.stream()
+        matches = []
+        start = 0
+        for end in cuts + [len(text)]:
+            matches += stream.feed(text[start:end])
+            start = end
+        matches += stream.flush()
+        assert [index for start, index in matches] == expected
+
+def test_leftmost_longest(automaton):
+    thumbsUp = covert_chess.emojiIndex("👍")
+    mediumThumbsUp = covert_chess.emojiIndex("👍🏽")
+    man = covert_chess.emojiIndex("👨")
+    woman = covert_chess.emojiIndex("👩")
+    family = covert_chess.emojiIndex("👨‍👩‍👧‍👦")
+
+    # longest emoji starting at the leftmost position wins over the emoji it starts with
+    assert automaton.findAll("👍🏽") == [mediumThumbsUp]
+    assert automaton.findAll("👍👍🏽👍") == [thumbsUp, mediumThumbsUp, thumbsUp]
+    assert automaton.findAll("👨👨‍👩‍👧‍👦👩") == [man, family, woman]
+    # zwj sequence cut short is the emoji it is made of
+    assert automaton.findAll("👨‍👩‍") == [man, woman]
+
+    # a match isn't returned while it could still grow
+    stream = automaton.stream()
+    assert stream.feed("x👍") == []
+    assert stream.feed("🏽") == []
+    assert stream.feed(" ") == [(1, mediumThumbsUp)]
+    assert stream.flush() == []
@@ -0,0 +1,83 @@
+# ------------------------------------------------------------------------------
+# Engine Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+from covert_chess_bot import engine
+from covert_chess_bot.position import Position
+
+def test_evaluation_is_symmetric():
+    start = Position.fromFen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+    assert engine.evaluate(start) == 0
+
+    # same position with colours swapped scores the same for the side to move
+    e4 = Position.fromFen("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1")
+    e5 = Position.fromFen("rnbqkbnr/pppp1ppp/8/4p3/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+    assert engine.evaluate(e4) == engine.evaluate(e5) < 0
+
+@pytest.mark.parametrize("fen, move, mate", [
+    ("6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1", "Ra8#", 1),
+    ("r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4", "Qxf7#", 1),
+    # only move, then mated
+    ("k7/8/1K6/8/8/8/8/7R b - - 0 1", "Kb8", -1),
+])
+def test_finds_mates(fen, move, mate):
+    hint = engine.suggestMove(fen, 1.0)
+
+    assert (hint["move"], hint["mate"]) == (move, mate)
+    assert hint["line"][0] == move
+    assert hint["fen"] == Position.fromFen(fen).push(Position.fromFen(fen).parseSan(move)).fen()
+
+def test_wins_material():
+    hint = engine.suggestMove("4k3/8/8/3q4/8/8/3R4/3K4 w - - 0 1", 0.3)
+
+    assert hint["move"] == "Rxd5"
+    assert hint["score"] > 300 and hint["mate"] == None
+
+def test_no_hint_without_legal_moves():
+    # checkmate & stalemate
+    assert engine.suggestMove("k7/8/8/8/8/8/1r6/Kr6 w - - 0 1", 0.3) == None
+    assert engine.suggestMove("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1", 0.3) == None
+
+    with pytest.raises(ValueError):
+        engine.suggestMove("8/8/8/8/8/8/8/4K3 w - - 0 1", 0.3)
+
+class BrokenExecutor:
+    '''
+    Stands in for a process pool whose worker was killed.
+    '''
+
+    def submit(self, *args):
+        raise BrokenProcessPool("worker killed")
+
+def test_hint_pool_starts_processes_on_first_search():
+    hints = engine.HintPool(seconds=0.2)
+    try:
+        assert hints.executor == None
+
+        future = hints.submit("4k3/8/8/8/8/8/8/R3K3 w - - 0 1", key=1)
+        assert hints.executor != None
+        assert future.result(timeout=60)["move"] != None
+    finally:
+        hints.shutdown()
+
+    assert not hints.isBusy(1)
+    with pytest.raises(RuntimeError):
+        hints.submit("4k3/8/8/8/8/8/8/R3K3 w - - 0 1", key=1)
+
+def test_failed_resubmit_doesnt_leave_key_busy(monkeypatch):
+    hints = engine.HintPool()
+    # every pool is broken, so resubmitting after the 1st breaks too
+    monkeypatch.setattr(hints, "searchExecutor", lambda: BrokenExecutor())
+
+    for attempt in range(hints.maxPending + 1):
+        with pytest.raises(BrokenProcessPool):
+            hints.submit("4k3/8/8/8/8/8/8/R3K3 w - - 0 1", key=1)
+
+        assert not hints.isBusy(1)
+        assert hints.pending == 0
+
+    hints.shutdown()
@@ -0,0 +1,82 @@
+# ------------------------------------------------------------------------------
+# Move Check Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import pytest
+from covert_chess_bot import covert_chess, move_check
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# previous FEN, FEN after one legal move, the move
+LEGAL_MOVES = [
+    (START_FEN, "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1", "1. e4"),
+    # en passant square left out, as no pawn can take on it
+    (START_FEN, "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1", "1. e4"),
+    ("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1", "rnbqkb1r/pppppppp/5n2/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 1 2", "1... Nf6"),
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", "r3k2r/8/8/8/8/8/8/R4RK1 b kq - 1 1", "1. O-O"),
+    ("r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1", "2kr3r/8/8/8/8/8/8/R3K2R w KQ - 1 2", "1... O-O-O"),
+    ("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 2", "4k3/8/3P4/8/8/8/8/4K3 b - - 0 2", "2. exd6"),
+    ("4k3/P7/8/8/8/8/8/4K3 w - - 3 40", "Q3k3/8/8/8/8/8/8/4K3 b - - 0 40", "40. a8=Q+"),
+]
+
+# previous FEN, FEN after, a word from the problem found
+ILLEGAL_MOVES = [
+    # knight can't move there
+    (START_FEN, "rnbqkbnr/pppppppp/8/8/8/1N6/PPPPPPPP/R1BQKBNR b KQkq - 1 1", "isn't one legal move"),
+    # bishop is pinned to its king
+    ("4k3/4r3/8/8/8/8/4B3/4K3 w - - 0 1", "4k3/4r3/8/8/8/3B4/8/4K3 b - - 1 1", "isn't one legal move"),
+    # black's piece moved on white's turn
+    (START_FEN, "rnbqkb1r/pppppppp/5n2/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 1 1", "isn't one legal move"),
+    # two moves at once
+    (START_FEN, "rnbqkbnr/pppppppp/8/8/3PP3/8/PPP2PPP/RNBQKBNR b KQkq - 0 1", "isn't one legal move"),
+    (START_FEN, START_FEN, "no piece has moved"),
+    # legal board, but the rest of the position is wrong
+    (START_FEN, "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 1", "to move"),
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", "r3k2r/8/8/8/8/8/8/R4K1R b KQkq - 1 1", "castling rights"),
+    (START_FEN, "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 1 1", "half move clock"),
+    ("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1", "rnbqkb1r/pppppppp/5n2/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 1 1", "full move number"),
+]
+
+SCHEMES = [
+    (covert_chess.ORIGINAL_SCHEME, covert_chess.ORIGINAL_SCHEME),
+    (covert_chess.DENSE_SCHEME, covert_chess.DENSE_SCHEME),
+    (covert_chess.ORIGINAL_SCHEME, covert_chess.DENSE_SCHEME),
+]
+
+def encodings(previousFen, currentFen, schemes):
+    '''
+    Returns message with both positions encoded in given schemes, among other text & emoji.
+    '''
+    previousScheme, currentScheme = schemes
+
+    return f"was 👍 {covert_chess.encode(previousFen, previousScheme)} now {covert_chess.encode(currentFen, currentScheme)} 🎉"
+
+@pytest.mark.parametrize("schemes", SCHEMES)
+@pytest.mark.parametrize("previousFen, currentFen, move", LEGAL_MOVES)
+def test_legal_moves(previousFen, currentFen, move, schemes):
+    result = move_check.checkEncodings(encodings(previousFen, currentFen, schemes))
+
+    assert result["legal"], result["problems"]
+    assert result["move"] == move
+    assert result["fen"] == currentFen
+    assert move_check.checkPositions(previousFen, currentFen) == result
+
+@pytest.mark.parametrize("schemes", SCHEMES)
+@pytest.mark.parametrize("previousFen, currentFen, problem", ILLEGAL_MOVES)
+def test_illegal_moves(previousFen, currentFen, problem, schemes):
+    result = move_check.checkEncodings(encodings(previousFen, currentFen, schemes))
+
+    assert not result["legal"]
+    assert any(problem in text for text in result["problems"])
+
+def test_checked_against_previous_fen():
+    e4 = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+
+    assert move_check.checkEncodings(covert_chess.encode(e4), previousFen=START_FEN)["legal"]
+
+    with pytest.raises(ValueError):
+        move_check.checkEncodings(covert_chess.encode(e4))
+    with pytest.raises(ValueError):
+        move_check.checkEncodings("no positions here 👍", previousFen=START_FEN)
@@ -0,0 +1,73 @@
+# ------------------------------------------------------------------------------
+# Openings Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import pytest
+from covert_chess_bot import openings
+from covert_chess_bot.position import Position
+
+OPENINGS = """eco	name	pgn
+B00	King's Pawn Game	1. e4
+C20	King's Pawn Game: Open Game	1. e4 e5
+C44	King's Knight Opening	1. e4 e5 2. Nf3 Nc6
+C44	King's Knight Opening: transposed	1. Nf3 Nc6 2. e4 e5
+A04	Zukertort Opening	1. Nf3
+
+"""
+
+def fenAfter(sans):
+    position = Position.fromFen(openings.startingFen)
+    for san in sans:
+        position = position.push(position.parseSan(san))
+    return position.fen()
+
+@pytest.fixture
+def index(tmp_path):
+    openingsLocation = tmp_path / "openings.tsv"
+    openingsLocation.write_text(OPENINGS, encoding="utf8")
+    indexLocation = tmp_path / "openings.idx"
+
+    # the transposed line reaches an opening already listed, which is kept
+    assert openings.buildIndex(openingsLocation, indexLocation) == 4
+
+    return openings.OpeningIndex(indexLocation)
+
+def test_lookup(index):
+    def name(sans):
+        return index.lookup(Position.fromFen(fenAfter(sans)).zobristKey())
+
+    assert name(["e4"]) == "B00 King's Pawn Game"
+    assert name(["e4", "e5", "Nf3", "Nc6"]) == "C44 King's Knight Opening"
+    assert name(["Nf3", "Nc6", "e4", "e5"]) == "C44 King's Knight Opening"
+    assert name(["Nf3"]) == "A04 Zukertort Opening"
+    assert name(["d4"]) == None
+    assert name([]) == None
+
+def test_bad_files_rejected(tmp_path):
+    openingsLocation = tmp_path / "openings.tsv"
+    openingsLocation.write_text("eco\tname\tpgn\nA00\tNonsense\t1. e5\n", encoding="utf8")
+    with pytest.raises(ValueError, match="line 2"):
+        openings.buildIndex(openingsLocation, tmp_path / "openings.idx")
+
+    notIndex = tmp_path / "not.idx"
+    notIndex.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        openings.OpeningIndex(notIndex)
+
+def test_opening_name(index, monkeypatch):
+    monkeypatch.setattr(openings, "index", index)
+
+    # clocks & move numbers don't matter, only the position
+    assert openings.openingName(fenAfter(["e4", "e5"]).replace(" 0 2", " 3 7")) == "C20 King's Pawn Game: Open Game"
+    assert openings.openingName("not a fen") == None
+
+def test_missing_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(openings, "index", None)
+    monkeypatch.setattr(openings, "indexFileLocation", str(tmp_path / "missing.idx"))
+
+    # openings just aren't recognised, and the missing file isn't looked for again
+    assert openings.openingName(fenAfter(["e4"])) == None
+    assert openings.index == False
+    assert openings.openingName(fenAfter(["e4"])) == None
@@ -0,0 +1,101 @@
+# ------------------------------------------------------------------------------
+# Position Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import pytest
+from covert_chess_bot.position import Position
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# well known perft results (number of move sequences of each length), covering
+# castling, en passant, promotion, pins & discovered checks
+# https://www.chessprogramming.org/Perft_Results
+PERFT = [
+    (START_FEN, [20, 400, 8902]),
+    ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862]),
+    ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238]),
+    ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467]),
+    ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379]),
+]
+
+def perft(position, depth):
+    '''
+    Returns number of sequences of legal moves of given length from position.
+    '''
+    moves = position.legalMoves()
+    if depth == 1:
+        return len(moves)
+
+    return sum(perft(position.push(move), depth - 1) for move in moves)
+
+def loadFens():
+    with open("data/positions.txt", "r", encoding="utf8") as positionsFile:
+        return [line.strip() for line in positionsFile if line.strip() != ""]
+
+@pytest.mark.parametrize("fen, counts", PERFT)
+def test_perft(fen, counts):
+    position = Position.fromFen(fen)
+
+    assert [perft(position, depth) for depth in range(1, len(counts) + 1)] == counts
+
+@pytest.mark.parametrize("fen", [fen for fen, counts in PERFT])
+def test_san_round_trip(fen):
+    position = Position.fromFen(fen)
+
+    for move in position.legalMoves():
+        assert position.parseSan(position.san(move)) == move
+
+        after = position.push(move)
+        for reply in after.legalMoves():
+            assert after.parseSan(after.san(reply)) == reply
+
+def test_san():
+    position = Position.fromFen("4k3/8/8/8/8/5N2/8/RN2K2R w KQ - 0 1")
+
+    assert position.san(position.parseSan("Nbd2")) == "Nbd2"
+    assert position.san(position.parseSan("O-O")) == "O-O"
+    assert position.san(position.parseSan("Ra8")) == "Ra8+"
+    with pytest.raises(ValueError):
+        position.parseSan("Nd2")
+    with pytest.raises(ValueError):
+        position.parseSan("Ke3e4")
+
+    # fool's mate
+    position = Position.fromFen(START_FEN)
+    moves = []
+    for san in ["f3", "e5", "g4", "Qh4"]:
+        move = position.parseSan(san)
+        moves.append(position.san(move))
+        position = position.push(move)
+    assert moves == ["f3", "e5", "g4", "Qh4#"]
+    assert position.legalMoves() == [] and position.isCheck()
+
+def test_fen_round_trip():
+    for fen in loadFens():
+        assert Position.fromFen(fen).fen() == fen
+
+    with pytest.raises(ValueError):
+        Position.fromFen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBN w KQkq - 0 1")
+
+def test_zobrist_key():
+    def play(sans):
+        position = Position.fromFen(START_FEN)
+        for san in sans:
+            position = position.push(position.parseSan(san))
+        return position
+
+    # same position reached by a different move order
+    assert play(["Nf3", "Nf6", "Nc3"]).zobristKey() == play(["Nc3", "Nf6", "Nf3"]).zobristKey()
+    assert play(["Nf3", "Nf6", "Nc3"]).zobristKey() != play(["Nf3", "Nc6", "Nc3"]).zobristKey()
+
+    # en passant square only counts when a pawn could take on it
+    assert (Position.fromFen("4k3/8/8/8/4P3/8/8/4K3 b - e3 0 1").zobristKey()
+            == Position.fromFen("4k3/8/8/8/4P3/8/8/4K3 b - - 0 1").zobristKey())
+    assert (Position.fromFen("4k3/8/8/8/3pP3/8/8/4K3 b - e3 0 1").zobristKey()
+            != Position.fromFen("4k3/8/8/8/3pP3/8/8/4K3 b - - 0 1").zobristKey())
+
+    # castling rights & side to move
+    assert Position.fromFen(START_FEN).zobristKey() != Position.fromFen(START_FEN.replace("KQkq", "KQk")).zobristKey()
+    assert Position.fromFen(START_FEN).zobristKey() != Position.fromFen(START_FEN.replace(" w ", " b ")).zobristKey()
@@ -0,0 +1,104 @@
+# ------------------------------------------------------------------------------
+# Reminders Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import random
+import time
+import pytest
+from covert_chess_bot import reminders
+from covert_chess_bot.reminders import ReminderStore, TimingWheel, WHEEL_SLOTS, WHEEL_LEVELS
+
+@pytest.mark.parametrize("seed", range(3))
+def test_keys_expire_at_due_tick_across_levels(seed):
+    rng = random.Random(seed)
+    # just before every level's slots roll over, so keys cascade down from each level
+    start = WHEEL_SLOTS ** (WHEEL_LEVELS - 1) - 10
+    wheel = TimingWheel(start)
+
+    due = {}
+    for key in range(500):
+        # spread over every level of the wheel
+        due[key] = start + 1 + int(rng.choice([WHEEL_SLOTS, WHEEL_SLOTS ** 2, WHEEL_SLOTS ** 3]) * rng.random())
+        wheel.schedule(key, due[key], value=key * 2)
+
+    # rescheduled & cancelled keys only expire at their new time, or not at all
+    for key in range(0, 500, 7):
+        due[key] = start + 1 + rng.randrange(WHEEL_SLOTS ** 2)
+        wheel.schedule(key, due[key], value=key * 2)
+    for key in range(3, 500, 11):
+        assert wheel.cancel(key)
+        del due[key]
+    assert not wheel.cancel(3)
+    assert len(wheel) == len(due)
+
+    # advanced a few ticks at a time, or far in one go
+    tick = start
+    end = max(due.values())
+    while tick < end:
+        toTick = min(end, tick + rng.choice([1, 5, 63, 64, 1000, 5000]))
+        expired = wheel.advance(toTick)
+
+        assert all(value == key * 2 for key, value in expired)
+        assert [due[key] for key, value in expired] == sorted(due[key] for key, value in expired)
+        assert {key for key, value in expired} == {key for key, dueTick in due.items() if tick < dueTick <= toTick}
+        tick = toTick
+
+    assert len(wheel) == 0
+
+def test_past_due_key_expires_on_next_tick():
+    wheel = TimingWheel(100)
+    wheel.schedule("late", 50)
+
+    assert wheel.advance(100) == []
+    assert wheel.advance(101) == [("late", None)]
+
+    with pytest.raises(ValueError):
+        wheel.schedule("far", wheel.tick + 1 + WHEEL_SLOTS ** WHEEL_LEVELS)
+
+def test_reminders_sent_deferred_and_kept_across_restart(tmp_path, monkeypatch):
+    database = str(tmp_path / "reminders.db")
+    batches = []
+    deferred = [("", 1)]
+
+    def deliver(batch):
+        batches.append(batch)
+        return [key for key in deferred if key in dict(batch)]
+
+    store = ReminderStore(database, deliver, tickSeconds=1)
+    store.set(("", 1), 1, "fen")
+    store.set(("", 2), 2, "fen")
+    store.set(("", 3), 1, "fen")
+    assert store.cancel(("", 3))
+    store.close()
+
+    # loaded back after a restart
+    store = ReminderStore(database, deliver, tickSeconds=1)
+    # ticked by hand below, at made up times
+    store.stopped.set()
+    store.thread.join()
+    assert store.get(("", 1)) == 1 and store.get(("", 2)) == 2 and store.get(("", 3)) == None
+
+    now = time.time()
+    monkeypatch.setattr(reminders.time, "time", lambda: now + 3600 + 5)
+    store.expire()
+    assert batches.pop() == [(("", 1), 1)]
+
+    # couldn't be sent, so tried again next tick
+    deferred = []
+    monkeypatch.setattr(reminders.time, "time", lambda: now + 3600 + 7)
+    store.expire()
+    assert batches.pop() == [(("", 1), 1)]
+
+    # not due again until there is a new position
+    monkeypatch.setattr(reminders.time, "time", lambda: now + 3 * 3600 + 10)
+    store.expire()
+    assert batches.pop() == [(("", 2), 2)]
+
+    store.touch(("", 1), "new fen")
+    monkeypatch.setattr(reminders.time, "time", lambda: now + 4 * 3600 + 20)
+    store.expire()
+    assert batches.pop() == [(("", 1), 1)]
+
+    store.close()
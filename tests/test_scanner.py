@@ -0,0 +1,84 @@
+# ------------------------------------------------------------------------------
+# Scanner Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import json
+import multiprocessing
+import pytest
+from covert_chess_bot import covert_chess, scanner
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+E4_FEN = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+ENDGAME_FEN = "8/8/8/4k3/8/8/4K3/8 b - - 50 80"
+
+def writeExport(directory):
+    '''
+    Writes a full account export of two chats, returns its location.
+    '''
+    start = covert_chess.findEmoji(covert_chess.encode(START_FEN, covert_chess.ORIGINAL_SCHEME))
+    e4 = covert_chess.encode(E4_FEN, covert_chess.DENSE_SCHEME)
+    endgame = covert_chess.encode(ENDGAME_FEN, covert_chess.ORIGINAL_SCHEME)
+
+    export = {
+        # escaped in the export, so not the start of a chat's messages
+        "about": 'telegram export, with "messages": [ in text',
+        "chats": {"list": [
+            {"name": "Alice", "type": "personal_chat", "id": 111, "messages": [
+                {"id": 1, "type": "message", "text": "plain ascii"},
+                # position split over two messages, the 2nd formatted
+                {"id": 2, "type": "message", "text": "my move 👍 " + "".join(start[:12])},
+                {"id": 3, "type": "message", "text": [{"type": "bold", "text": "".join(start[12:])}, " done"]},
+                {"id": 4, "type": "message", "text": f"then {e4}"},
+                {"id": 5, "type": "message", "text": "🏳️"},
+            ]},
+            {"name": "Bob", "type": "personal_chat", "id": -222, "messages": [
+                {"id": 7, "type": "service", "action": "pin_message"},
+                {"id": 8, "type": "message", "text": covert_chess.mix(endgame, "The quick brown fox jumps over the lazy dog.")},
+                {"id": 9, "type": "message", "text": "😀😀 no position"},
+            ]},
+        ]},
+    }
+
+    location = directory / "result.json"
+    location.write_text(json.dumps(export, ensure_ascii=False, indent=1), encoding="utf8")
+
+    return location
+
+@pytest.mark.parametrize("readSize", [1, 7, 64, scanner.READ_SIZE])
+def test_messages_read_incrementally(tmp_path, readSize):
+    location = writeExport(tmp_path)
+    export = json.loads(location.read_text(encoding="utf8"))
+
+    expected = [(chat["id"], message) for chat in export["chats"]["list"] for message in chat["messages"]]
+
+    assert list(scanner.readMessages(location, readSize)) == expected
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_positions_found_across_messages(tmp_path, workers):
+    location = writeExport(tmp_path)
+
+    # batches handed to worker processes still give positions in file order
+    if workers:
+        with multiprocessing.Pool(workers, initializer=scanner.startWorker) as pool:
+            positions = list(scanner.scanFile(location, pool, batchSize=2))
+    else:
+        positions = list(scanner.scanFile(location, batchSize=2))
+
+    found = [(position["chat_id"], position["message_ids"], position["scheme"], position["fen"], position["resigned"])
+             for position in positions]
+
+    assert found == [
+        (111, [2, 3], covert_chess.ORIGINAL_SCHEME, START_FEN, False),
+        (111, [4, 5], covert_chess.DENSE_SCHEME, E4_FEN, True),
+        (-222, [8], covert_chess.ORIGINAL_SCHEME, ENDGAME_FEN, False),
+    ]
+
+def test_truncated_export_rejected(tmp_path):
+    location = writeExport(tmp_path)
+    text = location.read_text(encoding="utf8")
+    location.write_text(text[:text.index('"id": 4')], encoding="utf8")
+
+    with pytest.raises(ValueError):
+        list(scanner.readMessages(location, 64))
@@ -0,0 +1,118 @@
+# ------------------------------------------------------------------------------
+# Send Queue Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import logging
+from concurrent.futures import Future
+from types import SimpleNamespace
+from covert_chess_bot import send_queue
+from covert_chess_bot.fake_bot_api import FakeBotApi
+from covert_chess_bot.send_queue import SendQueue, TokenBucket, PRIORITY_BULK
+from covert_chess_bot.telegram_request import MeteredRequest
+
+from telegram import Bot
+from telegram.error import Unauthorized
+
+# seconds sends may arrive early at the fake api, as they are timed there rather than when sent
+TOLERANCE = 0.05
+
+def withinLimit(times, rate, burst):
+    '''
+    Checks sorted send times never exceed a token bucket of given rate & burst.
+    '''
+    bucket = TokenBucket(rate, burst, times[0] if times else 0)
+
+    for now in times:
+        if bucket.waitTime(now) > TOLERANCE:
+            return False
+        bucket.tokens -= 1
+
+    return True
+
+def test_replies_sent_within_limits_before_bulk_messages():
+    chats = 20
+    messagesPerChat = 3
+    bulkChats = 40
+
+    # fake api rejects anything over telegram's limits with a 429
+    fakeApi = FakeBotApi()
+    sendQueue = SendQueue(Bot("123456:test", base_url=fakeApi.baseUrl, request=MeteredRequest(con_pool_size=8)))
+
+    try:
+        # queue everything before any of it is sent, bulk messages first
+        with sendQueue.condition:
+            for chatId in range(bulkChats):
+                sendQueue.send(-chatId - 1, f"bulk {chatId}", priority=PRIORITY_BULK)
+            for i in range(messagesPerChat):
+                for chatId in range(1, chats + 1):
+                    sendQueue.send(chatId, f"reply {i}")
+
+        assert sendQueue.join(timeout=60)
+    finally:
+        sendQueue.stop()
+        fakeApi.stop()
+
+    assert len(fakeApi.sent) == chats * messagesPerChat + bulkChats
+    assert fakeApi.rejected == 0
+
+    times = sorted(time for time, method, parameters in fakeApi.sent)
+    assert withinLimit(times, send_queue.GLOBAL_RATE, send_queue.GLOBAL_BURST)
+
+    byChat = {}
+    for time, method, parameters in fakeApi.sent:
+        byChat.setdefault(int(parameters["chat_id"]), []).append(time)
+    for chatId, chatTimes in byChat.items():
+        if chatId < 0:
+            assert withinLimit(sorted(chatTimes), send_queue.GROUP_RATE, send_queue.GROUP_BURST)
+        else:
+            assert withinLimit(sorted(chatTimes), send_queue.CHAT_RATE, send_queue.CHAT_BURST)
+
+    # every reply which could be sent straight away (a chat's burst) went before any bulk message
+    order = [int(parameters["chat_id"]) for time, method, parameters in sorted(fakeApi.sent, key=lambda sent: sent[0])]
+    firstReplies = chats * send_queue.CHAT_BURST
+    assert all(chatId > 0 for chatId in order[:firstReplies])
+
+    # and each chat's replies arrived in the order they were sent
+    for chatId in range(1, chats + 1):
+        texts = [parameters["text"] for time, method, parameters in fakeApi.sent if int(parameters["chat_id"]) == chatId]
+        assert texts == [f"reply {i}" for i in range(messagesPerChat)]
+
+class RecordingQueue:
+    '''
+    Stands in for a send queue, recording each send & returning its Future.
+    '''
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chatId, text, **kwargs):
+        future = Future()
+        self.sent.append((chatId, text, kwargs, future))
+        return future
+
+def messageUpdate(chatId, chatType, messageId):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chatId, type=chatType),
+                           message=SimpleNamespace(message_id=messageId))
+
+def test_replies_quote_group_messages_and_log_errors(monkeypatch, caplog):
+    from covert_chess_bot import bot
+
+    queue = RecordingQueue()
+    monkeypatch.setattr(bot, "sendQueue", queue)
+
+    # quoted in groups, as reply_text does, but not in private chats
+    bot.reply(messageUpdate(-5, "group", 10), "group reply")
+    bot.reply(messageUpdate(5, "private", 11), "private reply", disable_web_page_preview=True)
+    assert [(chatId, text, kwargs) for chatId, text, kwargs, future in queue.sent] == [
+        (-5, "group reply", {"reply_to_message_id": 10}),
+        (5, "private reply", {"disable_web_page_preview": True}),
+    ]
+
+    # nothing waits on the Future, so failed sends are logged
+    with caplog.at_level(logging.ERROR, logger=bot.logger.name):
+        queue.sent[0][3].set_exception(Unauthorized("Forbidden: bot was blocked by the user"))
+        queue.sent[1][3].set_result(None)
+
+    assert [record.getMessage() for record in caplog.records] == ["sending message failed: Forbidden: bot was blocked by the user"]
@@ -0,0 +1,114 @@
+# ------------------------------------------------------------------------------
+# Sessions Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import sqlite3
+import threading
+import time
+import pytest
+from covert_chess_bot.sessions import SessionStore
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+E4_FEN = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+
+@pytest.fixture
+def databaseLocation(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+def storedFen(databaseLocation, chatId):
+    '''
+    Returns fen of chat's session as written to the database, None if it hasn't been.
+    '''
+    connection = sqlite3.connect(databaseLocation)
+    try:
+        row = connection.execute("SELECT fen FROM sessions WHERE chat_id = ?", (chatId,)).fetchone()
+    finally:
+        connection.close()
+
+    return None if row == None else row[0]
+
+def test_sessions_written_on_close(databaseLocation):
+    store = SessionStore(databaseLocation, flushInterval=60)
+    store.set(1, START_FEN, "start")
+    store.set(2, E4_FEN, "e4")
+    store.close()
+
+    store = SessionStore(databaseLocation, flushInterval=60)
+    assert store.get(1).fen == START_FEN
+    assert store.get(2).encoding == "e4"
+    assert store.get(3) == None
+    store.close()
+
+def test_changed_sessions_kept_until_written(databaseLocation):
+    store = SessionStore(databaseLocation, flushInterval=60, cacheSize=2)
+
+    for chatId in range(5):
+        store.set(chatId, START_FEN, str(chatId))
+    store.shrink()
+
+    # nothing written yet, so nothing can be evicted
+    assert len(store.cache) == 5
+    assert storedFen(databaseLocation, 0) == None
+
+    store.flush()
+    store.shrink()
+
+    assert len(store.cache) <= 2
+    assert storedFen(databaseLocation, 0) == START_FEN
+    # evicted sessions are read back from the database
+    assert [store.get(chatId).encoding for chatId in range(5)] == [str(chatId) for chatId in range(5)]
+    store.close()
+
+def test_sessions_not_evicted_while_being_written(databaseLocation):
+    store = SessionStore(databaseLocation, flushInterval=60, cacheSize=1)
+    store.set(1, START_FEN, "start")
+
+    # hold the write part way, as if the database were slow
+    store.databaseLock.acquire()
+    flushing = threading.Thread(target=store.flush)
+    flushing.start()
+    time.sleep(0.1)
+
+    store.set(2, START_FEN, "other")
+    store.shrink()
+    # session being written must still be cached, as the database doesn't have it yet
+    cached = 1 in store.cache
+    if not cached:
+        store.databaseLock.release()
+        flushing.join()
+    assert cached
+
+    # changed again while being written
+    store.set(1, E4_FEN, "e4")
+
+    store.databaseLock.release()
+    flushing.join()
+
+    # latest change is still waiting to be written, so isn't evicted
+    assert 1 in store.dirty
+    store.shrink()
+    assert store.get(1).fen == E4_FEN
+
+    store.close()
+    assert storedFen(databaseLocation, 1) == E4_FEN
+
+def test_failed_write_keeps_sessions_changed(databaseLocation):
+    store = SessionStore(databaseLocation, flushInterval=60)
+    store.set(1, START_FEN, "start")
+
+    with store.databaseLock:
+        store.connection.execute("DROP TABLE sessions")
+
+    with pytest.raises(sqlite3.Error):
+        store.flush()
+
+    assert store.dirty == {1}
+    assert store.get(1).fen == START_FEN
+
+    # written once the database can be written again
+    with store.databaseLock:
+        store.connection.execute("CREATE TABLE sessions (chat_id INTEGER PRIMARY KEY, fen TEXT NOT NULL, encoding TEXT NOT NULL, updated REAL NOT NULL)")
+    store.close()
+    assert storedFen(databaseLocation, 1) == START_FEN
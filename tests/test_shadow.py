@@ -0,0 +1,42 @@
+# ------------------------------------------------------------------------------
+# Shadow Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import json
+from covert_chess_bot import covert_chess, shadow
+
+def comparisons(operation, result):
+    return shadow.shadowComparisons.values.get((operation, result), 0)
+
+def test_encode_checked_against_reference():
+    before = comparisons("encode_dense", "match")
+
+    shadow.start(1.0)
+    try:
+        covert_chess.encode("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1", covert_chess.DENSE_SCHEME)
+        covert_chess.encode("8/8/8/4k3/8/8/4K3/8 w - - 50 80", covert_chess.DENSE_SCHEME)
+    finally:
+        # makes the comparisons already queued before returning
+        shadow.stop()
+
+    assert shadow.runner == None
+    assert comparisons("encode_dense", "match") == before + 2
+
+def test_mismatches_written_before_stop(tmp_path):
+    mismatchFile = tmp_path / "shadow.jsonl"
+
+    @shadow.shadowed("test_wrong", lambda value: value + 1)
+    def wrong(value):
+        return value
+
+    shadow.start(1.0, str(mismatchFile))
+    try:
+        for value in range(5):
+            wrong(value)
+    finally:
+        shadow.stop()
+
+    lines = [json.loads(line) for line in mismatchFile.read_text(encoding="utf8").splitlines()]
+    assert [(line["args"], line["active"], line["reference"]) for line in lines] == [([value], value, value + 1) for value in range(5)]
@@ -0,0 +1,140 @@
+# ------------------------------------------------------------------------------
+# Streaming Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import random
+import pytest
+from covert_chess_bot import covert_chess, framing
+from covert_chess_bot.streaming import StreamingDecoder, PartialPositions
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# carrier text & emoji found around positions
+NOISE = ["hi ", "👍", "🎉 ok ", "😀😀", "well played ", "🏳️", "♟️", "\n"]
+
+def loadFens():
+    with open("data/positions.txt", "r", encoding="utf8") as positionsFile:
+        return [line.strip() for line in positionsFile if line.strip() != ""]
+
+def makeText(random, fens):
+    '''
+    Returns text of a few positions (either scheme, some resigned) among noise.
+    '''
+    parts = []
+    for i in range(random.randint(1, 4)):
+        parts.append(random.choice(NOISE))
+        parts.append(covert_chess.encode(random.choice(fens), random.choice([covert_chess.DENSE_SCHEME, covert_chess.ORIGINAL_SCHEME])))
+        if random.random() < 0.3:
+            parts.append(covert_chess.emojiList[covert_chess.resignIndex])
+    parts.append(random.choice(NOISE))
+
+    return "".join(parts)
+
+def streamPositions(text, cuts):
+    '''
+    Returns positions found by feeding text to a streaming decoder split at cuts (character offsets).
+    '''
+    decoder = StreamingDecoder()
+    positions = []
+
+    start = 0
+    for end in cuts + [len(text)]:
+        positions += decoder.feed(text[start:end])
+        start = end
+    positions += decoder.flush()
+
+    return [{key: value for key, value in position.items() if key != "chunks"} for position in positions]
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_positions_as_find_positions(seed):
+    rng = random.Random(seed)
+    fens = loadFens()
+
+    for i in range(40):
+        text = makeText(rng, fens)
+        expected = framing.findPositions(text)
+
+        # whole, every character on its own, and at random places (including within emoji)
+        assert streamPositions(text, []) == expected
+        assert streamPositions(text, list(range(1, len(text)))) == expected
+        assert streamPositions(text, sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(1, 10))))) == expected
+
+def test_position_assembled_across_messages():
+    positionEmoji = covert_chess.findEmoji(covert_chess.encode(START_FEN, covert_chess.ORIGINAL_SCHEME))
+    decoder = StreamingDecoder()
+
+    # each message ends with a whole emoji, so is flushed
+    assert decoder.feed("first half " + "".join(positionEmoji[:10])) == []
+    assert decoder.flush() == []
+    assert decoder.inProgress and decoder.received == 10 and decoder.needed == covert_chess.originalSchemeLength
+
+    # board squares are known as soon as their emoji arrive, 3 to an emoji
+    squares = decoder.squares()
+    assert squares[:8] == list("rnbqkbnr")
+    assert squares[28:] == [None] * 36
+
+    decoder.feed("".join(positionEmoji[10:]) + " rest")
+    positions = decoder.flush()
+
+    assert [(position["fen"], position["chunks"]) for position in positions] == [(START_FEN, 2)]
+    assert not decoder.inProgress
+
+def test_partial_positions_dropped_when_complete_or_old():
+    partialPositions = PartialPositions(maxChats=2, timeout=60)
+
+    decoders = [partialPositions.start(chatId) for chatId in range(3)]
+    # least recently used dropped beyond maxChats
+    assert partialPositions.get(0) == None
+    assert partialPositions.get(2) is decoders[2]
+
+    # dropped once it has no position in progress
+    partialPositions.keep(2, decoders[2])
+    assert partialPositions.get(2) == None
+
+    partialPositions.timeout = -1
+    assert partialPositions.get(1) == None
+
+@pytest.mark.parametrize("scheme", [covert_chess.DENSE_SCHEME, covert_chess.ORIGINAL_SCHEME])
+def test_only_fitting_emoji_continue_position(scheme):
+    positionEmoji = covert_chess.findEmoji(covert_chess.encode(START_FEN, scheme))
+    decoder = StreamingDecoder()
+    decoder.feed("".join(positionEmoji[:5]))
+    decoder.flush()
+
+    # a lone emoji (e.g. sent for its emoji info) doesn't carry on a position it doesn't complete
+    assert not decoder.couldContinue(["👍"])
+    assert not decoder.couldContinue(positionEmoji[5:6])
+    assert not decoder.couldContinue([])
+    assert decoder.couldContinue(positionEmoji[5:])
+    assert decoder.couldContinue(positionEmoji[5:] + ["👍"])
+
+    # square emoji holding more than 3 squares' worth of piece values
+    if scheme == covert_chess.ORIGINAL_SCHEME:
+        badSquares = covert_chess.emojiList[(4 * framing.SQUARE_OFFSET + 13 ** 3) % 3178]
+        assert not decoder.couldContinue([badSquares] + positionEmoji[6:])
+
+    decoder.feed("".join(positionEmoji[5:-1]))
+    decoder.flush()
+    assert decoder.couldContinue(positionEmoji[-1:])
+
+def test_lone_emoji_gets_emoji_info_while_position_in_progress():
+    from types import SimpleNamespace
+    from covert_chess_bot import bot
+
+    positionEmoji = covert_chess.findEmoji(covert_chess.encode(START_FEN, covert_chess.ORIGINAL_SCHEME))
+    replies = []
+
+    def message(text):
+        return SimpleNamespace(message=SimpleNamespace(text=text, reply_text=lambda text, **kwargs: replies.append(text)),
+                               effective_chat=SimpleNamespace(id=42), bot=SimpleNamespace(username="test_bot"))
+
+    bot.decode_command(message("/decode"), SimpleNamespace(argument="".join(positionEmoji[:10]), command=None))
+    assert replies.pop().startswith("Received 10 of 25 emoji")
+
+    bot.emoji_info(message("👍"), None)
+    assert replies.pop().startswith("Emoji ")
+
+    bot.emoji_info(message("".join(positionEmoji[10:])), None)
+    assert START_FEN in replies.pop()
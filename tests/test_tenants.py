@@ -0,0 +1,79 @@
+# ------------------------------------------------------------------------------
+# Tenants Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import http.client
+import json
+import threading
+from covert_chess_bot.fake_bot_api import FakeBotApi
+from covert_chess_bot.tenants import TenantRunner, parseTenants, tenantDatabase
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+TOKENS = {"first": "111111:first", "second": "222222:second"}
+
+def post(connection, path, body):
+    '''
+    POST body to webhook path, returns http status.
+    '''
+    connection.request("POST", path, body, {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+def test_tenants_named_by_bot_id():
+    assert parseTenants(["111111:first", "222222:second"]) == [("111111", "111111:first"), ("222222", "222222:second")]
+    assert parseTenants(TOKENS) == list(TOKENS.items())
+
+    assert tenantDatabase("data/sessions.db", "first") == "data/sessions.first.db"
+
+def test_webhook_routes_by_token_and_drops_duplicates():
+    fakeApi = FakeBotApi(enforceLimits=False)
+
+    # (tenant, bot token, update id) of every update handled
+    handled = []
+    allHandled = threading.Event()
+
+    def record(update, context):
+        handled.append((context.tenant.name, context.bot.token, update.update_id))
+        if len(handled) == 3:
+            allHandled.set()
+
+    runner = TenantRunner(TOKENS, baseUrl=fakeApi.baseUrl, webhookPort=0, listen="127.0.0.1")
+    runner.dispatcher.add_handler(TypeHandler(Update, record))
+    runner.start()
+
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", runner.webhookPort, timeout=10)
+        update = json.dumps(fakeApi.makeUpdate(1, "/start")).encode("utf8")
+
+        assert post(connection, "/" + TOKENS["first"], update) == 200
+        # re-sent by telegram, acknowledged but not handled again
+        assert post(connection, "/" + TOKENS["first"], update) == 200
+        # update ids are only unique for each bot, so the same id sent to another bot is still handled
+        assert post(connection, "/" + TOKENS["second"], update) == 200
+
+        assert post(connection, "/" + TOKENS["second"], json.dumps(fakeApi.makeUpdate(2, "/start")).encode("utf8")) == 200
+        assert post(connection, "/123456:unknown", update) == 403
+        assert post(connection, "/" + TOKENS["first"], b"not json") == 400
+
+        assert allHandled.wait(10)
+    finally:
+        runner.stop()
+        fakeApi.stop()
+
+    updateId = json.loads(update)["update_id"]
+    assert sorted(handled) == [("first", TOKENS["first"], updateId), ("second", TOKENS["second"], updateId),
+                               ("second", TOKENS["second"], updateId + 1)]
+
+def test_webhook_refuses_updates_once_stopped():
+    runner = TenantRunner(TOKENS)
+    tenant = runner.byName["first"]
+
+    runner.gate.close()
+    # refused (rather than acknowledged & lost), so telegram re-sends it after a restart
+    assert runner.accept(tenant, json.dumps({"update_id": 1}).encode("utf8")) == 503
+    assert runner.dispatcher.update_queue.qsize() == 0
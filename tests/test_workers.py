@@ -0,0 +1,86 @@
+# ------------------------------------------------------------------------------
+# Webhook Workers Tests
+# ------------------------------------------------------------------------------
+# run from the root folder of this repository with 'python3 -m pytest'
+# ------------------------------------------------------------------------------
+
+import http.client
+import json
+import socket
+import threading
+import time
+from covert_chess_bot.fake_bot_api import FakeBotApi
+from covert_chess_bot.workers import AcceptGate, WebhookWorkerPool
+
+TOKEN = "123456:test"
+
+def freePort():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+def post(connection, update):
+    '''
+    POST update to webhook on a keep-alive connection, returns http status (None if the connection failed).
+    '''
+    try:
+        connection.request("POST", "/" + TOKEN, json.dumps(update).encode("utf8"), {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        return None
+
+def test_accept_gate_waits_for_requests_in_flight():
+    gate = AcceptGate()
+    assert gate.enter()
+
+    closed = threading.Event()
+    threading.Thread(target=lambda: (gate.close(), closed.set()), daemon=True).start()
+
+    # refused as soon as closing, but close waits for the request already let through
+    time.sleep(0.1)
+    assert not gate.enter()
+    assert not closed.is_set()
+
+    gate.leave()
+    assert closed.wait(5)
+
+def test_stop_loses_no_acknowledged_updates():
+    fakeApi = FakeBotApi(enforceLimits=False)
+    replied = set()
+    fakeApi.listeners.append(lambda method, parameters: replied.add(int(parameters["chat_id"])))
+
+    port = freePort()
+    pool = WebhookWorkerPool(TOKEN, port, 2, listen="127.0.0.1", baseUrl=fakeApi.baseUrl, globalRate=1e9)
+    pool.start()
+
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        statuses = {}
+
+        for chatId in range(1, 11):
+            statuses[chatId] = post(connection, fakeApi.makeUpdate(chatId, "/start"))
+        assert all(status == 200 for status in statuses.values())
+
+        stopping = threading.Thread(target=pool.stop)
+        stopping.start()
+
+        # keep sending on the same keep-alive connection until the pool has stopped
+        chatId = 11
+        deadline = time.monotonic() + 60
+        while stopping.is_alive() and time.monotonic() < deadline:
+            statuses[chatId] = post(connection, fakeApi.makeUpdate(chatId, "/start"))
+            chatId += 1
+            time.sleep(0.01)
+
+        stopping.join()
+    finally:
+        fakeApi.stop()
+
+    acknowledged = {chatId for chatId, status in statuses.items() if status == 200}
+    # every update acknowledged was handled, the rest were refused (for telegram to re-send) or not received
+    assert acknowledged <= replied
+    assert all(status in (200, 503, None) for status in statuses.values())
+    assert any(status != 200 for status in statuses.values())